@@ -0,0 +1,29 @@
+#!/usr/bin/env bash
+
+set -x
+set -e
+set -u
+
+# With SSH_CONTROL_COMMAND=open, opens a persistent SSH connection to the client VM at SSH_CONTROL_PATH,
+# which tests then reuse for their sessions; with SSH_CONTROL_COMMAND=exit, closes it.
+
+if [[ "$SSH_CONTROL_COMMAND" == "exit" ]]; then
+  ssh -oControlPath="$SSH_CONTROL_PATH" -O exit ec2-user@"$CLIENT_PUBLIC_ADDRESS"
+  exit 0
+fi
+
+CLIENT_REGION_KEYNAME=${BASE_KEYNAME}-${CLIENT_REGION}
+CLIENT_REGION_KEYFILE=./aws-pems/${CLIENT_REGION_KEYNAME}.pem
+
+# The connection stays open in the background; it is closed after a while in case it is not closed explicitly
+set +e
+N=10
+until ssh -oStrictHostKeyChecking=no -oControlMaster=yes -oControlPersist=30m -oControlPath="$SSH_CONTROL_PATH" \
+  -i "$CLIENT_REGION_KEYFILE" ec2-user@"$CLIENT_PUBLIC_ADDRESS" true >/dev/null; do
+  N=$(( N-1 ))
+  if (( N == 0 )); then
+    >&2 echo "Could not open SSH connection"
+    exit 243
+  fi
+  sleep 2
+done
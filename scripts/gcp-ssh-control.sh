@@ -0,0 +1,28 @@
+#!/usr/bin/env bash
+
+set -x
+set -e
+set -u
+
+# With SSH_CONTROL_COMMAND=open, opens a persistent SSH connection to the client VM at SSH_CONTROL_PATH,
+# which tests then reuse for their sessions; with SSH_CONTROL_COMMAND=exit, closes it.
+
+if [[ "$SSH_CONTROL_COMMAND" == "exit" ]]; then
+  # Only the control socket is used, so the host name is arbitrary
+  ssh -oControlPath="$SSH_CONTROL_PATH" -O exit "$CLIENT_NAME"
+  exit 0
+fi
+
+# The connection stays open in the background; it is closed after a while in case it is not closed explicitly
+set +e
+N=15
+until gcloud compute ssh "$CLIENT_NAME" --zone="${CLIENT_ZONE}" \
+  --ssh-flag="-oControlMaster=yes" --ssh-flag="-oControlPersist=30m" --ssh-flag="-oControlPath=$SSH_CONTROL_PATH" \
+  --command true >/dev/null; do
+  N=$(( N-1 ))
+  if (( N == 0 )); then
+    >&2 echo "Could not open SSH connection"
+    exit 173
+  fi
+  sleep 3
+done
@@ -1,16 +1,33 @@
+import asyncio
+import datetime
 import json
 import logging
 import os
+import threading
+from typing import Union, Optional
 
 from cloud.clouds import Region, Cloud
-from util.subprocesses import run_subprocess
+from util.subprocesses import run_subprocess_async
+from util.utils import Timer
 
-__enabled_regions = {}
+# By region ID: whether it is enabled, and when that was last checked.
+# Entries without a time of checking, as in the default file, are not checked again.
+# Replaced rather than changed, so that checking again in the background does not change what is being read.
+__enabled_regions: dict[str, dict[str, Union[bool, str]]] = {}
+# For replacing it and writing the file, as from the background re-checking
+__lock = threading.Lock()
+# Unknown regions whose probe timed out, not saved, and treated as not enabled in this process
+__timed_out: set[str] = set()
 
 __enabled_regions_file = "region_data/enabled_aws_regions.json"
 
+# After this, an entry is re-checked in the background, and used meanwhile
+enabled_regions_ttl_s = 7 * 24 * 3600
+max_concurrent_probes = 8
+probe_timeout_s = 60
 
-def __get_enabled_regions():
+
+def __get_enabled_regions() -> dict[str, dict[str, Union[bool, str]]]:
     global __enabled_regions
     if (
         __enabled_regions
@@ -22,10 +39,12 @@ def __get_enabled_regions():
             d = json.load(f)
             # Remove comments
             d = {k: v for k, v in d.items() if not k.startswith("__")}
-            __enabled_regions = d
+            __enabled_regions = {
+                k: v if isinstance(v, dict) else {"enabled": v} for k, v in d.items()
+            }
             logging.info(
                 "Supported AWS Regions as %s",
-                __enabled_regions,
+                {k: v["enabled"] for k, v in __enabled_regions.items()},
             )
 
     except FileNotFoundError:
@@ -34,39 +53,107 @@ def __get_enabled_regions():
     return __enabled_regions
 
 
-def __add_to_cache(region: str, is_supported: bool):
-    global __enabled_regions
-    __enabled_regions[region] = is_supported
+def __save():
     # Sort by region and cloud (which is only AWS here)
-    __enabled_regions = dict(
-        sorted(__enabled_regions.items(), key=lambda i: (i[1], i[0]))
-    )
-    with open(__enabled_regions_file, "w") as f:
-        logging.info("Adding %s, AWS supported region: %s", region, is_supported)
-        json.dump(__enabled_regions, f, indent=2)
+    d = dict(sorted(__enabled_regions.items(), key=lambda i: (i[1]["enabled"], i[0])))
+    # Written to a new file that then replaces the old one, so that a crash leaves one or the other
+    tmp = f"{__enabled_regions_file}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(
+            {k: v if "checked" in v else v["enabled"] for k, v in d.items()},
+            f,
+            indent=2,
+        )
+    os.replace(tmp, __enabled_regions_file)
 
 
-def is_nonenabled_auth_aws_region(r: Region):
-    if r.cloud != Cloud.AWS:
+def __is_stale(entry: dict[str, Union[bool, str]]) -> bool:
+    if "checked" not in entry:
         return False
+    checked = datetime.datetime.fromisoformat(entry["checked"])
+    age = datetime.datetime.now(datetime.timezone.utc) - checked
+    return age.total_seconds() > enabled_regions_ttl_s
 
-    stored_value = __get_enabled_regions().get(r.region_id, None)
-    if stored_value is not None:
-        return not stored_value
 
-    try:
-        run_subprocess(
-            "./scripts/aws-test-auth.sh",
-            env={"PATH": os.environ.get("PATH"), "REGION": r.region_id},
+def discover_aws_regions(regions: list[Region]):
+    """Finds which of the AWS regions are enabled, probing those not known concurrently,
+    and waiting for that. Regions known from a check longer ago than enabled_regions_ttl_s
+    are checked again in the background, with the old value used meanwhile."""
+    known = __get_enabled_regions()
+    region_ids = [r.region_id for r in regions if r.cloud == Cloud.AWS]
+    unknown = [r for r in region_ids if r not in known and r not in __timed_out]
+    stale = [r for r in region_ids if r in known and __is_stale(known[r])]
+    if unknown:
+        with Timer(f"Discovering whether {len(unknown)} AWS regions are enabled"):
+            asyncio.run(__probe_all(unknown))
+    if stale:
+        logging.info("Checking again whether AWS regions %s are enabled", stale)
+        threading.Thread(
+            target=lambda: asyncio.run(__probe_all(stale)),
+            name="aws-regions-recheck",
+            daemon=True,
+        ).start()
+
+
+async def __probe_all(region_ids: list[str]):
+    """Probes the regions, and then writes the file once.
+    A probe that times out tells nothing, so the region's entry is left as it was."""
+    global __enabled_regions
+    limit = asyncio.Semaphore(max_concurrent_probes)
+
+    async def probe(region_id: str) -> Optional[bool]:
+        """:return whether the region is enabled, or None if the probe timed out"""
+        async with limit:
+            try:
+                # Timed out here rather than in the subprocess, which gives the same error as on failing
+                await asyncio.wait_for(
+                    run_subprocess_async(
+                        "./scripts/aws-test-auth.sh",
+                        env={"PATH": os.environ.get("PATH"), "REGION": region_id},
+                    ),
+                    probe_timeout_s,
+                )
+            except asyncio.TimeoutError:
+                logging.warning(
+                    "Could not discover whether %s is enabled: no answer in %s s",
+                    region_id,
+                    probe_timeout_s,
+                )
+                return None
+            except ChildProcessError:
+                is_enabled = False
+            else:
+                is_enabled = True
+        logging.info(
+            "Discovered %s is %s enabled",
+            region_id,
+            "" if is_enabled else "not ",
+        )
+        return is_enabled
+
+    enabled = await asyncio.gather(*[probe(r) for r in region_ids])
+    checked = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with __lock:
+        known = __get_enabled_regions()
+        __timed_out.update(
+            r for r, e in zip(region_ids, enabled) if e is None and r not in known
         )
-    except ChildProcessError:
-        is_enabled = False
-    else:
-        is_enabled = True
-    logging.info(
-        "Discovered %s is %s enabled",
-        r.region_id,
-        "" if is_enabled else "not ",
-    )
-    __add_to_cache(r.region_id, is_enabled)
-    return not is_enabled
+        discovered = {
+            r: {"enabled": e, "checked": checked}
+            for r, e in zip(region_ids, enabled)
+            if e is not None
+        }
+        if discovered:
+            __enabled_regions = known | discovered
+            __save()
+
+
+def is_nonenabled_auth_aws_region(r: Region):
+    if r.cloud != Cloud.AWS:
+        return False
+
+    if r.region_id not in __get_enabled_regions():
+        discover_aws_regions([r])
+    entry = __get_enabled_regions().get(r.region_id)
+    # Not known where the probe timed out
+    return entry is None or not entry["enabled"]
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
 import csv
+import hashlib
+import logging
+import os
 import re
 from enum import Enum
 from functools import total_ordering
+from typing import Optional
 
 import geopy.distance
+import numpy as np
 
 from util.utils import gcp_default_project
 
@@ -25,6 +30,11 @@ __PRIVATE__INIT__ = object()
 
 @total_ordering
 class Region:
+    """There is one Region object for each region, from get_region(), so that equality is identity,
+    and hashing uses a precomputed hash."""
+
+    __slots__ = ("lat", "long", "cloud", "region_id", "idx", "__repr", "__hash")
+
     def __init__(
         self,
         private_init,
@@ -32,7 +42,9 @@ class Region:
         region_id: str,
         lat: float = None,
         long: float = None,
+        idx: int = 0,
     ):
+        """:param idx: the index of the region in get_regions()"""
         if private_init is not __PRIVATE__INIT__:
             raise ValueError(
                 'Call get_region() instead of  CloudRegion, which is kept "private" so that a cache can be built.'
@@ -45,6 +57,9 @@ class Region:
         self.long = long
         self.cloud = cloud
         self.region_id = region_id
+        self.idx = idx
+        self.__repr = f"{cloud.name}.{region_id}"
+        self.__hash = hash(self.__repr)
 
     def script(self):
         return f"./scripts/{self.lowercase_cloud_name()}-launch.sh"
@@ -52,14 +67,18 @@ class Region:
     def deletion_script(self):
         return f"./scripts/{self.lowercase_cloud_name()}-delete-instances.sh"
 
-    def script_for_test_from_region(self):
-        return f"./scripts/do-one-test-from-{self.lowercase_cloud_name()}.sh"
+    def ssh_control_script(self):
+        return f"./scripts/{self.lowercase_cloud_name()}-ssh-control.sh"
 
     def __repr__(self):
-        return f"{self.cloud.name}.{self.region_id}"
+        return self.__repr
 
     def __hash__(self):
-        return hash(repr(self))
+        return self.__hash
+
+    def __reduce__(self):
+        # Unpickled or copied as the same object
+        return get_region, (self.cloud.name, self.region_id)
 
     def env(self) -> dict[str, str]:
         envs = {
@@ -73,14 +92,20 @@ class Region:
 
     def __lt__(self, other):
         """Note @total_ordering above"""
-        return repr(self) < repr(other)
+        return self.__repr < other.__repr
 
     def __eq__(self, other):
-        return self.region_id == other.region_id and self.cloud == other.cloud
+        return self is other
 
 
+__locations_file = "./region_data/locations.csv"
+# Distances in km between the regions, by index in get_regions(), built for the content of locations.csv
+__distances_file = "./region_data/distances.npz"
+
 __regions: list[Region]
 __regions = []
+# By cloud, as Cloud and as its name, and region_id
+__regions_by_key: dict[tuple[Cloud | str, str], Region] = {}
 
 
 def get_regions() -> list[Region]:
@@ -88,7 +113,7 @@ def get_regions() -> list[Region]:
 
     if not __regions:
 
-        fp = open(f"./region_data/locations.csv")
+        fp = open(__locations_file)
         rdr = csv.DictReader(filter(lambda row_: row_[0] != "#", fp))
         for row in rdr:
 
@@ -104,9 +129,13 @@ def get_regions() -> list[Region]:
 
             region_id = row["region"]
 
-            __regions.append(
-                Region(__PRIVATE__INIT__, Cloud(cloud_s), region_id, lat, long)
+            region = Region(
+                __PRIVATE__INIT__, Cloud(cloud_s), region_id, lat, long, len(__regions)
             )
+            assert (region.cloud, region_id) not in __regions_by_key, region
+            __regions_by_key[(region.cloud, region_id)] = region
+            __regions_by_key[(region.cloud.name, region_id)] = region
+            __regions.append(region)
         fp.close()
     return __regions
 
@@ -115,18 +144,15 @@ def get_region(
     cloud: [Cloud | str],
     region_id: str,
 ) -> Region:
-    regions = get_regions()
-    if isinstance(cloud, str):
-        cloud = Cloud(cloud)
-    assert isinstance(cloud, Cloud), cloud
-    matches = [r for r in regions if r.cloud == cloud and r.region_id == region_id]
-    if not matches:
-        print(f"{cloud}")
+    if not __regions:
+        get_regions()
+    try:
+        return __regions_by_key[(cloud, region_id)]
+    except KeyError:
+        if isinstance(cloud, str):
+            cloud = Cloud(cloud)
+        assert isinstance(cloud, Cloud), cloud
         raise ValueError(f"Cannot find region {cloud}.{region_id}")
-    else:
-        assert len(matches) == 1, matches
-        ret = matches[0]
-        return ret
 
 
 def __samecity_crosscloud_datacenters() -> list[set[Region, Region]]:
@@ -143,21 +169,79 @@ def __samecity_crosscloud_datacenters() -> list[set[Region, Region]]:
     ]
 
 
-def interregion_distance(r1: Region, r2: Region):
-    ret = geopy.distance.distance((r1.lat, r1.long), (r2.lat, r2.long)).km
-    if ret == 0:
-        if r1 == r2:
-            pass  # Test within a single cloud's region. Use 0 though in fact a region can be spread out.
-        else:
-            if {r1, r2} in __samecity_crosscloud_datacenters():
-                # Where we have identical coordinates for cross-cloud data-centers, it
-                # means that a city's coordinates were used as an approximation.
-                # We use 10 as an approximation for intra-city distance to avoid divide-by-zero errors.
-                ret = 10
-            else:
-                assert False, (
-                    f"Should not have zero distance for region "
-                    f"pair unless these are known same-city data-centers {r1},{r2}"
-                )
+def interregion_distance(r1: Region, r2: Region) -> float:
+    ret = __distance_matrix()[r1.idx, r2.idx]
+    assert not np.isnan(ret), (
+        f"Should not have zero distance for region "
+        f"pair unless these are known same-city data-centers {r1},{r2}"
+    )
+    return float(ret)
+
+
+def interregion_distances(src_idxs: np.ndarray, dst_idxs: np.ndarray) -> np.ndarray:
+    """:param src_idxs: Region.idx of each source
+    :param dst_idxs: Region.idx of each destination
+    :return the distance of each pair, in km"""
+    ret = __distance_matrix()[src_idxs, dst_idxs]
+    assert not np.isnan(ret).any(), "Zero distance between regions in different cities"
+    return ret
 
+
+__distances: Optional[np.ndarray] = None
+
+
+def locations_hash() -> str:
+    """:return the SHA-256 of locations.csv, which distances are computed from"""
+    with open(__locations_file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def __distance_matrix() -> np.ndarray:
+    global __distances
+    if __distances is None:
+        source_hash = locations_hash()
+        __distances = __load_distances(source_hash)
+        if __distances is None:
+            __distances = __build_distances()
+            # Written to a new file that then replaces the old one, so that readers see one or the other
+            tmp = f"{__distances_file}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.savez(f, source_hash=source_hash, km=__distances)
+            os.replace(tmp, __distances_file)
+    return __distances
+
+
+def __load_distances(source_hash: str) -> Optional[np.ndarray]:
+    try:
+        with np.load(__distances_file) as saved:
+            if str(saved["source_hash"]) != source_hash:
+                return None
+            return saved["km"]
+    except (FileNotFoundError, KeyError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logging.warning("Ignoring unreadable %s: %s", __distances_file, e)
+        return None
+
+
+def __build_distances() -> np.ndarray:
+    """Geodesic distances, as from geopy, so that they do not change with the cache.
+    Where a pair has identical coordinates, it is NaN unless known to be in the same city.
+    """
+    regions = get_regions()
+    samecity = __samecity_crosscloud_datacenters()
+    # Within a single cloud's region, 0 though in fact a region can be spread out.
+    ret = np.zeros((len(regions), len(regions)))
+    for i, r1 in enumerate(regions):
+        for j in range(i + 1, len(regions)):
+            r2 = regions[j]
+            d = geopy.distance.distance((r1.lat, r1.long), (r2.lat, r2.long)).km
+            if d == 0:
+                if {r1, r2} in samecity:
+                    # Where we have identical coordinates for cross-cloud data-centers, it
+                    # means that a city's coordinates were used as an approximation.
+                    # We use 10 as an approximation for intra-city distance to avoid divide-by-zero errors.
+                    d = 10
+                else:
+                    d = np.nan
+            ret[i, j] = ret[j, i] = d
     return ret
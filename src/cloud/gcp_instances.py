@@ -0,0 +1,262 @@
+"""GCP instances created and deleted in bulk with gcloud.
+
+The requests for all the instances are sent at once, without waiting for each to finish,
+and then all their instances and operations are polled with one listing of each,
+so that each instance is reported on as soon as it is ready or has failed.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from typing import Callable, Awaitable, Union, Optional, NamedTuple
+
+from cloud.clouds import Region, Cloud
+from util.subprocesses import run_command_async
+from util.utils import gcp_default_project, subprocess_timeout
+
+poll_interval_s = 3
+# Deletion requests, each for the instances of one zone, sent at once
+max_concurrent_deletion_requests = 10
+startup_script = "./startup-scripts/gcp-install-and-run-iperf-server.sh"
+
+
+def instance_name(run_id: str, region: Region) -> str:
+    return f"intercloud-{region.region_id}-{run_id}"
+
+
+def zone(region: Region) -> str:
+    return f"{region.region_id}-b"
+
+
+async def create_instances(
+    run_id: str,
+    regions: list[Region],
+    machine_type: str,
+    on_created: Callable[[Region, Union[str, Exception]], Awaitable[None]],
+    timeout: float = subprocess_timeout,
+):
+    """Creates an instance in each region, labeled with run_id.
+    :param on_created: called as each instance is up, with output as from CloudProvider.launch_vm,
+    that is, its address, name, and zone, comma-separated; or with the exception if it failed
+    """
+    assert all(r.cloud == Cloud.GCP for r in regions), regions
+    project = gcp_default_project()
+    pending: dict[str, Region] = {}
+
+    async def request(region: Region):
+        name = instance_name(run_id, region)
+        try:
+            await run_command_async(
+                [
+                    "gcloud",
+                    "compute",
+                    "instances",
+                    "create",
+                    name,
+                    f"--project={project}",
+                    f"--zone={zone(region)}",
+                    f"--machine-type={machine_type}",
+                    "--network-interface=network-tier=PREMIUM",
+                    f"--labels=run-id={run_id}",
+                    f"--metadata-from-file=startup-script={os.path.abspath(startup_script)}",
+                    "--async",
+                ],
+                timeout=timeout,
+            )
+        except ChildProcessError as e:
+            await on_created(region, e)
+        else:
+            pending[name] = region
+
+    await asyncio.gather(*(request(r) for r in regions))
+
+    deadline = time.monotonic() + timeout
+    while pending:
+        await asyncio.sleep(poll_interval_s)
+        try:
+            instances = await list_instances(project, run_id)
+            errors = await __operation_errors(project, run_id, "insert")
+        except ChildProcessError as e:
+            logging.warning("Failed to poll GCP instances of run %s: %r", run_id, e)
+            instances, errors = {}, {}
+        for name, region in list(pending.items()):
+            address = __address(instances.get(name))
+            if address:
+                del pending[name]
+                await on_created(region, f"{address},{name},{zone(region)}")
+            elif name in errors:
+                del pending[name]
+                await on_created(region, ChildProcessError(errors[name]))
+        if pending and time.monotonic() > deadline:
+            for name, region in pending.items():
+                await on_created(
+                    region, ChildProcessError(f"Not up after {timeout} s: {name}")
+                )
+            break
+
+
+class Deletion(NamedTuple):
+    """The outcome of deleting an instance"""
+
+    # None if it was deleted
+    error: Optional[str]
+    # From the request until it was seen to be gone, or was given up on
+    latency_s: float
+
+
+async def delete_instances(
+    run_id: str, regions: list[Region], timeout: float = subprocess_timeout
+) -> dict[str, Deletion]:
+    """Deletes the instances labeled with run_id in these regions, and then checks that none
+    is left, deleting again any that are, as from a failed request or a launch still going.
+    :return the outcome for each instance, by name
+    """
+    project = gcp_default_project()
+    zones = {zone(r) for r in regions}
+    ret = await __delete_in_zones(project, run_id, zones, timeout)
+    try:
+        left = await __instances_in_zones(project, run_id, zones)
+        if left:
+            logging.warning(
+                "Deleting again %d GCE VMs left from run %s: %s",
+                len(left),
+                run_id,
+                list(left),
+            )
+            ret |= await __delete_in_zones(project, run_id, zones, timeout)
+            for name in await __instances_in_zones(project, run_id, zones):
+                deletion = ret.get(name, Deletion(None, 0))
+                if deletion.error is None:
+                    ret[name] = deletion._replace(error="Still exists after deletion")
+    except ChildProcessError as e:
+        logging.error("Could not check for GCE VMs left from run %s: %r", run_id, e)
+    return ret
+
+
+async def __delete_in_zones(
+    project: str, run_id: str, zones: set[str], timeout: float
+) -> dict[str, Deletion]:
+    instances = await __instances_in_zones(project, run_id, zones)
+    by_zone: dict[str, list[str]] = {}
+    for name, i in instances.items():
+        by_zone.setdefault(__basename(i["zone"]), []).append(name)
+
+    ret: dict[str, Deletion] = {}
+    requested: dict[str, float] = {}
+    limit = asyncio.Semaphore(max_concurrent_deletion_requests)
+    since = time.time()
+
+    async def request(zone_: str, names: list[str]):
+        # One request for all the instances in the zone
+        async with limit:
+            start = time.monotonic()
+            try:
+                await run_command_async(
+                    ["gcloud", "compute", "instances", "delete", "-q", *names]
+                    + [f"--project={project}", f"--zone={zone_}", "--async"],
+                    timeout=timeout,
+                )
+            except ChildProcessError as e:
+                ret.update(
+                    {n: Deletion(repr(e), time.monotonic() - start) for n in names}
+                )
+            else:
+                requested.update(dict.fromkeys(names, start))
+
+    await asyncio.gather(*(request(z, names) for z, names in by_zone.items()))
+
+    deadline = time.monotonic() + timeout
+    while requested:
+        await asyncio.sleep(poll_interval_s)
+        try:
+            remaining = await list_instances(project, run_id)
+            errors = await __operation_errors(project, run_id, "delete", since)
+        except ChildProcessError as e:
+            logging.warning("Failed to poll GCP instances of run %s: %r", run_id, e)
+            remaining, errors = None, {}
+        now = time.monotonic()
+        # Where the listing failed, not known whether any is gone, until the deadline
+        for name, start in list(requested.items()) if remaining is not None else []:
+            if name not in remaining:
+                del requested[name]
+                ret[name] = Deletion(None, now - start)
+                logging.info("Deleted GCE VM %s in %.1f s", name, now - start)
+            elif name in errors:
+                del requested[name]
+                ret[name] = Deletion(errors[name], now - start)
+        if requested and now > deadline:
+            ret.update(
+                {
+                    n: Deletion(f"Not deleted after {timeout} s", now - start)
+                    for n, start in requested.items()
+                }
+            )
+            break
+    return ret
+
+
+async def __instances_in_zones(
+    project: str, run_id: str, zones: set[str]
+) -> dict[str, dict]:
+    return {
+        name: i
+        for name, i in (await list_instances(project, run_id)).items()
+        if __basename(i["zone"]) in zones
+    }
+
+
+async def list_instances(project: str, run_id: str) -> dict[str, dict]:
+    """:return the instances labeled with run_id, by name"""
+    out = await run_command_async(
+        ["gcloud", "compute", "instances", "list"]
+        + [f"--project={project}", f"--filter=labels.run-id={run_id}", "--format=json"],
+        timeout=subprocess_timeout,
+    )
+    return {i["name"]: i for i in json.loads(out or "[]")}
+
+
+async def __operation_errors(
+    project: str, run_id: str, operation_type: str, since: float = 0
+) -> dict[str, str]:
+    """:param since: the time from which operations are considered, as from time.time()
+    :return errors of the operations of this type on instances of the run, by instance name
+    """
+    out = await run_command_async(
+        ["gcloud", "compute", "operations", "list"]
+        + [
+            f"--project={project}",
+            f"--filter=operationType={operation_type} AND targetLink~-{run_id}$",
+            "--format=json",
+        ],
+        timeout=subprocess_timeout,
+    )
+    return {
+        __basename(op["targetLink"]): "; ".join(
+            e.get("message", e.get("code", "")) for e in op["error"]["errors"]
+        )
+        for op in json.loads(out or "[]")
+        if op.get("status") == "DONE"
+        and op.get("error")
+        and (
+            not since
+            or datetime.datetime.fromisoformat(op["insertTime"]).timestamp() >= since
+        )
+    }
+
+
+def __address(instance: Optional[dict]) -> Optional[str]:
+    """:return the external address of a running instance"""
+    if not instance or instance.get("status") != "RUNNING":
+        return None
+    for interface in instance.get("networkInterfaces", []):
+        for config in interface.get("accessConfigs", []):
+            if config.get("natIP"):
+                return config["natIP"]
+    return None
+
+
+def __basename(url: str) -> str:
+    return url.rsplit("/", 1)[-1]
@@ -0,0 +1,299 @@
+import abc
+import asyncio
+import getpass
+import logging
+import os
+import time
+from typing import Optional, Callable, Awaitable, Union
+
+from cloud import gcp_instances
+from cloud.clouds import Region, Cloud, basename_key_for_aws_ssh
+from test_steps.measurement import (
+    Measurement,
+    MeasurementError,
+    Transport,
+    OpenSshTransport,
+    GcloudSshTransport,
+    measure,
+)
+from test_steps.utils import env_for_singlecloud_subprocess
+from util.subprocesses import run_subprocess_async
+from util.utils import subprocess_timeout
+
+# For all the GCP VMs being deleted at once
+gcp_deletion_timeout = 6 * 60
+# Attempts at each command of a test, and the delay between them, since VMs may not yet accept connections
+ssh_retries = {Cloud.AWS: (10, 2), Cloud.GCP: (15, 3)}
+
+
+class CloudProvider(abc.ABC):
+    """Launches VMs, runs tests from them, and deletes them, in one cloud.
+
+    Launching gives the VM's address, for GCP followed by its name and zone, comma-separated,
+    as output by the launch scripts under `scripts`.
+    """
+
+    @abc.abstractmethod
+    async def launch_vm(self, run_id: str, region: Region, machine_type: str) -> str:
+        pass
+
+    async def launch_vms(
+        self,
+        run_id: str,
+        regions: list[Region],
+        machine_type: str,
+        on_launched: Callable[[Region, Union[str, Exception]], Awaitable[None]],
+    ):
+        """Launches a VM in each region.
+        :param on_launched: called as each launch finishes, with the output of launching,
+        or with the exception if it failed
+        By default, each VM is launched with launch_vm, all at once.
+        """
+
+        async def launch(region: Region):
+            try:
+                output = await self.launch_vm(run_id, region, machine_type)
+            except Exception as e:
+                output = e
+            await on_launched(region, output)
+
+        await asyncio.gather(*(launch(r) for r in regions))
+
+    @abc.abstractmethod
+    async def run_test(
+        self,
+        run_id: str,
+        src: tuple[Region, dict],
+        dst: tuple[Region, dict],
+        ssh_control_path: Optional[str] = None,
+    ) -> Measurement:
+        """:param src: the region and information on the VM where the test is run from,
+        which is in this provider's cloud.
+        :param ssh_control_path: a connection to the source VM opened with open_ssh_connection,
+        over which the test's SSH sessions go, rather than each making its own connection.
+        :raise MeasurementError, with the step that failed
+        """
+
+    @abc.abstractmethod
+    async def open_ssh_connection(
+        self, run_id: str, src: tuple[Region, dict], control_path: str
+    ):
+        """Opens a persistent SSH connection to this VM, with its control socket at control_path."""
+
+    @abc.abstractmethod
+    async def close_ssh_connection(
+        self, run_id: str, src: tuple[Region, dict], control_path: str
+    ):
+        pass
+
+    @abc.abstractmethod
+    async def delete_vms(self, run_id: str, regions: list[Region]):
+        """Deletes VMs from this run in these regions of this provider's cloud."""
+
+
+class ScriptProvider(CloudProvider):
+    """Runs the scripts under `scripts` against the real cloud;
+    for launching and deleting GCP VMs, gcloud through gcp_instances."""
+
+    async def launch_vm(self, run_id: str, region: Region, machine_type: str) -> str:
+        if region.cloud == Cloud.GCP:
+            outputs: dict[Region, Union[str, Exception]] = {}
+
+            async def on_created(r: Region, output: Union[str, Exception]):
+                outputs[r] = output
+
+            await gcp_instances.create_instances(
+                run_id, [region], machine_type, on_created
+            )
+            if isinstance(outputs[region], Exception):
+                raise outputs[region]
+            return outputs[region]
+
+        env = env_for_singlecloud_subprocess(run_id, region)
+        env["MACHINE_TYPE"] = machine_type
+        return await run_subprocess_async(region.script(), env, subprocess_timeout)
+
+    async def launch_vms(
+        self,
+        run_id: str,
+        regions: list[Region],
+        machine_type: str,
+        on_launched: Callable[[Region, Union[str, Exception]], Awaitable[None]],
+    ):
+        if regions and all(r.cloud == Cloud.GCP for r in regions):
+            # Requested all at once, and polled together
+            await gcp_instances.create_instances(
+                run_id, regions, machine_type, on_launched
+            )
+        else:
+            await super().launch_vms(run_id, regions, machine_type, on_launched)
+
+    async def run_test(
+        self,
+        run_id: str,
+        src: tuple[Region, dict],
+        dst: tuple[Region, dict],
+        ssh_control_path: Optional[str] = None,
+    ) -> Measurement:
+        src_region_ = src[0]
+        dst_vm_info = dst[1]
+        attempts, retry_delay_s = ssh_retries[src_region_.cloud]
+        start = time.time()
+        try:
+            return await asyncio.wait_for(
+                measure(
+                    self.__transport(src, ssh_control_path),
+                    dst_vm_info["address"],
+                    attempts,
+                    retry_delay_s,
+                ),
+                subprocess_timeout,
+            )
+        except asyncio.TimeoutError:
+            raise MeasurementError(
+                "timeout",
+                f"No result in {subprocess_timeout} s",
+                1,
+                time.time() - start,
+            )
+
+    @staticmethod
+    def __transport(
+        src: tuple[Region, dict], ssh_control_path: Optional[str]
+    ) -> Transport:
+        src_region_, src_vm_info = src
+        if src_region_.cloud == Cloud.AWS:
+            return OpenSshTransport(
+                "ec2-user",
+                src_vm_info["address"],
+                f"./aws-pems/{basename_key_for_aws_ssh}-{src_region_.region_id}.pem",
+                ssh_control_path,
+            )
+        elif src_region_.cloud == Cloud.GCP:
+            if ssh_control_path:
+                # The connection was opened with gcloud, which uses this key and the local user
+                return OpenSshTransport(
+                    getpass.getuser(),
+                    src_vm_info["address"],
+                    os.path.expanduser("~/.ssh/google_compute_engine"),
+                    ssh_control_path,
+                )
+            else:
+                return GcloudSshTransport(src_vm_info["name"], src_vm_info["zone"])
+        else:
+            assert (
+                False
+            ), f"Did not implement  tests from this cloud: {src_region_.cloud}"
+
+    async def open_ssh_connection(
+        self, run_id: str, src: tuple[Region, dict], control_path: str
+    ):
+        await self.__ssh_control(run_id, src, control_path, "open")
+
+    async def close_ssh_connection(
+        self, run_id: str, src: tuple[Region, dict], control_path: str
+    ):
+        await self.__ssh_control(run_id, src, control_path, "exit")
+
+    async def __ssh_control(
+        self, run_id: str, src: tuple[Region, dict], control_path: str, command: str
+    ):
+        env = self.__client_env(run_id, src) | {
+            "SSH_CONTROL_PATH": control_path,
+            "SSH_CONTROL_COMMAND": command,
+        }
+        script = src[0].ssh_control_script()
+        _ = await run_subprocess_async(script, env, subprocess_timeout)
+
+    @staticmethod
+    def __client_env(run_id: str, src: tuple[Region, dict]) -> dict[str, str]:
+        """:return environment for scripts that connect to the VM where tests are run from"""
+        src_region_, src_vm_info = src
+        env = {
+            "PATH": os.environ["PATH"],
+            "RUN_ID": run_id,
+            "CLIENT_CLOUD": src_region_.cloud.name,
+            "CLIENT_REGION": src_region_.region_id,
+        }
+
+        if src_region_.cloud == Cloud.AWS:
+            env |= {
+                "CLIENT_PUBLIC_ADDRESS": src_vm_info["address"],
+                "BASE_KEYNAME": basename_key_for_aws_ssh,
+            }
+        elif src_region_.cloud == Cloud.GCP:
+            try:
+                env |= {
+                    "CLIENT_NAME": src_vm_info["name"],
+                    "CLIENT_ZONE": src_vm_info["zone"],
+                }
+            except KeyError as ke:
+                logging.error(f"{src_vm_info=}")
+                raise ke
+
+        else:
+            assert (
+                False
+            ), f"Did not implement  tests from this cloud: {src_region_.cloud} (region {src_region_})"
+        return env
+
+    async def delete_vms(self, run_id: str, regions: list[Region]):
+        if not regions:
+            return
+        clouds = {r.cloud for r in regions}
+        assert len(clouds) == 1, clouds
+        cloud = clouds.pop()
+
+        if cloud == Cloud.GCP:
+            logging.info("Will delete GCE VMs from run-id %s in %s", run_id, regions)
+            outcomes = await gcp_instances.delete_instances(
+                run_id, regions, gcp_deletion_timeout
+            )
+            for name, deletion in outcomes.items():
+                if deletion.error:
+                    logging.error(
+                        "Failed to delete GCE VM %s: %s", name, deletion.error
+                    )
+            latencies = sorted(d.latency_s for d in outcomes.values() if not d.error)
+            if latencies:
+                logging.info(
+                    "Deleted %d GCE VMs from run-id %s; latency median %.1f s, max %.1f s",
+                    len(latencies),
+                    run_id,
+                    latencies[len(latencies) // 2],
+                    latencies[-1],
+                )
+        else:
+
+            async def delete_in_region(cloud_region: Region):
+                logging.info(
+                    "Will delete %s VMs from run-id %s in %s",
+                    cloud,
+                    run_id,
+                    cloud_region,
+                )
+                env = env_for_singlecloud_subprocess(run_id, cloud_region)
+                script = cloud_region.deletion_script()
+                _ = await run_subprocess_async(script, env, subprocess_timeout)
+
+            outcomes = await asyncio.gather(
+                *(delete_in_region(r) for r in regions), return_exceptions=True
+            )
+            for cloud_region, outcome in zip(regions, outcomes):
+                if isinstance(outcome, BaseException):
+                    logging.error(
+                        "Failed to delete VMs in %s: %r", cloud_region, outcome
+                    )
+
+
+__script_provider = ScriptProvider()
+__providers: dict[Cloud, CloudProvider] = {}
+
+
+def provider(cloud: Cloud) -> CloudProvider:
+    return __providers.get(cloud, __script_provider)
+
+
+def set_provider(cloud: Cloud, provider_: CloudProvider):
+    logging.info("Using %s for %s", type(provider_).__name__, cloud)
+    __providers[cloud] = provider_
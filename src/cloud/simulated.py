@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import math
+import random
+from typing import Optional
+
+from cloud.clouds import Region, Cloud, interregion_distance
+from cloud.providers import CloudProvider, set_provider
+from test_steps.measurement import Measurement, MeasurementError
+
+# Approximate, from the results of real runs
+default_boot_time_s = {Cloud.AWS: (90.0, 30.0), Cloud.GCP: (30.0, 10.0)}
+# Speed of light in fiber is about 200 km/ms, and routes are not straight.
+km_per_ms_rtt = 200 / 2 / 1.4
+min_rtt_ms = 0.5
+# TCP throughput is limited by window size / RTT, up to the VM's bandwidth
+tcp_window_bytes = 15e6
+max_bitrate_Bps = 2e9
+iperf_bytes = 10e6
+ping_count = 5
+# For starting up the processes
+overhead_rtts = 6
+# Mean and standard deviation of the time to open an SSH connection to a VM
+ssh_handshake_s = (1.5, 0.5)
+
+
+class SimulatedProvider(CloudProvider):
+    """A cloud simulated on this machine, for testing and benchmarking the system without clouds.
+
+    VMs "boot" after a time drawn from a normal distribution. Tests take as long as
+    the iperf transfer and pings would, plus SSH handshakes unless a connection is open,
+    and give a bitrate and RTT based on distance.
+    All times are multiplied by time_scale, so that whole runs can be sped up.
+    """
+
+    def __init__(
+        self,
+        cloud: Cloud,
+        boot_time_s: Optional[tuple[float, float]] = None,
+        time_scale: float = 1.0,
+        launch_failure_rate: float = 0.0,
+        test_failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        """:param boot_time_s: mean and standard deviation of the time to launch a VM"""
+        self.cloud = cloud
+        self.boot_time_s = boot_time_s or default_boot_time_s[cloud]
+        self.time_scale = time_scale
+        self.launch_failure_rate = launch_failure_rate
+        self.test_failure_rate = test_failure_rate
+        self.__random = random.Random(seed)
+        # Run ID and region to address
+        self.__live_vms: dict[tuple[str, Region], str] = {}
+        self.__vm_counter = 0
+        self.__ssh_connections: set[str] = set()
+
+    def live_vms(self, run_id: str) -> list[Region]:
+        return [r for (run_id_, r) in self.__live_vms if run_id_ == run_id]
+
+    async def __sleep(self, seconds: float):
+        await asyncio.sleep(max(0.0, seconds) * self.time_scale)
+
+    async def launch_vm(self, run_id: str, region: Region, machine_type: str) -> str:
+        assert region.cloud == self.cloud, region
+        mean, sd = self.boot_time_s
+        await self.__sleep(self.__random.gauss(mean, sd))
+        if self.__random.random() < self.launch_failure_rate:
+            raise ChildProcessError(f"Simulated failure to launch VM in {region}")
+
+        self.__vm_counter += 1
+        address = f"10.{self.__vm_counter // 256 % 256}.{self.__vm_counter % 256}.1"
+        self.__live_vms[(run_id, region)] = address
+        logging.info("Simulated VM in %s at %s", region, address)
+        if self.cloud == Cloud.GCP:
+            name = f"intercloud-{region.region_id}-{run_id}"
+            return f"{address},{name},{region.region_id}-b\n"
+        else:
+            return f"{address}\n"
+
+    async def run_test(
+        self,
+        run_id: str,
+        src: tuple[Region, dict],
+        dst: tuple[Region, dict],
+        ssh_control_path: Optional[str] = None,
+    ) -> Measurement:
+        src_region, dst_region = src[0], dst[0]
+        assert src_region.cloud == self.cloud, src_region
+        rtt_ms, bitrate_Bps = self.__network_model(src_region, dst_region)
+        rtt_s = rtt_ms / 1000
+        durations_s = {
+            "iperf": overhead_rtts / 2 * rtt_s + iperf_bytes / bitrate_Bps,
+            "ping": overhead_rtts / 2 * rtt_s + ping_count - 1,
+        }
+        timings = {}
+        for step, duration_s in durations_s.items():
+            if ssh_control_path not in self.__ssh_connections:
+                duration_s += self.__ssh_handshake_time()
+            await self.__sleep(duration_s)
+            timings[step] = duration_s * self.time_scale
+            if self.__random.random() < self.test_failure_rate / len(durations_s):
+                raise MeasurementError(
+                    step,
+                    f"Simulated failure in test {src_region} to {dst_region}",
+                    1,
+                    sum(timings.values()),
+                )
+
+        return Measurement(bitrate_Bps, rtt_ms, timings)
+
+    def __ssh_handshake_time(self) -> float:
+        mean, sd = ssh_handshake_s
+        return self.__random.gauss(mean, sd)
+
+    async def open_ssh_connection(
+        self, run_id: str, src: tuple[Region, dict], control_path: str
+    ):
+        assert src[0].cloud == self.cloud, src[0]
+        await self.__sleep(self.__ssh_handshake_time())
+        self.__ssh_connections.add(control_path)
+
+    async def close_ssh_connection(
+        self, run_id: str, src: tuple[Region, dict], control_path: str
+    ):
+        self.__ssh_connections.discard(control_path)
+
+    def __network_model(self, src: Region, dst: Region) -> tuple[float, float]:
+        """:return RTT in ms and bitrate in bytes per second, with random variation"""
+        distance = interregion_distance(src, dst)
+        rtt_ms = (min_rtt_ms + distance / km_per_ms_rtt) * self.__random.uniform(
+            1.0, 1.1
+        )
+        bitrate_Bps = min(
+            max_bitrate_Bps,
+            tcp_window_bytes / (rtt_ms / 1000) * math.exp(self.__random.gauss(0, 0.3)),
+        )
+        return rtt_ms, bitrate_Bps
+
+    async def delete_vms(self, run_id: str, regions: list[Region]):
+        async def delete_vm(r: Region):
+            assert r.cloud == self.cloud, r
+            await self.__sleep(self.__random.uniform(5, 15))
+            if self.__live_vms.pop((run_id, r), None):
+                logging.info("Deleted simulated VM in %s", r)
+
+        if self.cloud == Cloud.GCP:
+            # As in the real deletion script, one after the other
+            for region in regions:
+                await delete_vm(region)
+        else:
+            await asyncio.gather(*(delete_vm(r) for r in regions))
+
+
+def simulate_clouds(clouds: list[Cloud], **kwargs) -> dict[Cloud, SimulatedProvider]:
+    """Use simulated providers for these clouds instead of the real ones.
+    :param kwargs: as for SimulatedProvider
+    """
+    providers = {}
+    for c in clouds:
+        providers[c] = SimulatedProvider(c, **kwargs)
+        set_provider(c, providers[c])
+    return providers
@@ -3,7 +3,6 @@ import logging
 import os
 import platform
 import subprocess
-from math import log10
 from os import mkdir
 from pathlib import Path
 from statistics import mean
@@ -17,22 +16,20 @@ from matplotlib.collections import PathCollection
 from numpy.linalg import LinAlgError
 from scipy.stats import pearsonr
 
-from cloud.clouds import interregion_distance, get_region, Cloud
-from history.results import load_history, results_dir, perftest_resultsdir_envvar
+from cloud.clouds import Cloud
+from history.columnar import load_columns, HistoryColumns
+from history.results import results_dir, perftest_resultsdir_envvar
 from util import utils
 from util.utils import set_cwd, process_starttime, process_starttime_iso
 
 
-def __statistics(results):
-    def extract(key):
-        return [r[key] for r in results]
-
+def __statistics(columns: HistoryColumns) -> dict[str, np.ndarray]:
     mega = 1e6
 
     return {
-        "distance": extract("distance"),
-        "bitrate_Bps": [r / mega for r in extract("bitrate_Bps")],
-        "avgrtt": extract("avgrtt"),
+        "distance": columns.distance,
+        "bitrate_Bps": columns.bitrate_Bps / mega,
+        "avgrtt": columns.avgrtt,
     }
 
 
@@ -48,56 +45,42 @@ def __log_mean_ratios(clouddata):
     avgrtt_s = f"Mean of {bitrate_multiplier} log(bitrate)/dist\n"
     bitrate_s = "Mean of avg RTT/dist\n"
     for cloudpair, data in clouddata.items():
-        dist = data["distance"]
-        if not dist:
+        nonzero = data["distance"] != 0
+        dist = data["distance"][nonzero]
+        if not len(dist):
             continue
-        bitrate = data["bitrate_Bps"]
-        rtt = data["avgrtt"]
-        assert len(dist) == len(bitrate) == len(rtt)
-        mean_bitrate = mean(
-            [log10(bitrate[i]) / dist[i] for i in range(len(dist)) if dist[i] != 0]
-        )
+        bitrate = data["bitrate_Bps"][nonzero]
+        rtt = data["avgrtt"][nonzero]
+        mean_bitrate = np.mean(np.log10(bitrate) / dist)
 
         bitrate_s += "\t%s: %s\n" % (
             __cloudpair_s(cloudpair),
             round(bitrate_multiplier * mean_bitrate, 1),
         )
 
-        mean_avgrtt = mean([rtt[j] / dist[j] for j in range(len(dist)) if dist[j] != 0])
+        mean_avgrtt = np.mean(rtt / dist)
         avgrtt_s += "\t%s: %s\n" % (__cloudpair_s(cloudpair), round(1 / mean_avgrtt, 1))
     logging.info("\n" + bitrate_s + "\n" + avgrtt_s)
 
 
 def __prepare_data():
-    results = load_history()
-    if not results:
+    results = load_columns()
+    if not len(results):
         raise ValueError(
             "No results in %s; maybe set another value for %s env variable"
             % (results_dir(), perftest_resultsdir_envvar)
         )
     len_intra_and_interzone = len(results)
     # Eliminate intra-zone tests
-    results = list(
-        filter(
-            lambda d: (
-                (d["from_cloud"], d["from_region"]) != (d["to_cloud"], d["to_region"])
-            ),
-            results,
-        )
-    )
-    if not results:
+    results = results.select(~results.intra_region())
+    if not len(results):
         raise ValueError("No inter-zone results available")
     if len(results) < len_intra_and_interzone:
         logging.info(
-            "Removed %d intrazone results", len(results) < len_intra_and_interzone
+            "Removed %d intrazone results", len_intra_and_interzone - len(results)
         )
-    for result in results:
-        result["distance"] = interregion_distance(
-            get_region((result["from_cloud"]), result["from_region"]),
-            get_region((result["to_cloud"]), result["to_region"]),
-        )
-    results.sort(key=lambda d: d["distance"])
-    clouddata: dict[Optional[tuple[Cloud, Cloud]], dict[str, list]] = {
+    results = results.select(np.argsort(results.distance, kind="stable"))
+    clouddata: dict[Optional[tuple[Cloud, Cloud]], dict[str, np.ndarray]] = {
         None: __statistics(results)
     }
     s = ""
@@ -108,11 +91,7 @@ def __prepare_data():
 
     cross_prod.sort(key=homogeneous_first)
     for (from_cloud, to_cloud) in cross_prod:
-        cloudpair_results = [
-            r
-            for r in results
-            if (from_cloud.name, to_cloud.name) == (r["from_cloud"], r["to_cloud"])
-        ]
+        cloudpair_results = results.select(results.cloud_pair(from_cloud, to_cloud))
         s += "\t%s,%s has %d results\n" % (
             from_cloud,
             to_cloud,
@@ -125,7 +104,7 @@ def __prepare_data():
 
 
 def __plot_figures(
-    data_by_cloudpair: dict[Optional[tuple[Cloud, Cloud]], dict[str, list]]
+    data_by_cloudpair: dict[Optional[tuple[Cloud, Cloud]], dict[str, np.ndarray]]
 ):
     datetime_s = process_starttime().strftime("%Y-%m-%dT%H-%M-%SZ")
     subdir = os.path.abspath(f"{results_dir()}/charts/{datetime_s}")
@@ -154,7 +133,7 @@ def __plot_figure(
         clouddata[cloudpair][k] for k in ["distance", "avgrtt", "bitrate_Bps"]
     ]
 
-    if not dist:  # No data
+    if not len(dist):  # No data
         return
 
     _fig, base_ax = plt.subplots()
@@ -198,7 +177,9 @@ class EmptyDataset(Exception):
 
 
 def __multiplot_figure(
-    rtt_ax, bitrate_ax, clouddata: dict[Optional[tuple[Cloud, Cloud]], dict[str, list]]
+    rtt_ax,
+    bitrate_ax,
+    clouddata: dict[Optional[tuple[Cloud, Cloud]], dict[str, np.ndarray]],
 ):
     cloudpair_strs = []
     plot_linear_rtt_funcs = []
@@ -246,7 +227,7 @@ def __multiplot_figure(
                     clouddata[cloudpair][k]
                     for k in ["distance", "avgrtt", "bitrate_Bps"]
                 ]
-                if not dist:
+                if not len(dist):
                     raise EmptyDataset
                 return __plot_both_series(
                     cloudpair,
@@ -340,9 +321,9 @@ def plot_legends(bitrate_ax, bitrate_lines, rtt_ax, rtt_lines, cloudpair_strs):
 
 def __plot_both_series(
     cloudpair: tuple[Cloud, Cloud],
-    dist: list,
-    rtt: list,
-    bitrate: list,
+    dist: np.ndarray,
+    rtt: np.ndarray,
+    bitrate: np.ndarray,
     rtt_ax,
     bitrate_ax,
     multiplot: bool,
@@ -412,8 +393,8 @@ def __singleplot_figure(bitrate, bitrate_ax, cloudpair, dist, multiplot, rtt, rt
 def __plot_series(
     cloudpair: tuple[Cloud, Cloud],
     series_name: str,
-    x: list,
-    y: list,
+    x: np.ndarray,
+    y: np.ndarray,
     axis,
     color: str,
     unit: str,
@@ -425,7 +406,7 @@ def __plot_series(
     if semilogy:
         axis.set_yscale("log")
         ylabel = f"{unit} (log)"
-        corr, _ = pearsonr(x, [log10(i) for i in y])
+        corr, _ = pearsonr(x, np.log10(y))
     else:
         ylabel = unit
         corr, _ = pearsonr(x, y)
@@ -463,8 +444,8 @@ def __plot_series(
 def __generate_linear_plot_func(
     cloudpair: tuple[Cloud, Cloud],
     ax: Axes,
-    distance: list[float],
-    y: list[float],
+    distance: np.ndarray,
+    y: np.ndarray,
     color: str,
     series_name: str,
     semilogy: bool,
@@ -476,9 +457,6 @@ def __generate_linear_plot_func(
     Unfortunately this results in some complexity as this function object is passed all
     the way up the stack.
     """
-    distance = np.array(distance)
-    y = np.array(y)
-
     if semilogy:
         y = np.log10(y)
 
@@ -1,10 +1,17 @@
+import collections
 import csv
 import logging
 import os.path
 from pathlib import Path
 
 from cloud.clouds import Region, get_region, Cloud
-from history.results import load_history, results_dir
+from history import csv_journal
+from history.results import (
+    succeeded_region_pairs,
+    results_dir,
+    tests_per_region_pair,
+    perftest_resultsdir_envvar,
+)
 from util.utils import process_starttime_iso
 
 
@@ -12,13 +19,36 @@ def __attempted_tests_csv_file():
     return f"{results_dir()}/attempted-tests.csv"
 
 
+def __attempts_index_file():
+    return f"{results_dir()}/attempted-tests-index.json"
+
+
+def __failed_tests_csv_file():
+    return f"{results_dir()}/failed-tests.csv"
+
+
+def __failures_index_file():
+    return f"{results_dir()}/failed-tests-index.json"
+
+
+attempted_tests_header = [
+    "timestamp",
+    "run_id",
+    "from_cloud",
+    "from_region",
+    "to_cloud",
+    "to_region",
+] + [f"{c.name.lower()}_vm" for c in Cloud]
+
+
 def without_already_succeeded(
     region_pairs: list[tuple[Region, Region]]
 ) -> list[tuple[Region, Region]]:
     successful_results = already_succeeded()
-    already_attempted = __results_dict_to_cloudregion_pairs_with_dedup(
-        __already_attempted()
-    )
+    already_attempted = {
+        (get_region(from_cloud, from_region), get_region(to_cloud, to_region))
+        for from_cloud, from_region, to_cloud, to_region in attempts_per_region_pair()
+    }
     old_failures = [p for p in already_attempted if p not in successful_results]
 
     no_redo_success = list(filter(lambda r: r not in successful_results, region_pairs))
@@ -32,21 +62,8 @@ def without_already_succeeded(
     return no_redo_success
 
 
-def already_succeeded() -> set[tuple[Region, Region]]:
-    successful_results = __results_dict_to_cloudregion_pairs_with_dedup(load_history())
-    return successful_results
-
-
-def __results_dict_to_cloudregion_pairs_with_dedup(dicts):
-    return set(
-        [
-            (
-                get_region(d["from_cloud"], d["from_region"]),
-                get_region(d["to_cloud"], d["to_region"]),
-            )
-            for d in dicts
-        ]
-    )
+def already_succeeded() -> frozenset[tuple[Region, Region]]:
+    return succeeded_region_pairs()
 
 
 def write_missing_regions(
@@ -68,7 +85,7 @@ def write_missing_regions(
 
 
 def write_failed_test(run_id: str, src: Region, dst: Region):
-    output_filename = f"{results_dir()}/failed-tests.csv"
+    output_filename = __failed_tests_csv_file()
     write_hdr = not os.path.exists(output_filename)
 
     entry = (
@@ -92,12 +109,13 @@ def write_failed_test(run_id: str, src: Region, dst: Region):
                 + "\n"
             )
         f.write(entry)
+    failures_per_region_pair()  # Bringing the counts up to date
 
 
 def write_attempted_tests(
     run_id: str, region_pairs_about_to_try: list[tuple[Region, Region]], machine_types
 ):
-    attempts: list[dict] = __already_attempted()
+    attempts = []
     for pair in region_pairs_about_to_try:
         d = {
             "timestamp": process_starttime_iso(),
@@ -114,23 +132,73 @@ def write_attempted_tests(
         attempts.append(d)
 
     if attempts:
-        keys = list(attempts[len(attempts) - 1].keys())
         f = __attempted_tests_csv_file()
         if not os.path.exists(f):
             Path(os.path.dirname(f)).mkdir(parents=True, exist_ok=True)
+        csv_journal.append_rows(f, attempts, attempted_tests_header)
+        attempts_per_region_pair()  # Bringing the counts up to date
+
 
-        with open(f, "w") as f:
-            dict_writer = csv.DictWriter(f, keys)
-            dict_writer.writeheader()
-            dict_writer.writerows(attempts)
-
-
-def __already_attempted() -> list[dict]:
-    try:
-        with open(__attempted_tests_csv_file()) as f:
-            reader = csv.reader(f, skipinitialspace=True)
-            header = next(reader)
-            attempts = [dict(zip(header, row)) for row in reader]
-            return attempts
-    except FileNotFoundError:
-        return []
+def attempts_per_region_pair() -> collections.Counter[tuple[str, str, str, str]]:
+    """:return the count of attempts by from_cloud, from_region, to_cloud, to_region.
+    From an index that is brought up to date by reading only the attempts written since it was saved.
+    """
+    return csv_journal.count_rows(
+        __attempted_tests_csv_file(), __attempts_index_file(), __region_pair_of_row
+    )
+
+
+def failures_per_region_pair() -> collections.Counter[tuple[str, str, str, str]]:
+    """:return the count of failed tests by from_cloud, from_region, to_cloud, to_region,
+    kept in an index as for attempts_per_region_pair"""
+    return csv_journal.count_rows(
+        __failed_tests_csv_file(), __failures_index_file(), __region_pair_of_row
+    )
+
+
+def __region_pair_of_row(r: dict[str, str]) -> tuple[str, str, str, str]:
+    return r["from_cloud"], r["from_region"], r["to_cloud"], r["to_region"]
+
+
+def analyze_test_count():
+    """Writes the counts of successes, failures, and attempts per region pair,
+    most successes first, to tests-per-regionpair.csv"""
+    successes = collections.Counter(
+        {
+            (src.cloud.name, src.region_id, dst.cloud.name, dst.region_id): n
+            for (src, dst), n in tests_per_region_pair().items()
+        }
+    )
+    if not successes:
+        logging.info(
+            "No previous results found. You may need to check the %s env variable",
+            perftest_resultsdir_envvar,
+        )
+        return
+    failures = failures_per_region_pair()
+    attempts = attempts_per_region_pair()
+    pairs = sorted(
+        successes.keys() | failures.keys() | attempts.keys(),
+        key=lambda p: -successes[p],
+    )
+
+    # Here and elsewhere, timestamps  are at time of writing file,
+    # so that the same testrun can get different timestamps. To allow identifying
+    # a testrun, could use a timestamp from the begining of the run.
+    # But run_id also gives that
+    test_counts = [
+        {
+            "count": successes[p],
+            "from_cloud": p[0],
+            "from_region": p[1],
+            "to_cloud": p[2],
+            "to_region": p[3],
+            "failures": failures[p],
+            "attempts": attempts[p],
+        }
+        for p in pairs
+    ]
+    with open(results_dir() + "/tests-per-regionpair.csv", "w") as f:
+        dict_writer = csv.DictWriter(f, test_counts[0].keys())
+        dict_writer.writeheader()
+        dict_writer.writerows(test_counts)
@@ -0,0 +1,167 @@
+"""The results history as NumPy columns, for analytics.
+
+Bitrate, RTT and distance are float arrays. Clouds, regions and run IDs are integer
+codes, indexes into arrays of their values, so that results can be selected with
+boolean masks. The columns are saved in results-columns.npz beside results.csv,
+and rebuilt only when results.csv, or locations.csv that distances come from, changes.
+"""
+
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+
+from cloud.clouds import (
+    Cloud,
+    Region,
+    get_region,
+    interregion_distances,
+    locations_hash,
+)
+from history.results import iter_history, results_dir, results_file_stat
+from util.utils import Timer
+
+# Cloud codes are indexes into clouds
+clouds = np.array([c.name for c in Cloud])
+cloud_codes = {c: i for i, c in enumerate(Cloud)}
+
+# One element per result
+per_result_columns = [
+    "bitrate_Bps",
+    "avgrtt",
+    "distance",
+    "from_cloud",
+    "to_cloud",
+    "from_region",
+    "to_region",
+    "run_id",
+]
+
+
+class HistoryColumns:
+    """Each of per_result_columns is an array with one element per result.
+    Region codes are indexes into regions, with values like "GCP.us-east1",
+    and run ID codes are indexes into run_ids."""
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.bitrate_Bps = arrays["bitrate_Bps"]
+        self.avgrtt = arrays["avgrtt"]
+        self.distance = arrays["distance"]
+        self.from_cloud = arrays["from_cloud"]
+        self.to_cloud = arrays["to_cloud"]
+        self.from_region = arrays["from_region"]
+        self.to_region = arrays["to_region"]
+        self.run_id = arrays["run_id"]
+        self.regions = arrays["regions"]
+        self.run_ids = arrays["run_ids"]
+
+    def __len__(self):
+        return len(self.bitrate_Bps)
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        return {
+            c: getattr(self, c) for c in per_result_columns + ["regions", "run_ids"]
+        }
+
+    def select(self, selector: np.ndarray) -> "HistoryColumns":
+        """:param selector: a boolean mask, or indexes, as for a NumPy array
+        :return the selected results, with the same codes"""
+        return HistoryColumns(
+            self.arrays() | {c: getattr(self, c)[selector] for c in per_result_columns}
+        )
+
+    def cloud_pair(self, from_cloud: Cloud, to_cloud: Cloud) -> np.ndarray:
+        """:return a mask of the results from one cloud to another"""
+        return (self.from_cloud == cloud_codes[from_cloud]) & (
+            self.to_cloud == cloud_codes[to_cloud]
+        )
+
+    def intra_region(self) -> np.ndarray:
+        """:return a mask of the results within one region"""
+        return self.from_region == self.to_region
+
+    def region(self, code: int) -> Region:
+        return get_region(*str(self.regions[code]).split(".", 1))
+
+
+def load_columns() -> HistoryColumns:
+    """:return the columns for the results, from the saved ones if neither results.csv
+    nor locations.csv has changed since they were saved"""
+    stat = results_file_stat()
+    locations_hash_ = locations_hash()
+    columns = __load_saved(stat, locations_hash_)
+    if columns is None:
+        with Timer("Building columns of results"):
+            columns = __build()
+        if stat is not None:
+            __save(columns, stat, locations_hash_)
+    return columns
+
+
+def __columns_file():
+    return f"{results_dir()}/results-columns.npz"
+
+
+def __load_saved(
+    stat: Optional[tuple[int, int]], locations_hash_: str
+) -> Optional[HistoryColumns]:
+    if stat is None:
+        return None
+    try:
+        with np.load(__columns_file()) as saved:
+            if (
+                tuple(saved["source_stat"]) != stat
+                or str(saved["locations_hash"]) != locations_hash_
+            ):
+                return None
+            return HistoryColumns({k: saved[k] for k in saved.files})
+    except (FileNotFoundError, KeyError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logging.warning("Ignoring unreadable %s: %s", __columns_file(), e)
+        return None
+
+
+def __save(columns: HistoryColumns, stat: tuple[int, int], locations_hash_: str):
+    # Written to a new file that then replaces the old one, so that readers see one or the other
+    tmp = __columns_file() + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(
+            f,
+            source_stat=np.array(stat, dtype=np.int64),
+            locations_hash=locations_hash_,
+            **columns.arrays(),
+        )
+    os.replace(tmp, __columns_file())
+
+
+def __build() -> HistoryColumns:
+    region_codes: dict[Region, int] = {}
+    run_id_codes: dict[str, int] = {}
+    lists = {c: [] for c in per_result_columns if c != "distance"}
+    src_idxs, dst_idxs = [], []
+    for r in iter_history():
+        src_idxs.append(r.src.idx)
+        dst_idxs.append(r.dst.idx)
+        lists["bitrate_Bps"].append(r.bitrate_Bps)
+        lists["avgrtt"].append(r.avgrtt)
+        lists["from_cloud"].append(cloud_codes[r.src.cloud])
+        lists["to_cloud"].append(cloud_codes[r.dst.cloud])
+        lists["from_region"].append(region_codes.setdefault(r.src, len(region_codes)))
+        lists["to_region"].append(region_codes.setdefault(r.dst, len(region_codes)))
+        lists["run_id"].append(run_id_codes.setdefault(r.run_id, len(run_id_codes)))
+
+    float_columns = ["bitrate_Bps", "avgrtt"]
+    return HistoryColumns(
+        {
+            c: np.array(v, dtype=np.float64 if c in float_columns else np.int32)
+            for c, v in lists.items()
+        }
+        | {
+            "distance": interregion_distances(
+                np.array(src_idxs, dtype=np.intp), np.array(dst_idxs, dtype=np.intp)
+            ),
+            "regions": np.array([repr(r) for r in region_codes], dtype=str),
+            "run_ids": np.array(list(run_id_codes), dtype=str),
+        }
+    )
@@ -0,0 +1,222 @@
+"""CSV files that are only appended to, possibly by several processes at once.
+
+When rows with new columns are appended, a new header row is appended before them,
+with the columns of the header before plus the new ones. A row whose first field is the
+name of the first column is such a header; rows before it have "" for the new columns.
+A row partly written before a crash is cut off by the next append; until then,
+it is not read, as neither is a row being appended.
+Only compact() rewrites a file, so that it has one header.
+"""
+
+import collections
+import csv
+import fcntl
+import io
+import json
+import logging
+import mmap
+import os
+import threading
+from typing import Optional, Iterator, Callable
+
+
+def append_rows(path: str, rows: list[dict], header: Optional[list[str]] = None):
+    """Appends the rows, and syncs to disk so that they survive a crash.
+    :param header: the columns for a new file, by default those of the first row
+    """
+    if not rows:
+        return
+    with open(path, "a") as f:
+        # Other processes append to the same file only between our reading its header and writing
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            # A row partly written before a crash is cut off, rather than kept with a cut-short value
+            end = __end_of_last_line(path)
+            if end < f.tell():
+                logging.warning("Cutting off a partly written row in %s", path)
+                f.truncate(end)
+            last_header = __last_header(path)
+            buf = io.StringIO()
+            if last_header is None:
+                columns = list(header or rows[0].keys())
+                new_columns = [k for r in rows for k in r if k not in columns]
+                columns += list(dict.fromkeys(new_columns))
+                write_header = True
+            else:
+                new_columns = [k for r in rows for k in r if k not in last_header]
+                columns = last_header + list(dict.fromkeys(new_columns))
+                write_header = bool(new_columns)
+                if write_header:
+                    logging.info("Adding columns %s in %s", new_columns, path)
+            dict_writer = csv.DictWriter(buf, columns)
+            if write_header:
+                dict_writer.writeheader()
+            dict_writer.writerows(rows)
+            # In one write, so that readers that do not lock see whole rows
+            f.write(buf.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_rows(
+    path: str, offset: int = 0
+) -> tuple[list[str], list[dict[str, str]], int]:
+    """:param offset: where to start reading, as returned from an earlier call
+    :return all columns, the rows with all columns, and the offset after the last whole row;
+    or no columns and rows if the file does not exist or is empty
+    """
+    try:
+        with open(path, "rb") as f:
+            header = __header_at(f, offset)
+            if header is None:
+                return [], [], 0
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], [], 0
+
+    # A row being appended by another process is read next time
+    end = data.rfind(b"\n") + 1
+    reader = csv.reader(
+        io.StringIO(data[:end].decode(), newline=""), skipinitialspace=True
+    )
+    columns = list(header)
+    rows = []
+    for header, row in __rows_with_headers(reader, header):
+        columns += [c for c in header if c not in columns]
+        rows.append(dict(zip(header, row)))
+    return columns, [dict.fromkeys(columns, "") | r for r in rows], offset + end
+
+
+def iter_rows(path: str) -> Iterator[dict[str, str]]:
+    """Streams the rows, each with the columns of the header in effect for it,
+    without reading the whole file at once. As for read_rows, a row being appended is not read.
+    """
+    try:
+        with open(path, "rb") as f:
+            reader = csv.reader(
+                __whole_lines(f, __end_of_last_line(path)), skipinitialspace=True
+            )
+            header = next(reader, None)
+            if not header:
+                return
+            for header, row in __rows_with_headers(reader, header):
+                yield dict(zip(header, row))
+    except FileNotFoundError:
+        return
+
+
+def __whole_lines(f, end: int) -> Iterator[str]:
+    """:return the lines of the binary file up to the offset end"""
+    read = 0
+    for line in f:
+        read += len(line)
+        if read > end:
+            return
+        yield line.decode()
+
+
+def __rows_with_headers(
+    reader: Iterator[list[str]], header: list[str]
+) -> Iterator[tuple[list[str], list[str]]]:
+    """:return each row, with the header in effect for it"""
+    first_column = header[0]
+    for row in reader:
+        if not row:
+            continue
+        if row[0] == first_column:
+            header = row
+        else:
+            yield header, row
+
+
+def count_rows(
+    path: str, index_path: str, key: Callable[[dict[str, str]], Optional[tuple]]
+) -> collections.Counter[tuple]:
+    """:param index_path: where the counts are kept, with the offset up to which they were counted
+    :param key: what to count a row under, or None to skip it
+    :return the count of rows by key. From the index, brought up to date by reading
+    only the rows written since it was saved; counted anew if the file was replaced or cut.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return collections.Counter()
+
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        index = None
+    if not index or index["journal_id"] != st.st_ino or index["offset"] > st.st_size:
+        index = {"journal_id": st.st_ino, "offset": 0, "counts": []}
+
+    counts = collections.Counter({tuple(c[:-1]): c[-1] for c in index["counts"]})
+    _, rows, offset = read_rows(path, index["offset"])
+    if offset != index["offset"]:
+        for r in rows:
+            k = key(r)
+            if k is not None:
+                counts[k] += 1
+        index |= {
+            "offset": offset,
+            "counts": [list(k) + [n] for k, n in counts.items()],
+        }
+        # Replacing, so that a concurrent reader sees the old or the new index
+        tmp = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, index_path)
+    return counts
+
+
+def compact(path: str) -> int:
+    """Rewrites the file with one header, for all columns.
+    Written to a new file that then replaces the old one, so that a crash leaves one or the other.
+    :return the number of rows
+    """
+    columns, rows, _ = read_rows(path)
+    if not columns:
+        return 0
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        dict_writer = csv.DictWriter(f, columns)
+        dict_writer.writeheader()
+        dict_writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(rows)
+
+
+def __last_header(path: str) -> Optional[list[str]]:
+    with open(path, "rb") as f:
+        return __header_at(f, os.fstat(f.fileno()).st_size)
+
+
+def __header_at(f, offset: int) -> Optional[list[str]]:
+    """:return the header for rows at this offset, or None if the file has none"""
+    f.seek(0)
+    first_line = f.readline()
+    if not first_line.strip():
+        return None
+    if offset <= len(first_line):
+        line = first_line
+    else:
+        first_column = first_line.split(b",")[0]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = m.rfind(b"\n" + first_column + b",", 0, offset) + 1
+            end = m.find(b"\n", start)
+            line = m[start : end if end >= 0 else len(m)]
+    return next(csv.reader([line.decode()], skipinitialspace=True))
+
+
+def __end_of_last_line(path: str) -> int:
+    """:return the offset after the last newline, 0 if there is none"""
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return m.rfind(b"\n") + 1
@@ -0,0 +1,83 @@
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+from cloud.clouds import Region
+from history.results import append_results
+
+
+class ResultWriter:
+    """Appends results to results.csv from a thread of its own, so that tests only queue them.
+
+    Results queued within group_interval_s of the first one in a group are written
+    together, with one fsync, so that tests finishing at about the same time do not each
+    wait for the disk. Results are in results.csv, for querying, soon after being queued,
+    rather than only when the batch ends.
+    """
+
+    def __init__(
+        self,
+        group_interval_s: float = 1.0,
+        write_attempts: int = 3,
+        retry_delay_s: float = 1.0,
+    ):
+        """:param retry_delay_s: the delay before trying a failed write again,
+        multiplied by the number of attempts so far"""
+        self.__group_interval_s = group_interval_s
+        self.__write_attempts = write_attempts
+        self.__retry_delay_s = retry_delay_s
+        # None asks the thread to stop, after writing what was queued before it
+        self.__queue: queue.Queue[Optional[tuple[Region, Region, dict]]] = queue.Queue()
+        self.__written = 0
+        self.__unwritten: list[tuple[Region, Region]] = []
+        self.__thread = threading.Thread(
+            target=self.__run, name="Result-writer", daemon=True
+        )
+        self.__thread.start()
+
+    def write(self, src: Region, dst: Region, result_j: dict):
+        """Queues the result of the test from src to dst, in the form of Measurement.result_json"""
+        self.__queue.put((src, dst, result_j))
+
+    def close(self) -> list[tuple[Region, Region]]:
+        """Writes the results queued so far, and stops the thread
+        :return the tests whose results could not be written, even when tried again
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+        logging.info("Wrote %d results", self.__written)
+        return self.__unwritten
+
+    def __run(self):
+        stopping = False
+        while not stopping:
+            group = [self.__queue.get()]
+            deadline = time.time() + self.__group_interval_s
+            while group[-1] is not None and (wait_s := deadline - time.time()) > 0:
+                try:
+                    group.append(self.__queue.get(timeout=wait_s))
+                except queue.Empty:
+                    break
+            stopping = group[-1] is None
+            self.__append([t for t in group if t is not None])
+
+    def __append(self, tests: list[tuple[Region, Region, dict]]):
+        for attempt in range(1, self.__write_attempts + 1):
+            try:
+                append_results([result_j for _, _, result_j in tests])
+            except Exception as e:
+                logging.exception(e)
+                logging.error(
+                    "Could not write %d results, attempt %d of %d",
+                    len(tests),
+                    attempt,
+                    self.__write_attempts,
+                )
+                if attempt < self.__write_attempts:
+                    time.sleep(self.__retry_delay_s * attempt)
+            else:
+                self.__written += len(tests)
+                return
+        self.__unwritten += [(src, dst) for src, dst, _ in tests]
@@ -1,17 +1,20 @@
 import collections
-import csv
-import json
 import logging
 import os
-import shutil
+import sqlite3
+import sys
+import threading
+from contextlib import closing, nullcontext
 from functools import cache
-from pathlib import Path
-from typing import Optional
+from typing import Optional, Any, Callable, NamedTuple, Iterator, Iterable
 
-from cloud.clouds import Region
+from cloud.clouds import Region, get_region
+from history import results_db, csv_journal
 from util.utils import set_cwd, init_logger
 
 perftest_resultsdir_envvar = "PERFTEST_RESULTSDIR"
+# If set, results are also indexed in a SQLite database next to results.csv, for faster queries
+results_db_envvar = "PERFTEST_RESULTS_DB"
 
 init_logger()
 
@@ -29,33 +32,10 @@ def results_dir():
     return ret
 
 
-def __results_dir_for_run(run_id):
-    return f"./result-files-one-run/results-{run_id}"
-
-
 def __results_file():
     return f"{results_dir()}/results.csv"
 
 
-def write_results_for_run(
-    result_j, run_id: str, src_region_: Region, dst_region_: Region
-):
-    res_dir_for_run = __results_dir_for_run(run_id)
-    path = Path(res_dir_for_run)
-
-    path.mkdir(parents=True, exist_ok=True)
-    results_for_one_run_file = (
-        f"{res_dir_for_run}/results-{src_region_}-to-{dst_region_}.json"
-    )
-    # We write separate files for each test to avoid race conditions, since tests happen in parallel.
-    with open(
-        results_for_one_run_file,
-        "w",
-    ) as f:
-        json.dump(result_j, f)
-        logging.info("Wrote %s", results_for_one_run_file)
-
-
 def __parse_nums_from_results(r) -> Optional[dict[str, float]]:
     ret = {}
     for k, v in r.items():
@@ -79,129 +59,230 @@ def __parse_nums_from_results(r) -> Optional[dict[str, float]]:
 
 
 def load_history() -> list[dict]:
-    try:
+    """:return the results, the same list until results.csv changes, so that
+    repeated calls do not each go through all of them; callers that modify it,
+    or its results, must modify copies"""
+    return __cached("history", __load_history)
+
+
+def __load_history() -> list[dict]:
+    if use_results_db():
+        with closing(__connect_db()) as conn:
+            return results_db.load_all(conn)
+    else:
+        return __load_history_csv()[1]
+
+
+# Name to results file state and the value computed from it
+__history_cache: dict[str, tuple[tuple, Any]] = {}
+# Results are written, and the cache invalidated, from the thread of ResultWriter
+__history_cache_lock = threading.Lock()
+
+
+def __cached(name: str, compute: Callable[[], Any]) -> Any:
+    """:return the value from the last call to compute, unless the results file changed since"""
+    file_state = (use_results_db(), results_file_stat())
+    with __history_cache_lock:
+        cached = __history_cache.get(name)
+    if cached and cached[0] == file_state:
+        return cached[1]
+    # Not holding the lock, as compute may call this. Stored under the file state from
+    # before computing, so that results written meanwhile are taken next time.
+    value = compute()
+    with __history_cache_lock:
+        __history_cache[name] = (file_state, value)
+    return value
 
-        with open(__results_file()) as f1:
-            contents = f1.read()
-            contents = contents.strip()
-            if not contents:
-                return []  # deal with empty file
-        with open(__results_file()) as f:
-
-            reader = csv.reader(f, skipinitialspace=True)
-            header = next(reader)
-            results = [dict(zip(header, row)) for row in reader]
-            results = [__parse_nums_from_results(r) for r in results]
-            results = [r for r in results if r is not None]
-            return results
+
+def results_file_stat() -> Optional[tuple[int, int]]:
+    """:return the modification time in ns and the size of the results file,
+    which change when results are written; or None if there is no file"""
+    try:
+        stat = os.stat(__results_file())
+        return stat.st_mtime_ns, stat.st_size
     except FileNotFoundError:
-        return []
-
-
-def __count_tests_per_region_pair(
-    ascending: bool, region_pairs: list[tuple[str, str, str, str]]
-) -> list[dict[str, int]]:
-    tests_per_regionpair = collections.Counter(region_pairs)
-    items = tests_per_regionpair.items()
-    multiplier = 1 if ascending else -1
-    items = sorted(items, key=lambda i: multiplier * i[1])
-    assert not items or len(items[0]) == 2 and type(items[0][1]) == int, items[0]
-
-    # Here and elsewhere, timestamps  are at time of writing file,
-    # so that the same testrun can get different timestamps. To allow identifying
-    # a testrun, could use a timestamp from the begining of the run.
-    # But run_id also gives that
-    dicts = [
+        return None
+
+
+def invalidate_history_cache():
+    """For when results are written; needed only if the file's modification time
+    and size could both be unchanged by writing it."""
+    with __history_cache_lock:
+        __history_cache.clear()
+
+
+def __load_history_csv() -> tuple[list[str], list[dict]]:
+    """:return the header and the results"""
+    header, results = __read_results_csv()
+    results = [__parse_nums_from_results(r) for r in results]
+    results = [r for r in results if r is not None]
+    return header, results
+
+
+def __read_results_csv() -> tuple[list[str], list[dict[str, str]]]:
+    """:return all columns, and the rows, unparsed"""
+    columns, rows, _ = csv_journal.read_rows(__results_file())
+    return columns, rows
+
+
+def compact_results():
+    """Rewrites the results file with one header, for all columns."""
+    count = csv_journal.compact(__results_file())
+    invalidate_history_cache()
+    logging.info("Compacted %d results in %s", count, __results_file())
+
+
+def use_results_db() -> bool:
+    return os.environ.get(results_db_envvar, "") not in ["", "0", "false"]
+
+
+def __connect_db() -> sqlite3.Connection:
+    return results_db.connect(
+        f"{results_dir()}/results.db", __results_file(), __load_history_csv
+    )
+
+
+def has_succeeded(src: Region, dst: Region) -> bool:
+    """:return whether there is a result for this test"""
+    return (src, dst) in succeeded_region_pairs()
+
+
+def succeeded_region_pairs() -> frozenset[tuple[Region, Region]]:
+    return __cached(
+        "succeeded_region_pairs", lambda: frozenset(tests_per_region_pair())
+    )
+
+
+def tests_per_region_pair() -> collections.Counter[tuple[Region, Region]]:
+    """:return the count of results by source and destination;
+    shared between callers, so not to be modified"""
+    return __cached("tests_per_region_pair", __tests_per_region_pair)
+
+
+def __tests_per_region_pair() -> collections.Counter[tuple[Region, Region]]:
+    counts = csv_journal.count_rows(
+        __results_file(), __results_counts_file(), __region_pair_of_result
+    )
+    return collections.Counter(
         {
-            "count": count,
-            "from_cloud": pair[0],
-            "from_region": pair[1],
-            "to_cloud": pair[2],
-            "to_region": pair[3],
+            (get_region(fc, fr), get_region(tc, tr)): n
+            for (fc, fr, tc, tr), n in counts.items()
         }
-        for pair, count in items
-    ]
-    return dicts
-
-
-def analyze_test_count():
-    def record_test_count(region_pairs: list[tuple[str, str, str, str]], filename: str):
-        test_counts = __count_tests_per_region_pair(False, region_pairs)
-        if not test_counts:
-            logging.info(
-                "No results found for %s. Either there are none, or you may need to check the %s env variable",
-                filename,
-                perftest_resultsdir_envvar,
-            )
-        else:
-            with open(results_dir() + "/" + filename, "w") as f:
-                dict_writer = csv.DictWriter(f, test_counts[0].keys())
-                dict_writer.writeheader()
-                dict_writer.writerows(test_counts)
-
-    dicts = load_history()
-    if not dicts:
-        logging.info(
-            "No previous results found. You may need to check the %s env variable",
-            perftest_resultsdir_envvar,
-        )
-    else:
-        by_test_pairs = [
-            (d["from_cloud"], d["from_region"], d["to_cloud"], d["to_region"])
-            for d in dicts
-        ]
-
-        record_test_count(by_test_pairs, "tests-per-regionpair.csv")
-
-
-def combine_results(run_id: str):
-    def json_to_flattened_dict(json_s: str) -> dict:
-        ret = {}
-        j = json.loads(json_s)
-        for k, v in j.items():
-            if isinstance(v, dict):
-                for k2, v2 in v.items():
-                    assert isinstance(v2, (str, int, float, bool))
-                    ret[f"{k}_{k2}"] = v2
-            else:
-                ret[k] = v
-        return ret
-
-    if not os.path.exists(__results_dir_for_run(run_id)):
-        logging.warning("No results at %s", __results_dir_for_run(run_id))
-        return
+    )
+
+
+def __results_counts_file():
+    return f"{results_dir()}/results-counts-index.json"
+
+
+def __region_pair_of_result(r: dict[str, str]) -> Optional[tuple[str, str, str, str]]:
+    """:return the pair to count the result under, or None if it is skipped as in iter_history"""
+    if not r.get("bitrate_Bps") or not r.get("avgrtt"):
+        return None
+    return r["from_cloud"], r["from_region"], r["to_cloud"], r["to_region"]
+
+
+def tests_per_region() -> collections.Counter[Region]:
+    """:return the count of results with a region as source or destination;
+    shared between callers, so not to be modified"""
+    return __cached("tests_per_region", __tests_per_region)
+
+
+def __tests_per_region() -> collections.Counter[Region]:
+    counts = collections.Counter()
+    for (src, dst), n in tests_per_region_pair().items():
+        counts[src] += n
+        counts[dst] += n
+    return counts
+
+
+class TestResult(NamedTuple):
+    """One result from the history, with its regions resolved and its numbers parsed"""
+
+    __test__ = False  # Not for pytest to collect
+
+    timestamp: str
+    run_id: str
+    src: Region
+    dst: Region
+    bitrate_Bps: float
+    avgrtt: float
+    gcp_vm: str
+    aws_vm: str
+
+
+def iter_history() -> Iterator[TestResult]:
+    """Streams the results, without holding them all in memory.
+    Results without a bitrate or RTT are skipped, as in load_history."""
+    if use_results_db():
+        with closing(__connect_db()) as conn:
+            yield from __to_test_results(results_db.iter_all(conn))
     else:
-        dicts = load_history()
-        filenames = os.listdir(__results_dir_for_run(run_id))
-        logging.info(
-            f"Adding %d new results for %s into %d existing results in %s",
-            len(filenames),
-            run_id,
-            len(dicts),
-            __results_file(),
+        yield from __to_test_results(csv_journal.iter_rows(__results_file()))
+
+
+def __to_test_results(rows: Iterable[dict]) -> Iterator[TestResult]:
+    for r in rows:
+        if r.get("bitrate_Bps") in ["", None] or r.get("avgrtt") in ["", None]:
+            continue
+        yield TestResult(
+            r["timestamp"],
+            r["run_id"],
+            get_region(r["from_cloud"], r["from_region"]),
+            get_region(r["to_cloud"], r["to_region"]),
+            float(r["bitrate_Bps"]),
+            float(r["avgrtt"]),
+            r.get("gcp_vm", ""),
+            r.get("aws_vm", ""),
         )
-        if filenames:
-            keys = None
-            for fname in filenames:
-                with open(f"{__results_dir_for_run(run_id)}/{fname}") as infile:
-                    one_json = infile.read()
-                    d = json_to_flattened_dict(one_json)
-                    if not keys:
-                        keys = list(d.keys())
-                    else:
-                        assert set(d.keys()) == set(
-                            keys
-                        ), f"All keys should be the same in the result-files-one-run jsons {set(d.keys())}!={set(keys)}"
-                    dicts.append(d)
-
-            with open(__results_file(), "w") as f:
-                dict_writer = csv.DictWriter(f, keys)
-                dict_writer.writeheader()
-                dict_writer.writerows(dicts)
-
-    shutil.rmtree(__results_dir_for_run(run_id))
+
+
+def append_results(results_j: list[dict]):
+    """Appends results, each in the form of Measurement.result_json, to results.csv,
+    and to its index if there is one.
+    Raises only if the results were not written to results.csv, so that writing them
+    can be tried again; failing to update what is derived from it is only logged,
+    since that is rebuilt from results.csv."""
+    new_dicts = [__flattened(j) for j in results_j]
+    if not new_dicts:
+        return
+    logging.info("Adding %d new results to %s", len(new_dicts), __results_file())
+    # Connecting before writing, when the database is in step with the CSV
+    with closing(__connect_db()) if use_results_db() else nullcontext() as conn:
+        csv_journal.append_rows(__results_file(), new_dicts)
+        try:
+            if conn:
+                parsed = [__parse_nums_from_results(d) for d in new_dicts]
+                results_db.add_results(
+                    conn, __results_file(), [r for r in parsed if r is not None]
+                )
+            invalidate_history_cache()
+            tests_per_region_pair()  # Bringing the counts up to date
+        except Exception as e:
+            logging.exception(e)
+            logging.error(
+                "Wrote results, but could not update what is derived from them"
+            )
+
+
+def __flattened(result_j: dict) -> dict:
+    """:return the result with nested keys joined, as in from_cloud"""
+    ret = {}
+    for k, v in result_j.items():
+        if isinstance(v, dict):
+            for k2, v2 in v.items():
+                assert isinstance(v2, (str, int, float, bool))
+                ret[f"{k}_{k2}"] = v2
+        else:
+            ret[k] = v
+    return ret
 
 
 if __name__ == "__main__":
     set_cwd()
-    analyze_test_count()
+    if "--compact" in sys.argv[1:]:
+        compact_results()
+    else:
+        from history.attempted import analyze_test_count
+
+        analyze_test_count()
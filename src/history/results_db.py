@@ -0,0 +1,130 @@
+import logging
+import os
+import sqlite3
+from typing import Callable, Iterator
+
+from util.utils import Timer
+
+numeric_columns = ["distance", "bitrate_Bps", "avgrtt"]
+pair_columns = ["from_cloud", "from_region", "to_cloud", "to_region"]
+
+
+def connect(
+    db_path: str,
+    csv_path: str,
+    load_csv: Callable[[], tuple[list[str], list[dict]]],
+) -> sqlite3.Connection:
+    """Opens the database of results, an index of the results CSV.
+    If the CSV changed since the database was built from it, the database is rebuilt.
+    :param load_csv: gives the header and rows of the CSV
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS source (csv_mtime_ns INTEGER, csv_size INTEGER)"
+        )
+        if __source_stat(conn) != __csv_stat(csv_path):
+            with Timer("Indexing results in SQLite"):
+                header, rows = load_csv()
+                __rebuild(conn, header, rows)
+                __set_source_stat(conn, csv_path)
+            conn.commit()
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def add_results(conn: sqlite3.Connection, csv_path: str, rows: list[dict]):
+    """Adds rows that were just added to the CSV, so that the database
+    stays in step with it without being rebuilt."""
+    columns = __columns(conn)
+    if columns is None or any(k not in columns for r in rows for k in r):
+        # Columns changed; the next connection will rebuild from the CSV
+        logging.info("Results have new columns, so will reindex them")
+        return
+    __insert(conn, columns, rows)
+    __set_source_stat(conn, csv_path)
+    conn.commit()
+
+
+def load_all(conn: sqlite3.Connection) -> list[dict]:
+    return list(iter_all(conn))
+
+
+def iter_all(conn: sqlite3.Connection) -> Iterator[dict]:
+    columns = __columns(conn)
+    if not columns:
+        return
+    cursor = conn.execute(
+        f"SELECT {__column_list(columns)} FROM results ORDER BY rowid"
+    )
+    for row in cursor:
+        yield dict(zip(columns, row))
+
+
+def has_succeeded(
+    conn: sqlite3.Connection, from_cloud, from_region, to_cloud, to_region
+) -> bool:
+    if not __columns(conn):
+        return False
+    cursor = conn.execute(
+        "SELECT 1 FROM results WHERE from_cloud=? AND from_region=? AND to_cloud=? AND to_region=? LIMIT 1",
+        (from_cloud, from_region, to_cloud, to_region),
+    )
+    return cursor.fetchone() is not None
+
+
+def __column_list(columns: list[str]) -> str:
+    return ", ".join(f'"{c}"' for c in columns)
+
+
+def __columns(conn: sqlite3.Connection):
+    """:return the columns of the results table, in the order of the CSV, or None if there is none"""
+    cursor = conn.execute("PRAGMA table_info(results)")
+    columns = [row[1] for row in cursor]
+    return columns or None
+
+
+def __rebuild(conn: sqlite3.Connection, header: list[str], rows: list[dict]):
+    conn.execute("DROP TABLE IF EXISTS results")
+    if not header:
+        return
+    column_defs = ", ".join(
+        f'"{c}" {"REAL" if c in numeric_columns else "TEXT"}' for c in header
+    )
+    conn.execute(f"CREATE TABLE results ({column_defs})")
+    __insert(conn, header, rows)
+    if all(c in header for c in pair_columns):
+        conn.execute(
+            f"CREATE INDEX results_by_pair ON results ({__column_list(pair_columns)})"
+        )
+    if all(c in header for c in ["run_id", "timestamp"]):
+        conn.execute('CREATE INDEX results_by_run ON results ("run_id", "timestamp")')
+
+
+def __insert(conn: sqlite3.Connection, columns: list[str], rows: list[dict]):
+    placeholders = ", ".join("?" for _ in columns)
+    conn.executemany(
+        f"INSERT INTO results ({__column_list(columns)}) VALUES ({placeholders})",
+        ([r.get(c, "") for c in columns] for r in rows),
+    )
+
+
+def __csv_stat(csv_path: str):
+    try:
+        stat = os.stat(csv_path)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
+
+
+def __source_stat(conn: sqlite3.Connection):
+    return conn.execute("SELECT csv_mtime_ns, csv_size FROM source").fetchone()
+
+
+def __set_source_stat(conn: sqlite3.Connection, csv_path: str):
+    conn.execute("DELETE FROM source")
+    stat = __csv_stat(csv_path)
+    if stat:
+        conn.execute("INSERT INTO source VALUES (?, ?)", stat)
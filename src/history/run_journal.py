@@ -0,0 +1,163 @@
+"""What each run did, recorded as it happens, so that a run that was killed can be resumed.
+
+Each run has a file of one JSON object per line, each an event:
+the batches planned, each VM launch as it starts and as it ends,
+each test done, each deletion of VMs, and the end of the run.
+Each event is synced to disk before the run goes on, so that the journal
+has every VM that could exist; a line cut short by a crash is ignored.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Union, Iterator
+
+from cloud.clouds import Region, Cloud, get_region
+from history.results import results_dir, succeeded_region_pairs
+
+
+def _journal_file(run_id: str):
+    return f"{results_dir()}/run-journals/{run_id}.jsonl"
+
+
+class RunJournal:
+    def __init__(self, run_id: str):
+        self.__path = _journal_file(run_id)
+        Path(os.path.dirname(self.__path)).mkdir(parents=True, exist_ok=True)
+        with open(self.__path, "ab+") as f:
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # After a line cut short by a crash, when resuming
+
+    def batches_planned(
+        self,
+        first_batch_idx: int,
+        batches: list[list[tuple[Region, Region]]],
+        machine_types: dict[Cloud, str],
+        run_options: dict[str, Union[str, bool, int, float]],
+    ):
+        """:param first_batch_idx: the index of the first of these batches in the run,
+        from which VMs are labeled
+        :param run_options: keyword arguments for running the batches, given again on resuming
+        """
+        self.__record(
+            "batches_planned",
+            first_batch_idx=first_batch_idx,
+            batches=[[[repr(r) for r in p] for p in batch] for batch in batches],
+            machine_types={c.name: t for c, t in machine_types.items()},
+            run_options=run_options,
+        )
+
+    def vm_launching(self, vm_run_id: str, region: Region):
+        self.__record("vm_launching", vm_run_id=vm_run_id, region=repr(region))
+
+    def vm_launched(self, vm_run_id: str, region: Region, vm_info: Optional[dict]):
+        """:param vm_info: None if the launch failed"""
+        self.__record(
+            "vm_launched", vm_run_id=vm_run_id, region=repr(region), vm_info=vm_info
+        )
+
+    def vms_deleted(self, vm_run_id: str, regions: list[Region]):
+        self.__record(
+            "vms_deleted", vm_run_id=vm_run_id, regions=[repr(r) for r in regions]
+        )
+
+    def test_done(self, src: Region, dst: Region, succeeded: bool):
+        self.__record("test_done", src=repr(src), dst=repr(dst), succeeded=succeeded)
+
+    def run_finished(self):
+        self.__record("run_finished")
+
+    def __record(self, event: str, **fields):
+        with open(self.__path, "a") as f:
+            f.write(json.dumps({"event": event} | fields) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class ResumedRun:
+    """The state of a run as recorded in its journal, for resuming it."""
+
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.machine_types: dict[Cloud, str] = {}
+        self.run_options: dict = {}
+        # Batch index in the run to the pairs planned for it, when last planned
+        self.__batches: dict[int, list[tuple[Region, Region]]] = {}
+        self.__next_batch_idx = 0
+        self.__tests_done: dict[tuple[Region, Region], bool] = {}
+        # VMs that may exist: those launched, or whose launch started, and not deleted since.
+        # Where the launch did not finish, there is no information on the VM.
+        self.vms: dict[tuple[Region, str], Optional[dict]] = {}
+        self.finished = False
+
+    def apply(self, e: dict):
+        event = e["event"]
+        if event == "batches_planned":
+            # When resuming, the batches left are planned again, replacing those before
+            self.__batches = {
+                i: [(_region(s), _region(d)) for s, d in batch]
+                for i, batch in enumerate(e["batches"], start=e["first_batch_idx"])
+            }
+            self.__next_batch_idx = e["first_batch_idx"] + len(e["batches"])
+            self.machine_types = {Cloud(c): t for c, t in e["machine_types"].items()}
+            self.run_options = e["run_options"]
+        elif event == "vm_launching":
+            self.vms[(_region(e["region"]), e["vm_run_id"])] = None
+        elif event == "vm_launched":
+            # A failed launch may still have left a VM
+            self.vms[(_region(e["region"]), e["vm_run_id"])] = e["vm_info"]
+        elif event == "vms_deleted":
+            for r in e["regions"]:
+                self.vms.pop((_region(r), e["vm_run_id"]), None)
+        elif event == "test_done":
+            self.__tests_done[(_region(e["src"]), _region(e["dst"]))] = e["succeeded"]
+        elif event == "run_finished":
+            self.finished = True
+        else:
+            logging.warning("Unknown event in run journal: %s", e)
+
+    def next_batch_idx(self) -> int:
+        """:return the index for batches planned from now on, after all those planned before"""
+        return self.__next_batch_idx
+
+    def pending_batches(self) -> list[list[tuple[Region, Region]]]:
+        """:return the batches, without the tests done, and without batches left empty.
+        A test that succeeded counts as done only if its result was written before the run stopped.
+        """
+        succeeded = succeeded_region_pairs()
+        done = {
+            p
+            for p, test_succeeded in self.__tests_done.items()
+            if not test_succeeded or p in succeeded
+        }
+        batches = [
+            [p for p in self.__batches[i] if p not in done]
+            for i in sorted(self.__batches)
+        ]
+        return [b for b in batches if b]
+
+
+def load_run(run_id: str) -> ResumedRun:
+    """:raise ValueError if there is no journal for this run"""
+    if not os.path.exists(_journal_file(run_id)):
+        raise ValueError(f"No journal for run {run_id} at {_journal_file(run_id)}")
+    run = ResumedRun(run_id)
+    for e in _events(run_id):
+        run.apply(e)
+    return run
+
+
+def _events(run_id: str) -> Iterator[dict]:
+    with open(_journal_file(run_id)) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning("Skipping a line cut short by a crash: %s", line)
+
+
+def _region(s: str) -> Region:
+    return get_region(*s.split(".", 1))
@@ -5,7 +5,6 @@ from graph.plot_chart import graph_full_testing_history
 from test_steps import batching
 from util.utils import (
     set_cwd,
-    random_id,
     Timer,
     process_starttime_iso,
     init_logger,
@@ -15,13 +14,10 @@ init_logger()
 
 
 def main():
-    batches, machine_types = batching.setup_batches()
-
-    run_id = random_id()
+    run_id, batches, machine_types, run_options = batching.setup_batches()
     logging.info("Run ID is %s", run_id)
 
-    for batch in batches:
-        batching.batch_setup_test_teardown(run_id, batch, machine_types)
+    batching.run_batches(run_id, batches, machine_types, **run_options)
 
     graph_full_testing_history()
 
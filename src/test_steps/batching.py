@@ -1,12 +1,15 @@
 import argparse
-import collections
+import asyncio
 import itertools
 import logging
 import math
 from itertools import product
-from typing import Union, Callable, Optional
+from typing import Union, Callable, Optional, Any
 
-from cloud.aws_regions_enabled import is_nonenabled_auth_aws_region
+from cloud.aws_regions_enabled import (
+    discover_aws_regions,
+    is_nonenabled_auth_aws_region,
+)
 from cloud.clouds import (
     Cloud,
     Region,
@@ -14,34 +17,211 @@ from cloud.clouds import (
     interregion_distance,
     get_region,
 )
+from cloud.simulated import simulate_clouds
 from history.attempted import (
     without_already_succeeded,
     write_attempted_tests,
     already_succeeded,
 )
-from history.results import load_history
-from test_steps.create_vms import create_vms
-from test_steps.delete_vms import delete_vms
-from test_steps.do_test import do_batch
+from history.results import tests_per_region
+from history.run_journal import RunJournal, ResumedRun, load_run
+from test_steps.do_test import Q, plan_batch, run_batch, RetryPolicy
+from test_steps.scheduling import SCHEDULE_GREEDY, schedules
 from test_steps.utils import unique_regions
-from util.utils import chunks, parse_infinity
+from test_steps.vm_pool import VmPool
+from util.utils import chunks, parse_infinity, Timer, random_id
 
 default_batch_size = math.inf
 default_max_batches = 1
 default_min_distance = 0
 default_max_distance = math.inf
 default_machine_types = "AWS,t3.nano;GCP,e2-small"
+default_schedule = SCHEDULE_GREEDY
+default_max_live_vms = math.inf
+default_test_attempts = 2
+default_retry_backoff_s = 5.0
+
+
+def run_batches(
+    run_id,
+    batches: list[list[tuple[Region, Region]]],
+    machine_types: dict[Cloud, str],
+    schedule: str = default_schedule,
+    pipelined: bool = False,
+    max_live_vms: Union[int, float] = default_max_live_vms,
+    test_attempts: int = default_test_attempts,
+    retry_backoff_s: float = default_retry_backoff_s,
+    resumed: Optional[ResumedRun] = None,
+):
+    """VMs in regions that the next batch also uses are kept for it, rather than deleted and relaunched.
+    VM launches and deletions, and tests, are recorded in the run's journal as they happen.
+    :param resumed: the run as recorded in its journal, when resuming it; its VMs that may
+    still exist are reused or deleted, and VMs launched now are labeled after its batches
+    """
+    journal = RunJournal(run_id)
+    first_batch_idx = resumed.next_batch_idx() if resumed else 0
+    run_options = {
+        "schedule": schedule,
+        "pipelined": pipelined,
+        "max_live_vms": max_live_vms,
+        "test_attempts": test_attempts,
+        "retry_backoff_s": retry_backoff_s,
+    }
+    journal.batches_planned(first_batch_idx, batches, machine_types, run_options)
+    vms_from_before = resumed.vms if resumed else {}
+    run = __pipelined_batches if pipelined and batches else __sequential_batches
+    asyncio.run(
+        run(
+            run_id,
+            batches,
+            machine_types,
+            schedule,
+            RetryPolicy(test_attempts, retry_backoff_s),
+            max_live_vms,
+            journal,
+            first_batch_idx,
+            vms_from_before,
+        )
+    )
+    journal.run_finished()
 
 
 def batch_setup_test_teardown(
-    run_id, region_pairs: list[tuple[Region, Region]], machine_types: dict[Cloud, str]
+    run_id,
+    region_pairs: list[tuple[Region, Region]],
+    machine_types: dict[Cloud, str],
+    schedule: str = default_schedule,
+):
+    run_batches(run_id, [region_pairs], machine_types, schedule)
+
+
+async def __sequential_batches(
+    run_id,
+    batches: list[list[tuple[Region, Region]]],
+    machine_types: dict[Cloud, str],
+    schedule: str,
+    retry_policy: RetryPolicy,
+    max_live_vms: Union[int, float],
+    journal: RunJournal,
+    first_batch_idx: int,
+    vms_from_before: dict[tuple[Region, str], Optional[dict]],
 ):
-    logging.info("Tests in batch: %s", region_pairs)
-    write_attempted_tests(run_id, region_pairs, machine_types)
+    pool = VmPool(run_id, machine_types, max_live_vms, journal)
     # VMs will still be cleaned up if launch or tests fail
-    vm_region_and_address_infos = create_vms(region_pairs, run_id, machine_types)
-    do_batch(run_id, vm_region_and_address_infos)
-    delete_vms(run_id, unique_regions(region_pairs))
+    try:
+        await __reattach(pool, vms_from_before, batches)
+        for i, region_pairs in enumerate(batches):
+            logging.info("Tests in batch: %s", region_pairs)
+            write_attempted_tests(run_id, region_pairs, machine_types)
+            q = plan_batch(region_pairs, schedule, retry_policy)
+            vm_run_id = __vm_run_id(run_id, first_batch_idx + i)
+            launching = asyncio.create_task(
+                __launch_vms_for_tests(q, pool, i, region_pairs, vm_run_id)
+            )
+            try:
+                await run_batch(run_id, q, journal)
+                await launching
+            finally:
+                launching.cancel()
+                await asyncio.gather(launching, return_exceptions=True)
+                if i + 1 < len(batches):
+                    pool.claim(i + 1, unique_regions(batches[i + 1]))
+                await pool.release(i)
+    finally:
+        await pool.release_all()
+
+
+def __vm_run_id(run_id, batch_idx: int) -> str:
+    """Each batch's VMs have their own ID, so that deleting them leaves other batches' VMs"""
+    return f"{run_id}-{batch_idx}"
+
+
+async def __reattach(
+    pool: VmPool,
+    vms_from_before: dict[tuple[Region, str], Optional[dict]],
+    batches: list[list[tuple[Region, Region]]],
+):
+    """Reuses the VMs left from before the run was resumed in the first batch,
+    and deletes those that it does not need."""
+    if not vms_from_before:
+        return
+    await pool.adopt(vms_from_before)
+    if batches:
+        pool.claim(0, unique_regions(batches[0]))
+    await pool.release(None)
+
+
+async def __launch_vms_for_tests(
+    q: Q,
+    pool: VmPool,
+    batch_idx: int,
+    region_pairs: list[tuple[Region, Region]],
+    vm_run_id: str,
+):
+    """Launches VMs, or reuses those from earlier batches, reporting each to the dispatcher
+    as soon as it is up, so that tests start as soon as both their VMs are up."""
+    try:
+        await pool.launch(batch_idx, region_pairs, vm_run_id, on_vm_ready=q.vm_ready)
+    finally:
+        await q.all_vms_launched()
+
+
+async def __pipelined_batches(
+    run_id,
+    batches: list[list[tuple[Region, Region]]],
+    machine_types: dict[Cloud, str],
+    schedule: str,
+    retry_policy: RetryPolicy,
+    max_live_vms: Union[int, float],
+    journal: RunJournal,
+    first_batch_idx: int,
+    vms_from_before: dict[tuple[Region, str], Optional[dict]],
+):
+    """Launches the VMs for each batch while the previous batch is testing,
+    and deletes each batch's VMs while the next batch is testing.
+    Tests of different batches do not overlap, so that a region is still in only one test at a time.
+    """
+    qs = [plan_batch(batch, schedule, retry_policy) for batch in batches]
+    pool = VmPool(run_id, machine_types, max_live_vms, journal)
+    launches: dict[int, asyncio.Task] = {}
+    teardowns: dict[int, asyncio.Task] = {}
+    stopping = False
+
+    async def launch(i: int):
+        logging.info("Tests in batch %d: %s", i, batches[i])
+        write_attempted_tests(run_id, batches[i], machine_types)
+        vm_run_id = __vm_run_id(run_id, first_batch_idx + i)
+        await __launch_vms_for_tests(qs[i], pool, i, batches[i], vm_run_id)
+        # The next batch's VMs launch while this batch is testing
+        if i + 1 < len(batches) and not stopping:
+            launches[i + 1] = asyncio.create_task(launch(i + 1))
+
+    async def teardown(i: int):
+        # Let a cancelled launch kill its scripts before deleting what it created
+        await asyncio.gather(launches[i], return_exceptions=True)
+        await pool.release(i)
+
+    with Timer("Pipelined batches"):
+        try:
+            await __reattach(pool, vms_from_before, batches)
+            launches[0] = asyncio.create_task(launch(0))
+            for i in range(len(batches)):
+                try:
+                    # Tests start as VMs come up, and the next batch's launch
+                    # is started when this batch's launch is done
+                    await run_batch(run_id, qs[i], journal)
+                    await launches[i]
+                finally:
+                    teardowns[i] = asyncio.create_task(teardown(i))
+        finally:
+            # VMs will still be cleaned up if launch or tests fail
+            stopping = True
+            for i, launch_task in list(launches.items()):
+                launch_task.cancel()  # Does nothing if done
+                if i not in teardowns:
+                    teardowns[i] = asyncio.create_task(teardown(i))
+            await asyncio.gather(*teardowns.values(), return_exceptions=True)
+            await pool.release_all()
 
 
 def all_tests_done(
@@ -69,6 +249,7 @@ def __arrange_in_testbatches(
     else:
         regions = get_regions()
 
+        discover_aws_regions(regions)
         regions = [r for r in regions if not is_nonenabled_auth_aws_region(r)]
         regions = __sort_regions(regions, bool(cloudpairs))
         if all_tests_done(regions, cloudpairs):
@@ -118,19 +299,7 @@ def __arrange_in_testbatches(
 def __ascending_freq_keyfunc() -> Callable[[Region], int]:
     """:return a function that will allow sorting in ascending order of freq of appearance
     of a CloudRegion in post runs"""
-    results: list[dict] = load_history()
-    regions_from_results_src = [
-        (get_region(d["from_cloud"], d["from_region"])) for d in results
-    ]
-    regions_from_results_dst = [
-        (get_region(d["to_cloud"], d["to_region"])) for d in results
-    ]
-
-    regions_from_results = collections.Counter(
-        regions_from_results_src + regions_from_results_dst
-    )
-
-    counts = collections.Counter(regions_from_results)
+    counts = tests_per_region()
 
     def key_func(region: Region) -> int:
         return counts[region]
@@ -312,6 +481,72 @@ def __command_line_args():
         "\nYou can specify any and all clouds here. Where unspecified, the default for that cloud is used.",
     )
 
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="\nLaunch the VMs for each batch while the previous batch is testing, "
+        "and delete each batch's VMs while the next batch is testing."
+        "\nTests of different batches still do not run at the same time.",
+    )
+    parser.add_argument(
+        "--max_live_vms",
+        type=int,
+        default=default_max_live_vms,
+        help="\nWith --pipelined, limits the number of VMs alive at once across batches, to limit cost; "
+        "the next batch's VMs are launched only when that fits."
+        f'\nDefault is "{default_max_live_vms}".',
+    )
+    parser.add_argument(
+        "--test_attempts",
+        type=int,
+        default=default_test_attempts,
+        help="\nThe most times a test is tried in a batch, while its VMs are up, before it is recorded as failed. "
+        "A failed test is tried again after the other tests planned, and after a backoff."
+        f'\nDefault is "{default_test_attempts}".',
+    )
+    parser.add_argument(
+        "--retry_backoff_s",
+        type=float,
+        default=default_retry_backoff_s,
+        help="\nSeconds before a failed test can be tried again, doubling with each attempt."
+        f'\nDefault is "{default_retry_backoff_s}".',
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+        help="\nRun ID of a run that was killed, to finish from its journal: "
+        "its VMs that may still exist are reused or deleted, and tests that were done are skipped."
+        "\nIf this is used, the other flags are ignored, except --simulated_clouds and --simulation_time_scale.",
+    )
+    parser.add_argument(
+        "--simulated_clouds",
+        type=str,
+        default="",
+        help="\nComma-separated clouds, e.g. AWS,GCP, to simulate on this machine instead of launching real VMs, "
+        "for testing and benchmarking this system."
+        "\nResults from simulated clouds are written like real results, "
+        "so use a separate results directory (see env variable PERFTEST_RESULTSDIR).",
+    )
+    parser.add_argument(
+        "--simulation_time_scale",
+        type=float,
+        default=1.0,
+        help="\nFactor by which simulated VM launches and tests are sped up (<1) or slowed down (>1)."
+        "\nDefault is 1, taking about as long as in the real clouds.",
+    )
+    parser.add_argument(
+        "--schedule",
+        type=str,
+        choices=schedules,
+        default=default_schedule,
+        help="\nOrder in which tests in a batch are run, given that a region is in only one test at a time."
+        f'\n"{SCHEDULE_GREEDY}" takes tests in the order they were planned. '
+        '\n"rounds" first arranges the tests in rounds of tests that can run in parallel, '
+        "so that fewer tests are left waiting on a busy region at the end of the batch."
+        f'\nDefault is "{default_schedule}".',
+    )
+
     args = parser.parse_args()
 
     if bool(args.region_pairs) and bool(
@@ -344,8 +579,18 @@ def __machine_types_per_cloud(args) -> dict[Cloud, str]:
     return machine_types
 
 
-def setup_batches() -> tuple[list[list[tuple[Region, Region]]], dict[Cloud, str]]:
+def setup_batches() -> tuple[
+    str, list[list[tuple[Region, Region]]], dict[Cloud, str], dict[str, Any]
+]:
+    """:return the run ID, the batches, the machine types, and keyword arguments for run_batches"""
     args = __command_line_args()
+    if args.simulated_clouds:
+        simulate_clouds(
+            [Cloud(c) for c in args.simulated_clouds.split(",")],
+            time_scale=args.simulation_time_scale,
+        )
+    if args.resume:
+        return __resumed_batches(args.resume)
     if args.clouds:
         clouds = [
             (Cloud(p[0]), Cloud(p[1]))
@@ -367,4 +612,29 @@ def setup_batches() -> tuple[list[list[tuple[Region, Region]]], dict[Cloud, str]
         logging.info("No tests to run that did not already succeeed")
         exit(0)
 
-    return batches, __machine_types_per_cloud(args)
+    run_options = {
+        "schedule": args.schedule,
+        "pipelined": args.pipelined,
+        "max_live_vms": parse_infinity(args.max_live_vms),
+        "test_attempts": args.test_attempts,
+        "retry_backoff_s": args.retry_backoff_s,
+    }
+    return random_id(), batches, __machine_types_per_cloud(args), run_options
+
+
+def __resumed_batches(
+    run_id: str,
+) -> tuple[str, list[list[tuple[Region, Region]]], dict[Cloud, str], dict[str, Any]]:
+    resumed = load_run(run_id)
+    if resumed.finished:
+        logging.info("Run %s already finished", run_id)
+        exit(0)
+    batches = resumed.pending_batches()
+    logging.info(
+        "Resuming run %s with %d tests left, and %d VMs that may still exist",
+        run_id,
+        sum(len(b) for b in batches),
+        len(resumed.vms),
+    )
+    run_options = resumed.run_options | {"resumed": resumed}
+    return run_id, batches, resumed.machine_types, run_options
@@ -1,41 +1,31 @@
+import asyncio
 import logging
-import threading
-from typing import Optional
+import time
+from typing import Optional, Callable, Awaitable, Union
 
 from cloud.clouds import Region, Cloud
+from cloud.providers import provider
 from history.attempted import write_missing_regions, write_failed_test
-from test_steps.utils import env_for_singlecloud_subprocess, unique_regions
-from util.subprocesses import run_subprocess
-from util.utils import dedup, thread_timeout, Timer
+from test_steps.utils import unique_regions
+from util.utils import Timer
 
 
-def __create_vm(
-    run_id_: str,
-    cloud_region_: Region,
-    vm_region_and_address_infos_inout: dict[Region, dict],
-    machine_type=str,
-):
-    with Timer(f"__create_vm: {cloud_region_}"):
-        logging.info("will launch a VM")  # reagion name in thread name
-        env = env_for_singlecloud_subprocess(run_id_, cloud_region_)
-        env["MACHINE_TYPE"] = machine_type
-        process_stdout = run_subprocess(cloud_region_.script(), env)
-
-        vm_address_info = process_stdout
-        if vm_address_info[-1] == "\n":
-            vm_address_info = vm_address_info[:-1]
-        vm_address_infos = vm_address_info.split(",")
+def __vm_info(launch_output: str, machine_type: str) -> dict:
+    vm_address_info = launch_output
+    if vm_address_info[-1] == "\n":
+        vm_address_info = vm_address_info[:-1]
+    vm_address_infos = vm_address_info.split(",")
 
-        vm_info = {
-            "machine_type": machine_type,
-            "address": vm_address_infos[0],
-        }
+    vm_info = {
+        "machine_type": machine_type,
+        "address": vm_address_infos[0],
+    }
 
-        if len(vm_address_infos) > 1:
-            vm_info["name"] = vm_address_infos[1]
-            vm_info["zone"] = vm_address_infos[2]
+    if len(vm_address_infos) > 1:
+        vm_info["name"] = vm_address_infos[1]
+        vm_info["zone"] = vm_address_infos[2]
 
-        vm_region_and_address_infos_inout[cloud_region_] = vm_info
+    return vm_info
 
 
 def __arrange_vms_by_region(
@@ -52,117 +42,105 @@ def __arrange_vms_by_region(
     return ret
 
 
-def create_vms(
+async def create_vms(
     region_pairs_: list[tuple[Region, Region]],
     run_id: str,
     machine_types: dict[Cloud, str],
+    vm_run_id: Optional[str] = None,
+    on_vm_ready: Optional[Callable[[Region, Optional[dict]], Awaitable[None]]] = None,
+    vms_already_up: Optional[dict[Region, dict]] = None,
 ) -> list[tuple[tuple[Region, Optional[dict]], tuple[Region, Optional[dict]]]]:
+    """:param vm_run_id: the run ID that VMs are named and labeled with,
+    by default run_id. To delete VMs of one batch but not of others in the same run,
+    give each batch its own.
+    :param on_vm_ready: called as soon as each VM is launched, with its information,
+    or with None if it failed, so that tests can start without waiting for other VMs.
+    :param vms_already_up: VMs that are reused rather than launched, by region
+    """
     with Timer("create_vms"):
-        vm_region_and_address_infos = {}
-        threads = []
-        regions_dedup = unique_regions(region_pairs_)
+        vm_region_and_address_infos = dict(vms_already_up or {})
+        failed_regions = []
+        regions_dedup = [
+            r
+            for r in unique_regions(region_pairs_)
+            if r not in vm_region_and_address_infos
+        ]
+        if vm_region_and_address_infos:
+            logging.info(
+                "Reusing VMs in %d regions: %s",
+                len(vm_region_and_address_infos),
+                list(vm_region_and_address_infos),
+            )
+            if on_vm_ready:
+                for cloud_region, vm_info in vm_region_and_address_infos.items():
+                    await on_vm_ready(cloud_region, vm_info)
         logging.info(
             "VMs of types %s in %s regions: %s",
             "; ".join(f"{c.name}:{t}" for c, t in machine_types.items()),
             len(regions_dedup),
             regions_dedup,
         )
-        for cloud_region in regions_dedup:
-            thread = threading.Thread(
-                name=f"Thread-create-{cloud_region}",
-                target=__create_vm,
-                args=(
-                    run_id,
-                    cloud_region,
-                    vm_region_and_address_infos,
-                    machine_types[cloud_region.cloud],
-                ),
-            )
-            threads.append(thread)
-            thread.start()
 
-        for thread in threads:
-            thread.join(timeout=thread_timeout)
-            if thread.is_alive():
-                logging.info("%s timed out", thread.name)
+        start = time.time()
+
+        async def report(cloud_region: Region, launch_output: Union[str, Exception]):
+            try:
+                if isinstance(launch_output, Exception):
+                    raise launch_output
+                vm_info = __vm_info(launch_output, machine_types[cloud_region.cloud])
+            except Exception as e:
+                logging.error("Failed to launch VM in %s: %r", cloud_region, e)
+                vm_info = None
+                __log_failure_to_create_vm(
+                    run_id, cloud_region, failed_regions, region_pairs_, machine_types
+                )
+                failed_regions.append(cloud_region)
+            else:
+                logging.info(
+                    "Launched a VM in %s in %.1f s", cloud_region, time.time() - start
+                )
+                vm_region_and_address_infos[cloud_region] = vm_info
+
+            if on_vm_ready:
+                await on_vm_ready(cloud_region, vm_info)
+
+        await asyncio.gather(
+            *(
+                provider(c).launch_vms(
+                    vm_run_id or run_id,
+                    [r for r in regions_dedup if r.cloud == c],
+                    machine_types[c],
+                    report,
+                )
+                for c in {r.cloud for r in regions_dedup}
+            )
+        )
 
         if not vm_region_and_address_infos:
             logging.error("No VMs were created")
+        elif failed_regions:
+            logging.info(
+                "%d regions where no VM was successfully created %s",
+                len(failed_regions),
+                failed_regions,
+            )
 
-        regionwithvm_pairs = __arrange_vms_by_region(
-            region_pairs_, vm_region_and_address_infos
-        )
-
-        __log_failure_to_create_vm(run_id, regionwithvm_pairs, machine_types)
-        return regionwithvm_pairs
+        return __arrange_vms_by_region(region_pairs_, vm_region_and_address_infos)
 
 
 def __log_failure_to_create_vm(
     run_id: str,
-    regionwithvm_pairs: list[tuple[tuple[Region, dict], tuple[Region, dict]]],
+    failed_region: Region,
+    previously_failed_regions: list[Region],
+    region_pairs: list[tuple[Region, Region]],
     machine_types: dict[Cloud, str],
 ):
-    region_pairs_missing_a_vm = regionpairs_lacking_a_vm(regionwithvm_pairs)
-    for fail_before_start in region_pairs_missing_a_vm:
-        src_, dst_ = fail_before_start[0][0], fail_before_start[1][0]
-        logging.error(
-            "Failed because or more VMs was unavailable: Test %s,%s", src_, dst_
-        )
-        write_failed_test(run_id, src_, dst_)
-    missing_regions = region_with_failed_vm(regionwithvm_pairs)
-    if missing_regions:
-        logging.info(
-            "%d regions where no VM was successfully created %s",
-            len(missing_regions),
-            missing_regions,
-        )
-        write_missing_regions(missing_regions, machine_types)
-
-
-def regionpairs_lacking_a_vm(
-    regionwithvm_pairs: list[tuple[tuple[Region, dict], tuple[Region, dict]]]
-) -> list[tuple[tuple[Region, dict], tuple[Region, dict]]]:
-    return __regionpair_vm_success(regionwithvm_pairs)[0]
-
-
-def regionpairs_with_both_vms(
-    regionwithvm_pairs: list[tuple[tuple[Region, dict], tuple[Region, dict]]]
-) -> list[tuple[tuple[Region, dict], tuple[Region, dict]]]:
-    return __regionpair_vm_success(regionwithvm_pairs)[1]
-
-
-def region_with_failed_vm(
-    regionwithvm_pairs: list[tuple[tuple[Region, dict], tuple[Region, dict]]]
-) -> list[Region]:
-    return __regionpair_vm_success(regionwithvm_pairs)[2]
-
-
-def __regionpair_vm_success(
-    regionwithvm_pairs: list[tuple[tuple[Region, dict], tuple[Region, dict]]]
-) -> tuple[
-    list[tuple[tuple[Region, dict], tuple[Region, dict]]],
-    list[tuple[tuple[Region, dict], tuple[Region, dict]]],
-    list[Region],
-]:
-    missing_regions = []
-
-    both_vms_exist: list[tuple[tuple[Region, dict], tuple[Region, dict]]]
-    missing_one_or_more_vms: list[tuple[tuple[Region, dict], tuple[Region, dict]]]
-    both_vms_exist = []
-    missing_one_or_more_vms = []
-    for regionwithvm_pair in regionwithvm_pairs:
-        skip = False
-        for i in [0, 1]:
-            if regionwithvm_pair[i][1] is None:
-                missing_regions.append(regionwithvm_pair[i][0])
-                skip = True
-        if skip:
-            missing_one_or_more_vms.append(regionwithvm_pair)
-        else:
-            both_vms_exist.append(regionwithvm_pair)
-
-    missing_regions = dedup(missing_regions)
-
-    logging.info("%d tests where both VMs successfully created", len(both_vms_exist))
-
-    return missing_one_or_more_vms, both_vms_exist, missing_regions
+    for src_, dst_ in region_pairs:
+        if failed_region in (src_, dst_) and not any(
+            r in previously_failed_regions for r in (src_, dst_)
+        ):
+            logging.error(
+                "Failed because or more VMs was unavailable: Test %s,%s", src_, dst_
+            )
+            write_failed_test(run_id, src_, dst_)
+    write_missing_regions([failed_region], machine_types)
@@ -1,25 +1,28 @@
+import asyncio
+import collections
 import itertools
-import json
 import logging
 import os
-import threading
+import shutil
+import statistics
+import tempfile
 import time
-from math import sqrt
-
-from cloud.clouds import Region, Cloud, basename_key_for_aws_ssh
-from history.attempted import write_failed_test
-from history.results import (
-    write_results_for_run,
-    combine_results,
-    analyze_test_count,
+from typing import Optional
+
+from cloud.clouds import Region, Cloud
+from cloud.providers import provider
+from history.attempted import write_failed_test, analyze_test_count
+from history.result_writer import ResultWriter
+from history.run_journal import RunJournal
+from test_steps.measurement import MeasurementError
+from test_steps.scheduling import (
+    SCHEDULE_GREEDY,
+    order_for_schedule,
+    max_parallel_tests,
 )
-from test_steps.create_vms import regionpairs_with_both_vms
 from util import utils
-from util.subprocesses import run_subprocess
 from util.utils import (
-    thread_timeout,
     Timer,
-    dedup,
     process_starttime_iso,
 )
 
@@ -28,6 +31,27 @@ class NoneAvailable(Exception):
     pass
 
 
+class RetryPolicy:
+    """How a failed test is tried again in the same batch, while its VMs are still up.
+
+    A failed pair goes back into the dispatcher after the pairs planned so far, and can be
+    taken again once its backoff has passed; the backoff grows with each attempt.
+    A failure is recorded only when the attempts run out.
+    """
+
+    def __init__(
+        self, attempts: int = 2, backoff_s: float = 5.0, backoff_factor: float = 2.0
+    ):
+        """:param attempts: the most times a test is tried, including the first"""
+        assert attempts >= 1, attempts
+        self.attempts = attempts
+        self.backoff_s = backoff_s
+        self.backoff_factor = backoff_factor
+
+    def backoff_after(self, attempts_made: int) -> float:
+        return self.backoff_s * self.backoff_factor ** (attempts_made - 1)
+
+
 def _regiondict_pairs_to_regionlist(
     pairs: list[tuple[tuple[Region, dict], tuple[Region, dict]]]
 ) -> list[Region]:
@@ -49,226 +73,505 @@ def _regiondict_pair_to_regionlist(
 
 
 class Q:
+    """Hands out region pairs for testing, such that a region is in only one test at a time.
+
+    Pairs are planned in advance, and become testable as the VMs in both
+    their regions are launched; pairs where a VM could not be launched are dropped.
+    Untested pairs are indexed by source region, and source regions that are idle
+    are tracked, so that finding a testable pair does not scan all untested pairs.
+    Of the pairs testable now, the one earliest in the planned order is handed out,
+    so that the order can express a schedule.
+    Workers waiting for a pair are woken as soon as a VM is launched or a finished test
+    frees its regions.
+    Workers beyond the number of tests that can still run in parallel
+    are retired rather than left waiting.
+    Pairs whose test failed are tried again as the retry policy allows.
+    """
+
     def __init__(
         self,
-        region_pairs_with_valid_vms: list[
-            tuple[tuple[Region, dict], tuple[Region, dict]]
-        ],
+        planned_region_pairs: list[tuple[Region, Region]],
+        retry_policy: Optional[RetryPolicy] = None,
     ):
-        self.__lock = threading.Lock()
+        self.__cond = asyncio.Condition()
 
-        self.__untested: list[tuple[tuple[Region, dict], tuple[Region, dict]]] = list(
-            region_pairs_with_valid_vms
-        )
+        self.__rank: dict[tuple[Region, Region], int] = {}
+        for p in planned_region_pairs:
+            self.__rank.setdefault(p, len(self.__rank))
+        self.__next_rank = len(self.__rank)
 
-        self.__now_under_test: list[
-            tuple[tuple[Region, dict], tuple[Region, dict]]
-        ] = []
+        self.__retry_policy = retry_policy or RetryPolicy(attempts=1)
+        self.__attempts: collections.Counter[tuple[Region, Region]] = (
+            collections.Counter()
+        )
+        # Pairs to be tried again, with the time from when they can be
+        self.__retrying: dict[tuple[Region, Region], float] = {}
+
+        self.__vm_infos: dict[Region, dict] = {}
+        # Pairs waiting for the VM in one or both regions
+        self.__waiting_by_region: dict[Region, set[tuple[Region, Region]]] = {}
+        for p in self.__rank:
+            for r in p:
+                self.__waiting_by_region.setdefault(r, set()).add(p)
+        self.__num_waiting = len(self.__rank)
+
+        # Dicts are used as insertion-ordered sets, kept sorted by rank, so that
+        # the first testable pair for each source region is also the earliest planned.
+        self.__untested_by_src: dict[
+            Region,
+            dict[Region, tuple[int, tuple[tuple[Region, dict], tuple[Region, dict]]]],
+        ] = {}
+        self.__num_untested = 0
+
+        self.__now_under_test: set[tuple[Region, Region]] = set()
+        self.__busy_regions: set[Region] = set()
+        # Source regions that have untested pairs and are not now under test
+        self.__idle_srcs: dict[Region, None] = {}
+
+        self.__worker_count = 0
+        # Cached until a pair is removed by a finished test or a failed VM
+        self.__max_parallel: Optional[int] = None
+
+    def add_worker(self):
+        self.__worker_count += 1
+
+    def max_parallel(self) -> int:
+        """:return the most tests that can run at once among the pairs waiting for VMs,
+        the untested pairs, and those under test, which is the most workers that can still be busy.
+        """
+        if self.__max_parallel is None:
+            pending = (
+                list(self.__now_under_test)
+                + [
+                    (src, dst)
+                    for src, untested_from_src in self.__untested_by_src.items()
+                    for dst in untested_from_src
+                ]
+                + list(set().union(*self.__waiting_by_region.values()))
+                + list(self.__retrying)
+            )
+            self.__max_parallel = max_parallel_tests(pending)
+        return self.__max_parallel
 
     def num_untested(self):
-        self.__lock.acquire()
-        try:
-            return len(self.__untested)
-        finally:
-            self.__lock.release()
+        return self.__num_untested
 
     def is_done(self):
-        self.__lock.acquire()
-        try:
-            none_left = not self.__untested
-            none_still_under_test = not self.__now_under_test
-            return none_left and none_still_under_test
+        return (
+            not self.__num_untested
+            and not self.__num_waiting
+            and not self.__now_under_test
+            and not self.__retrying
+        )
 
-        finally:
-            self.__lock.release()
+    async def vm_ready(self, region: Region, vm_info: Optional[dict]):
+        """Call when the VM in this region has been launched, with None if it failed."""
+        async with self.__cond:
+            waiting = self.__waiting_by_region.pop(region, set())
+            if vm_info is None:
+                self.__drop_waiting(waiting)
+                self.__max_parallel = None
+            else:
+                self.__vm_infos[region] = vm_info
+                ready = [p for p in waiting if all(r in self.__vm_infos for r in p)]
+                self.__drop_waiting(ready)
+                self.__add_untested(ready)
+            self.__cond.notify_all()
+
+    async def all_vms_launched(self):
+        """Call when no more VMs will be launched. Pairs still waiting for a VM are dropped."""
+        async with self.__cond:
+            for region in list(self.__waiting_by_region):
+                self.__drop_waiting(self.__waiting_by_region.pop(region))
+            self.__max_parallel = None
+            self.__cond.notify_all()
+
+    def __drop_waiting(self, pairs):
+        for p in pairs:
+            for r in p:
+                self.__waiting_by_region.get(r, set()).discard(p)
+            self.__num_waiting -= 1
+
+    def __add_untested(self, region_pairs: list[tuple[Region, Region]]):
+        srcs = set()
+        for src, dst in region_pairs:
+            pair = ((src, self.__vm_infos[src]), (dst, self.__vm_infos[dst]))
+            untested_from_src = self.__untested_by_src.setdefault(src, {})
+            untested_from_src[dst] = (self.__rank[(src, dst)], pair)
+            self.__num_untested += 1
+            srcs.add(src)
+            if src not in self.__busy_regions:
+                self.__idle_srcs[src] = None
+        for src in srcs:
+            self.__untested_by_src[src] = dict(
+                sorted(self.__untested_by_src[src].items(), key=lambda i: i[1][0])
+            )
 
-    def __get_suitable_pair(
+    def __take_suitable_pair(
         self,
-    ) -> tuple[tuple[Region, dict], tuple[Region, dict]]:
-        self.__lock.acquire()
-        ret = None
-        try:
-            intest: list[Region] = _regiondict_pairs_to_regionlist(
-                self.__now_under_test
-            )
-            for potential_testee in self.__untested:
-                potential_testee_regionlist = _regiondict_pair_to_regionlist(
-                    potential_testee
-                )
-                assert len(potential_testee_regionlist) == 2
-                if all(r not in intest for r in potential_testee_regionlist):
-                    self.__now_under_test.append(potential_testee)
-                    self.__untested.remove(potential_testee)
-                    ret = potential_testee
-                    break
-
-            return ret  # Can be none if none testable
-        finally:
-            self.__lock.release()
-
-    def blocking_dequeue_one(self) -> tuple[tuple[Region, dict], tuple[Region, dict]]:
-        while True:
-            src_dest = self.__get_suitable_pair()
-            if src_dest is None and self.num_untested():
-                logging.info(
-                    f"can't find a pair not currently under test among "
-                    f"{self.num_untested()} not yet tested. ({len(self.__now_under_test)} now under test); retrying"
-                )
-                time.sleep(5)
-                continue
-            else:
-                if not self.num_untested():
+    ) -> Optional[tuple[tuple[Region, dict], tuple[Region, dict]]]:
+        """Call only while holding the lock."""
+        best: Optional[tuple[int, Region, Region]] = None
+        for src in self.__idle_srcs:
+            for dst, (rank, _) in self.__untested_by_src[src].items():
+                if dst not in self.__busy_regions:
+                    if best is None or rank < best[0]:
+                        best = rank, src, dst
+                    break  # Later pairs from this source come later in the order
+        if best is None:
+            return None  # None testable now
+
+        _, src, dst = best
+        _, pair = self.__untested_by_src[src].pop(dst)
+        self.__num_untested -= 1
+        self.__attempts[(src, dst)] += 1
+        self.__now_under_test.add((src, dst))
+        self.__mark_busy(src, dst)
+        return pair
+
+    def __mark_busy(self, src: Region, dst: Region):
+        for r in (src, dst):
+            self.__busy_regions.add(r)
+            self.__idle_srcs.pop(r, None)
+
+    def __mark_idle(self, src: Region, dst: Region):
+        for r in (src, dst):
+            self.__busy_regions.discard(r)
+            if self.__untested_by_src.get(r):
+                self.__idle_srcs[r] = None
+
+    async def blocking_dequeue_one(
+        self,
+    ) -> Optional[tuple[tuple[Region, dict], tuple[Region, dict]]]:
+        async with self.__cond:
+            while True:
+                self.__add_due_retries()
+                src_dest = self.__take_suitable_pair()
+                if src_dest is not None:
+                    logging.info(
+                        f"Will process {_regiondict_pair_to_region_pair(src_dest)}; {self.__num_untested} left"
+                    )
+                    return src_dest
+                # Not while tests are under test, since any of them may be tried again
+                if self.is_done():
                     logging.info("done because queue is empty.")
-                else:
-                    assert (
-                        src_dest
-                    ), f"{threading.current_thread().name}; Q done {self.is_done()}, Untested {self.num_untested()}"
+                    self.__worker_count -= 1
+                    return None
+                if self.__worker_count > self.max_parallel():
                     logging.info(
-                        f"Will process {_regiondict_pair_to_region_pair(src_dest)}; {len(self.__untested)} left"
+                        "Retiring: %d workers, but at most %d tests can still run in parallel",
+                        self.__worker_count,
+                        self.__max_parallel,
                     )
-            return src_dest
-
-    def one_test_done(self, src: tuple[Region, dict], dst: tuple[Region, dict]):
-        self.__lock.acquire()
-        try:
+                    self.__worker_count -= 1
+                    return None
+                # Woken by vm_ready, one_test_done or retry_later, or when a retry is due
+                try:
+                    await asyncio.wait_for(self.__cond.wait(), self.__until_retry())
+                except asyncio.TimeoutError:
+                    pass
+
+    def __until_retry(self) -> Optional[float]:
+        """:return the time until the next retry is due, or None if there is none"""
+        if not self.__retrying:
+            return None
+        return max(0.0, min(self.__retrying.values()) - time.monotonic())
+
+    def __add_due_retries(self):
+        now = time.monotonic()
+        due = [p for p, due_at in self.__retrying.items() if due_at <= now]
+        for p in due:
+            del self.__retrying[p]
+            # After the pairs planned so far
+            self.__rank[p] = self.__next_rank
+            self.__next_rank += 1
+        self.__add_untested(due)
+
+    async def retry_later(
+        self, src: tuple[Region, dict], dst: tuple[Region, dict]
+    ) -> bool:
+        """Call instead of one_test_done when a test failed.
+        :return whether it will be tried again; if not, call one_test_done
+        """
+        pair = src[0], dst[0]
+        async with self.__cond:
+            attempts_made = self.__attempts[pair]
+            if attempts_made >= self.__retry_policy.attempts:
+                return False
+            backoff_s = self.__retry_policy.backoff_after(attempts_made)
             logging.info(
-                f"One test finished: {_regiondict_pair_to_region_pair((src, dst))}; {len(self.__untested)} left"
+                "Will try test %s again in %.1f s, after %d attempts",
+                pair,
+                backoff_s,
+                attempts_made,
+            )
+            self.__now_under_test.remove(pair)
+            self.__mark_idle(*pair)
+            self.__retrying[pair] = time.monotonic() + backoff_s
+            self.__max_parallel = None
+            self.__cond.notify_all()
+            return True
+
+    async def one_test_done(self, src: tuple[Region, dict], dst: tuple[Region, dict]):
+        async with self.__cond:
+            logging.info(
+                f"One test finished: {_regiondict_pair_to_region_pair((src, dst))}; {self.__num_untested} left"
+            )
+            self.__now_under_test.remove((src[0], dst[0]))
+            self.__mark_idle(src[0], dst[0])
+            self.__max_parallel = None
+            self.__cond.notify_all()
+
+
+class SshConnections:
+    """One persistent SSH connection to each source VM for the whole batch,
+    over which each test from it runs its sessions, rather than each session making its own connection.
+
+    A connection is opened before the first test from a VM. If it cannot be opened,
+    tests from that VM make their own connections, as without this.
+    """
+
+    # One for iperf, one for ping
+    sessions_per_test = 2
+
+    def __init__(self, run_id: str):
+        self.__run_id = run_id
+        self.__dir: Optional[str] = None
+        # None where the connection could not be opened
+        self.__connections: dict[Region, Optional[tuple[dict, str]]] = {}
+        self.__locks: dict[Region, asyncio.Lock] = {}
+        self.__handshake_s: dict[Region, float] = {}
+        self.__tests: collections.Counter[Region] = collections.Counter()
+
+    async def control_path(self, src: tuple[Region, dict]) -> Optional[str]:
+        """:return the control socket of the connection to the source VM, opening it if needed"""
+        region, vm_info = src
+        async with self.__locks.setdefault(region, asyncio.Lock()):
+            if region not in self.__connections:
+                self.__connections[region] = await self.__open(src)
+            connection = self.__connections[region]
+        if connection is None:
+            return None
+        self.__tests[region] += 1
+        return connection[1]
+
+    async def __open(self, src: tuple[Region, dict]) -> Optional[tuple[dict, str]]:
+        region, vm_info = src
+        if self.__dir is None:
+            # Short, because Unix socket paths are limited to about 100 characters
+            self.__dir = tempfile.mkdtemp(prefix="ssh-")
+        control_path = os.path.join(self.__dir, str(len(self.__connections)))
+        start = time.time()
+        try:
+            await provider(region.cloud).open_ssh_connection(
+                self.__run_id, src, control_path
+            )
+        except Exception as e:
+            logging.warning("Could not open SSH connection to %s: %r", region, e)
+            return None
+        self.__handshake_s[region] = time.time() - start
+        return vm_info, control_path
+
+    async def close_all(self):
+        opened = {r: c for r, c in self.__connections.items() if c is not None}
+
+        async def close(region: Region, connection: tuple[dict, str]):
+            vm_info, control_path = connection
+            await provider(region.cloud).close_ssh_connection(
+                self.__run_id, (region, vm_info), control_path
             )
-            self.__now_under_test.remove((src, dst))
-        finally:
-            self.__lock.release()
+
+        outcomes = await asyncio.gather(
+            *(close(r, c) for r, c in opened.items()), return_exceptions=True
+        )
+        for region, outcome in zip(opened, outcomes):
+            if isinstance(outcome, BaseException):
+                logging.warning(
+                    "Failed to close SSH connection to %s: %r", region, outcome
+                )
+        self.__connections.clear()
+        if self.__dir is not None:
+            shutil.rmtree(self.__dir, ignore_errors=True)
+            self.__dir = None
+        self.__log_savings()
+
+    def __log_savings(self):
+        if not self.__handshake_s:
+            return
+        # Each session would have made its own connection, taking about as long as opening this one
+        sessions_reused = sum(
+            self.sessions_per_test * self.__tests[r] for r in self.__handshake_s
+        )
+        saved_s = sum(
+            h * (self.sessions_per_test * self.__tests[r] - 1)
+            for r, h in self.__handshake_s.items()
+        )
+        logging.info(
+            "Opened %d SSH connections, averaging %.1f s, for %d SSH sessions; saved about %.1f s of handshakes",
+            len(self.__handshake_s),
+            statistics.mean(self.__handshake_s.values()),
+            sessions_reused,
+            saved_s,
+        )
 
 
-def __deq_tests_and_run(run_id, q: Q):
+async def __deq_tests_and_run(
+    run_id,
+    q: Q,
+    ssh: SshConnections,
+    result_writer: ResultWriter,
+    journal: Optional[RunJournal],
+):
     while not q.is_done():
         with Timer("dequeuing"):
-            src_dest = q.blocking_dequeue_one()
+            src_dest = await q.blocking_dequeue_one()
 
         if src_dest is not None:
             src, dst = src_dest
-            __do_one_test(src, dst, run_id, q)
+            await __do_one_test(src, dst, run_id, q, ssh, result_writer, journal)
         else:
-            assert not q.num_untested()
-            logging.info("No more untested available, exiting thread")
+            logging.info("No more untested available to this worker, exiting worker")
             break
 
 
-def __do_one_test(src, dst, run_id, q):
+async def __do_one_test(
+    src,
+    dst,
+    run_id,
+    q,
+    ssh: SshConnections,
+    result_writer: ResultWriter,
+    journal: Optional[RunJournal],
+):
     with Timer(f"Test {src[0]},{dst[0]}"):
-
+        # Stays None if the test is cancelled, so that it is not recorded as done
+        succeeded: Optional[bool] = None
         try:
             src_region_, src_vm_info = src
             dst_region_, dst_vm_info = dst
             logging.info("running test from %s to %s", src_region_, dst_region_)
 
-            env = {
-                "PATH": os.environ["PATH"],
-                "RUN_ID": run_id,
-                "SERVER_PUBLIC_ADDRESS": dst_vm_info["address"],
-                "SERVER_CLOUD": dst_region_.cloud.name,
-                "CLIENT_CLOUD": src_region_.cloud.name,
-                "SERVER_REGION": dst_region_.region_id,
-                "CLIENT_REGION": src_region_.region_id,
-            }
-
-            if src_region_.cloud == Cloud.AWS:
-                env |= {
-                    "CLIENT_PUBLIC_ADDRESS": src_vm_info["address"],
-                    "BASE_KEYNAME": basename_key_for_aws_ssh,
-                }
-            elif src_region_.cloud == Cloud.GCP:
-                try:
-                    env |= {
-                        "CLIENT_NAME": src_vm_info["name"],
-                        "CLIENT_ZONE": src_vm_info["zone"],
-                    }
-                except KeyError as ke:
-                    logging.error("{src_addr_infos=}")
-                    raise ke
-
-            else:
-                assert (
-                    False
-                ), f"Did not implement  tests from this cloud: {src_region_.cloud} (region {src_region_} to region {dst_region_} )"
-
-            script = src_region_.script_for_test_from_region()
-
-            process_stdout = run_subprocess(script, env)
+            ssh_control_path = await ssh.control_path(src)
+            measurement = await provider(src_region_.cloud).run_test(
+                run_id, src, dst, ssh_control_path
+            )
 
             logging.info(
                 "Test %s result from %s to %s is %s",
                 run_id,
                 src[0],
                 dst[0],
-                process_stdout,
+                measurement,
+            )
+            # Timestamp first, as the columns of results.csv are in this order
+            result_j = {"timestamp": process_starttime_iso()} | measurement.result_json(
+                run_id, src_region_, dst_region_
             )
-            test_result = process_stdout + "\n"
-
-            result_j = json.loads(test_result)
             machine_types: dict[Cloud, str] = {
                 r[0].cloud: r[1]["machine_type"] for r in (src, dst)
             }
             for c in Cloud:
                 result_j[f"{c.name.lower()}_vm"] = machine_types.get(c)
-            # Ignore timestamp from shellscript, and use process starttime
-            result_j["timestamp"] = process_starttime_iso()
-            write_results_for_run(result_j, run_id, src_region_, dst_region_)
+            result_writer.write(src_region_, dst_region_, result_j)
+            succeeded = True
+        except MeasurementError as e:
+            logging.error("Test from %s to %s failed: %s", src[0], dst[0], e)
+            succeeded = False
         except Exception as e:
             logging.exception(e)
-            write_failed_test(run_id, src[0], dst[0])
+            succeeded = False
         finally:
-            q.one_test_done(src, dst)
+            if succeeded is False and await q.retry_later(src, dst):
+                pass  # Recorded when it is done
+            else:
+                if succeeded is False:
+                    write_failed_test(run_id, src[0], dst[0])
+                if journal and succeeded is not None:
+                    journal.test_done(src[0], dst[0], succeeded)
+                await q.one_test_done(src, dst)
+
+
+def plan_batch(
+    region_pairs: list[tuple[Region, Region]],
+    schedule: str = SCHEDULE_GREEDY,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> Q:
+    """:return a dispatcher for these pairs, to which VMs are then reported with Q.vm_ready
+    :param retry_policy: by default, failed tests are not tried again"""
+    region_pairs = list(dict.fromkeys(region_pairs))
+    ordered = order_for_schedule(
+        schedule, region_pairs, max_parallel_tests(region_pairs)
+    )
+    return Q(ordered, retry_policy)
 
 
-def do_batch(
-    run_id: str,
-    region_with_vminfo_pairs: list[tuple[tuple[Region, dict], tuple[Region, dict]]],
-):
+async def run_batch(run_id: str, q: Q, journal: Optional[RunJournal] = None):
+    """Tests the pairs in this dispatcher as their VMs are launched.
+    :param journal: where tests are recorded as they are done"""
     with Timer("do_tests"):
-        assert region_with_vminfo_pairs, "Should not be empty"
+        # More workers than tests that can run in parallel would never get work
+        worker_count = q.max_parallel()
 
-        region_pairs_with_valid_vms = regionpairs_with_both_vms(
-            region_with_vminfo_pairs
-        )
-
-        threads = []
-
-        p: tuple[tuple[Region, dict], tuple[Region, dict]]
-        q = Q(region_pairs_with_valid_vms)
+        logging.info("Will use %d test workers", worker_count)
+        ssh = SshConnections(run_id)
+        result_writer = ResultWriter()
+        try:
+            workers = [
+                __start_worker(run_id, q, ssh, result_writer, journal)
+                for _ in range(worker_count)
+            ]
+            # Each test has its own timeout, so the workers finish
+            await asyncio.gather(*workers)
+        finally:
+            await ssh.close_all()
+            unwritten = await asyncio.to_thread(result_writer.close)
+            for src, dst in unwritten:
+                logging.error(
+                    "Test from %s to %s failed, as its result could not be written",
+                    src,
+                    dst,
+                )
+                write_failed_test(run_id, src, dst)
+                if journal:
+                    # Replacing its record as succeeded
+                    journal.test_done(src, dst, False)
 
-        region_count = len(
-            dedup(_regiondict_pairs_to_regionlist(region_with_vminfo_pairs))
-        )
-        # Reduce the contention where there are many regions
-        thread_count = 2 * int(sqrt(region_count))
-        assert thread_count >= 1
+        analyze_test_count()
 
-        logging.info("Will use %d test threads", thread_count)
-        # This is very much not thread-bound, so
-        for _ in range(thread_count):
-            __start_thread(run_id, threads, q)
 
-        for t in threads:
-            t.join(timeout=thread_timeout)
-            if t.is_alive():
-                logging.info("%s timed out", t.name)
+async def do_batch(
+    run_id: str,
+    region_with_vminfo_pairs: list[tuple[tuple[Region, dict], tuple[Region, dict]]],
+    schedule: str = SCHEDULE_GREEDY,
+):
+    """Tests pairs where the VMs have already been launched, or failed to launch."""
+    assert region_with_vminfo_pairs, "Should not be empty"
 
-        combine_results(run_id)
-        analyze_test_count()
+    q = plan_batch(
+        [_regiondict_pair_to_region_pair(p) for p in region_with_vminfo_pairs],
+        schedule,
+    )
+    vm_infos = dict(utils.shallow_flatten(region_with_vminfo_pairs))
+    for region, vm_info in vm_infos.items():
+        await q.vm_ready(region, vm_info)
+    await run_batch(run_id, q)
 
 
-thread_counter = 0
+worker_counter = 0
 
 
-def __start_thread(run_id: str, threads: list[threading.Thread], q: Q):
-    global thread_counter
-    thread_counter += 1
-    name = f"Test-thread-{thread_counter}"
-    logging.info(f"Will run test-thread %s", name)
-    thread = threading.Thread(
-        name=name,
-        target=__deq_tests_and_run,
-        args=(run_id, q),
+def __start_worker(
+    run_id: str,
+    q: Q,
+    ssh: SshConnections,
+    result_writer: ResultWriter,
+    journal: Optional[RunJournal],
+) -> asyncio.Task:
+    global worker_counter
+    worker_counter += 1
+    name = f"Test-worker-{worker_counter}"
+    logging.info(f"Will run test-worker %s", name)
+    q.add_worker()
+    return asyncio.create_task(
+        __deq_tests_and_run(run_id, q, ssh, result_writer, journal), name=name
     )
-    threads.append(thread)
-    thread.start()
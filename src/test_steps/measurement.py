@@ -0,0 +1,174 @@
+import abc
+import asyncio
+import logging
+import re
+import time
+from typing import Optional
+
+from cloud.clouds import Region
+from util.subprocesses import run_command_async
+
+# Each command over SSH; iperf runs for 10 s and ping for 4 s
+ssh_command_timeout = 60
+ping_count = 5
+
+# rtt min/avg/max/mdev = 0.030/0.043/0.052/0.008 ms
+__ping_summary = re.compile(r"=\s*[\d.]+/([\d.]+)/[\d.]+/[\d.]+\s*ms")
+
+
+class MeasurementError(Exception):
+    """A test failed at one step: "iperf", "ping", or "timeout"."""
+
+    def __init__(self, step: str, message: str, attempts: int, elapsed_s: float):
+        super().__init__(
+            f"{step} failed after {attempts} attempts in {elapsed_s:.1f} s: {message}"
+        )
+        self.step = step
+        self.attempts = attempts
+        self.elapsed_s = elapsed_s
+
+
+class Measurement:
+    """The result of one test, with the time that each step took."""
+
+    def __init__(self, bitrate_Bps: float, avgrtt_ms: float, timings: dict[str, float]):
+        self.bitrate_Bps = bitrate_Bps
+        self.avgrtt_ms = avgrtt_ms
+        self.timings = timings
+
+    def __repr__(self):
+        return f"Measurement({self.bitrate_Bps=}, {self.avgrtt_ms=}, {self.timings=})"
+
+    def result_json(self, run_id: str, src: Region, dst: Region) -> dict:
+        """:return the result in the form written to the results files"""
+        return {
+            "run_id": run_id,
+            "from": {"cloud": src.cloud.name, "region": src.region_id},
+            "to": {"cloud": dst.cloud.name, "region": dst.region_id},
+            # As strings, as they have always been written
+            "bitrate_Bps": str(round(self.bitrate_Bps)),
+            "avgrtt": f"{self.avgrtt_ms:.3f}",
+        }
+
+
+class Transport(abc.ABC):
+    """Runs commands on the VM that a test is run from."""
+
+    @abc.abstractmethod
+    async def run(self, command: str) -> str:
+        """:return the command's stdout
+        :raise ChildProcessError if the command, or the connection, failed"""
+
+
+class OpenSshTransport(Transport):
+    """Runs each command with one ssh process,
+    over the connection at control_path if it is open."""
+
+    def __init__(
+        self,
+        user: str,
+        host: str,
+        identity_file: Optional[str] = None,
+        control_path: Optional[str] = None,
+    ):
+        self.__args = [
+            "ssh",
+            "-oStrictHostKeyChecking=no",
+            "-oBatchMode=yes",
+            f"-oControlPath={control_path or 'none'}",
+        ]
+        if identity_file:
+            self.__args += ["-i", identity_file]
+        self.__args.append(f"{user}@{host}")
+
+    async def run(self, command: str) -> str:
+        return await run_command_async(
+            self.__args + [command], timeout=ssh_command_timeout
+        )
+
+
+class GcloudSshTransport(Transport):
+    """Runs each command with gcloud compute ssh, which manages the SSH keys for the VM."""
+
+    def __init__(self, name: str, zone: str):
+        self.__args = ["gcloud", "compute", "ssh", name, f"--zone={zone}"]
+
+    async def run(self, command: str) -> str:
+        return await run_command_async(
+            self.__args + ["--command", command], timeout=ssh_command_timeout
+        )
+
+
+async def measure(
+    transport: Transport,
+    server_address: str,
+    attempts: int,
+    retry_delay_s: float,
+) -> Measurement:
+    """Measures the bitrate with iperf and the RTT with ping, from the VM reached through the transport
+    to the iperf server at server_address.
+    :param attempts: for each command, since the VMs may not yet accept connections
+    """
+    iperf_output, iperf_s = await __run_with_retries(
+        transport, f"iperf -c {server_address} -y C", "iperf", attempts, retry_delay_s
+    )
+    bitrate_Bps = __parse(parse_iperf_csv, iperf_output, "iperf", iperf_s)
+
+    ping_output, ping_s = await __run_with_retries(
+        transport,
+        f"ping {server_address} -c {ping_count}",
+        "ping",
+        attempts,
+        retry_delay_s,
+    )
+    avgrtt_ms = __parse(parse_ping_summary, ping_output, "ping", ping_s)
+
+    return Measurement(bitrate_Bps, avgrtt_ms, {"iperf": iperf_s, "ping": ping_s})
+
+
+def parse_iperf_csv(output: str) -> float:
+    """:param output: from iperf -y C, one line of
+    timestamp,src_address,src_port,dst_address,dst_port,id,interval,transferred_bytes,bits_per_second
+    :return the bytes transferred in the 10 s of the test, which has always been recorded as the bitrate
+    """
+    line = output.strip().splitlines()[-1]
+    return float(line.split(",")[-2])
+
+
+def parse_ping_summary(output: str) -> float:
+    """:return the average RTT in ms from the last line of ping's output"""
+    match = __ping_summary.search(output.strip().splitlines()[-1])
+    if not match:
+        raise ValueError("No RTT summary")
+    return float(match.group(1))
+
+
+async def __run_with_retries(
+    transport: Transport,
+    command: str,
+    step: str,
+    attempts: int,
+    retry_delay_s: float,
+) -> tuple[str, float]:
+    """:return the command's output, and the time taken including retries"""
+    start = time.time()
+    error = ""
+    for attempt in range(1, attempts + 1):
+        try:
+            output = await transport.run(command)
+            if output.strip():
+                return output, time.time() - start
+            error = "No output"
+        except ChildProcessError as e:
+            error = str(e)
+        logging.info("%s attempt %d of %d failed: %s", step, attempt, attempts, error)
+        if attempt < attempts:
+            await asyncio.sleep(retry_delay_s)
+    raise MeasurementError(step, error, attempts, time.time() - start)
+
+
+def __parse(parse, output: str, step: str, elapsed_s: float) -> float:
+    try:
+        return parse(output)
+    except (ValueError, IndexError) as e:
+        raise MeasurementError(step, f"Cannot parse {output!r}: {e}", 1, elapsed_s)
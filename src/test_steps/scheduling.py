@@ -0,0 +1,237 @@
+import collections
+import itertools
+import logging
+
+from cloud.clouds import Region
+from test_steps.utils import unique_regions
+
+SCHEDULE_GREEDY = "greedy"
+SCHEDULE_ROUNDS = "rounds"
+schedules = [SCHEDULE_GREEDY, SCHEDULE_ROUNDS]
+
+
+def tournament_rounds(
+    region_pairs: list[tuple[Region, Region]]
+) -> list[list[tuple[Region, Region]]]:
+    """
+    :return the directed region pairs arranged in rounds, where no region
+    is in more than one pair in a round, so that each round can be tested in parallel.
+    This is an edge coloring of the graph of regions: Where every region is paired with every other,
+    the round-robin-tournament ("circle") method gives the least possible number of rounds;
+    otherwise rounds are packed greedily, most-constrained regions first.
+    """
+    pairs = list(dict.fromkeys(region_pairs))
+    regions = unique_regions(pairs)
+    undirected = {frozenset(p) for p in pairs if p[0] != p[1]}
+    n = len(regions)
+    if n > 1 and len(undirected) == n * (n - 1) // 2:
+        rounds = __circle_method_rounds(regions, pairs)
+    else:
+        rounds = __greedy_rounds(pairs)
+    assert sum(len(r) for r in rounds) == len(pairs)
+    return rounds
+
+
+def __circle_method_rounds(
+    regions: list[Region], pairs: list[tuple[Region, Region]]
+) -> list[list[tuple[Region, Region]]]:
+    remaining = set(pairs)
+    slots: list = list(regions)
+    if len(slots) % 2:
+        slots.append(None)  # A "bye" in the tournament
+    half = len(slots) // 2
+    forward = []
+    backward = []
+    for _ in range(len(slots) - 1):
+        fwd_round = []
+        bwd_round = []
+        for i in range(half):
+            a, b = slots[i], slots[-1 - i]
+            if a is None or b is None:
+                continue
+            for rnd, p in [(fwd_round, (a, b)), (bwd_round, (b, a))]:
+                if p in remaining:
+                    rnd.append(p)
+                    remaining.remove(p)
+        forward.append(fwd_round)
+        backward.append(bwd_round)
+        # Keep the first slot fixed, rotate the others
+        slots = [slots[0], slots[-1]] + slots[1:-1]
+
+    # Intra-region pairs, if explicitly requested, were not placed above
+    rounds = [r for r in forward + backward if r]
+    if remaining:
+        rounds += __greedy_rounds([p for p in pairs if p in remaining])
+    return rounds
+
+
+def __greedy_rounds(
+    pairs: list[tuple[Region, Region]]
+) -> list[list[tuple[Region, Region]]]:
+    rounds = []
+    remaining = list(pairs)
+    while remaining:
+        degree = collections.Counter(itertools.chain.from_iterable(remaining))
+
+        def most_constrained_first(i: int):
+            src, dst = remaining[i]
+            return -max(degree[src], degree[dst]), -(degree[src] + degree[dst]), i
+
+        in_round = set()
+        regions_in_round = set()
+        for i in sorted(range(len(remaining)), key=most_constrained_first):
+            src, dst = remaining[i]
+            if src not in regions_in_round and dst not in regions_in_round:
+                regions_in_round |= {src, dst}
+                in_round.add(i)
+        rounds.append([remaining[i] for i in sorted(in_round)])
+        remaining = [p for i, p in enumerate(remaining) if i not in in_round]
+    return rounds
+
+
+def max_parallel_tests(region_pairs: list[tuple[Region, Region]]) -> int:
+    """
+    :return the most tests among these pairs that can run at once, where no region
+    is in more than one test. This is the size of a maximum matching in the graph
+    of regions, found with Edmonds' blossom algorithm. An intra-region pair
+    occupies just the one region; it is modeled as an edge to a dummy vertex.
+    """
+    regions = unique_regions(region_pairs)
+    index = {r: i for i, r in enumerate(regions)}
+    adj: list[set[int]] = [set() for _ in regions]
+    for src, dst in region_pairs:
+        if src == dst:
+            adj.append(set())
+            adj[index[src]].add(len(adj) - 1)
+            adj[-1].add(index[src])
+        else:
+            adj[index[src]].add(index[dst])
+            adj[index[dst]].add(index[src])
+    n = len(adj)
+    match = [-1] * n
+
+    # A greedy matching to start means few augmenting paths are needed
+    for v in range(n):
+        if match[v] == -1:
+            for to in adj[v]:
+                if match[to] == -1:
+                    match[v], match[to] = to, v
+                    break
+
+    def find_augmenting_path(root: int) -> bool:
+        used = [False] * n
+        parent = [-1] * n
+        base = list(range(n))
+
+        def lowest_common_ancestor(a: int, b: int) -> int:
+            on_path = [False] * n
+            while True:
+                a = base[a]
+                on_path[a] = True
+                if match[a] == -1:
+                    break
+                a = parent[match[a]]
+            while True:
+                b = base[b]
+                if on_path[b]:
+                    return b
+                b = parent[match[b]]
+
+        def mark_path(v: int, b: int, child: int, in_blossom: list[bool]):
+            while base[v] != b:
+                in_blossom[base[v]] = in_blossom[base[match[v]]] = True
+                parent[v] = child
+                child = match[v]
+                v = parent[match[v]]
+
+        used[root] = True
+        queue = collections.deque([root])
+        while queue:
+            v = queue.popleft()
+            for to in adj[v]:
+                if base[v] == base[to] or match[v] == to:
+                    continue
+                if to == root or (match[to] != -1 and parent[match[to]] != -1):
+                    # Odd cycle: Contract the blossom
+                    cur_base = lowest_common_ancestor(v, to)
+                    in_blossom = [False] * n
+                    mark_path(v, cur_base, to, in_blossom)
+                    mark_path(to, cur_base, v, in_blossom)
+                    for i in range(n):
+                        if in_blossom[base[i]]:
+                            base[i] = cur_base
+                            if not used[i]:
+                                used[i] = True
+                                queue.append(i)
+                elif parent[to] == -1:
+                    parent[to] = v
+                    if match[to] == -1:
+                        # Augment along the path
+                        while to != -1:
+                            prev = parent[to]
+                            next_ = match[prev]
+                            match[to], match[prev] = prev, to
+                            to = next_
+                        return True
+                    used[match[to]] = True
+                    queue.append(match[to])
+        return False
+
+    for v in range(n):
+        if match[v] == -1:
+            find_augmenting_path(v)
+
+    return sum(1 for m in match if m != -1) // 2
+
+
+def simulated_makespan(
+    ordered_pairs: list[tuple[Region, Region]], worker_count: int
+) -> int:
+    """
+    :return the number of test-durations needed to run these pairs where each worker
+    takes the first pair in the list whose regions are not now under test,
+    as the dispatcher does, assuming all tests take equally long.
+    """
+    remaining = list(ordered_pairs)
+    makespan = 0
+    while remaining:
+        busy = set()
+        taken = set()
+        for i, (src, dst) in enumerate(remaining):
+            if len(taken) == worker_count:
+                break
+            if src not in busy and dst not in busy:
+                busy |= {src, dst}
+                taken.add(i)
+        remaining = [p for i, p in enumerate(remaining) if i not in taken]
+        makespan += 1
+    return makespan
+
+
+def order_for_schedule(
+    schedule: str, region_pairs: list[tuple[Region, Region]], worker_count: int
+) -> list[tuple[Region, Region]]:
+    """
+    :return the pairs in the order that the dispatcher should prefer them.
+    With the rounds schedule, pairs are ordered round by round; a worker whose
+    regions are free takes pairs from a later round rather than wait for the current one to finish.
+    """
+    if schedule == SCHEDULE_GREEDY:
+        return region_pairs
+    elif schedule == SCHEDULE_ROUNDS:
+        rounds = tournament_rounds(region_pairs)
+        ordered = list(itertools.chain.from_iterable(rounds))
+        logging.info(
+            "Scheduled %d tests in %d rounds of up to %d parallel tests. "
+            "Expected makespan with %d workers, in units of one test's duration: "
+            "%d with rounds, vs. %d with greedy dispatch in list order",
+            len(ordered),
+            len(rounds),
+            max((len(r) for r in rounds), default=0),
+            worker_count,
+            simulated_makespan(ordered, worker_count),
+            simulated_makespan(region_pairs, worker_count),
+        )
+        return ordered
+    else:
+        raise ValueError(f"Unknown schedule {schedule}; should be one of {schedules}")
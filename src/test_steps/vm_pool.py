@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import logging
+from typing import Union, Optional, Callable, Awaitable, Hashable
+
+from cloud.clouds import Region, Cloud
+from history.run_journal import RunJournal
+from test_steps.create_vms import create_vms
+from test_steps.delete_vms import delete_vms
+from test_steps.utils import unique_regions
+
+
+class LiveVmBudget:
+    """Bounds the number of VMs alive at once, across batches."""
+
+    def __init__(self, max_live_vms: Union[int, float]):
+        self.__max_live_vms = max_live_vms
+        self.__live_vms = 0
+        self.__cond = asyncio.Condition()
+
+    async def acquire(self, vm_count: int, already_held: int = 0):
+        """:param already_held: VMs that are alive, and that the caller needs;
+        they are not waited for."""
+        async with self.__cond:
+            # A batch with more VMs than the maximum can run once no other VMs are alive
+            await self.__cond.wait_for(
+                lambda: self.__live_vms <= already_held
+                or self.__live_vms + vm_count <= self.__max_live_vms
+            )
+            self.__live_vms += vm_count
+
+    async def add_live(self, vm_count: int):
+        """Counts VMs that are already alive, without waiting."""
+        async with self.__cond:
+            self.__live_vms += vm_count
+
+    async def release(self, vm_count: int):
+        async with self.__cond:
+            self.__live_vms -= vm_count
+            self.__cond.notify_all()
+
+
+class VmPool:
+    """VMs that are kept alive across batches, keyed by region and machine type.
+
+    Each batch claims the regions it needs. A batch reuses the VM already up in a region,
+    and a VM is deleted only when no batch claims its region.
+    VMs are named and labeled with the ID given at launch, and deleted by region and that ID.
+    Launches and deletions are recorded in the journal, if given, as they happen.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        machine_types: dict[Cloud, str],
+        max_live_vms: Union[int, float] = float("inf"),
+        journal: Optional[RunJournal] = None,
+    ):
+        self.__run_id = run_id
+        self.__machine_types = machine_types
+        self.__budget = LiveVmBudget(max_live_vms)
+        self.__journal = journal
+        self.__claims: dict[Hashable, set[Region]] = {}
+        # The VM that is up in each region, with the ID it was launched with
+        self.__live: dict[tuple[Region, str], tuple[str, dict]] = {}
+        # IDs launched with in each region, whether or not the launch succeeded, until deleted
+        self.__launched: dict[tuple[Region, str], set[str]] = collections.defaultdict(
+            set
+        )
+        self.__launching: set[tuple[Region, str]] = set()
+
+    def __key(self, region: Region) -> tuple[Region, str]:
+        return region, self.__machine_types[region.cloud]
+
+    async def adopt(self, vms: dict[tuple[Region, str], Optional[dict]]):
+        """Takes on VMs left by an earlier process of this run, to be reused or deleted.
+        :param vms: by region and the ID launched with, the information on each VM,
+        or None if it may exist but there is no information on it, so that it can only be deleted
+        """
+        for (region, vm_run_id), vm_info in vms.items():
+            key = self.__key(region)
+            self.__launched[key].add(vm_run_id)
+            if vm_info is not None:
+                self.__live[key] = (vm_run_id, vm_info)
+        if vms:
+            logging.info("Reattached to VMs in %s", self.live_regions())
+        await self.__budget.add_live(len(vms))
+
+    def claim(self, claimant: Hashable, regions: list[Region]):
+        """Keeps the VMs in these regions from being deleted until the claimant releases them."""
+        self.__claims.setdefault(claimant, set()).update(regions)
+
+    async def launch(
+        self,
+        claimant: Hashable,
+        region_pairs: list[tuple[Region, Region]],
+        vm_run_id: str,
+        on_vm_ready: Optional[Callable[[Region, Optional[dict]], Awaitable[None]]],
+    ):
+        """Claims the regions of these pairs, and launches VMs where none is up.
+        :param on_vm_ready: as for create_vms, called also for VMs that are reused
+        """
+        regions = unique_regions(region_pairs)
+        self.claim(claimant, regions)
+        reused = {
+            r: self.__live[self.__key(r)][1]
+            for r in regions
+            if self.__key(r) in self.__live
+        }
+        to_launch = [r for r in regions if r not in reused]
+
+        await self.__budget.acquire(len(to_launch), already_held=len(reused))
+        for r in to_launch:
+            self.__launched[self.__key(r)].add(vm_run_id)
+            self.__launching.add(self.__key(r))
+            if self.__journal:
+                self.__journal.vm_launching(vm_run_id, r)
+
+        async def on_vm_ready_in_pool(region: Region, vm_info: Optional[dict]):
+            key = self.__key(region)
+            if region not in reused:
+                self.__launching.discard(key)
+                if vm_info is not None:
+                    self.__live[key] = (vm_run_id, vm_info)
+                if self.__journal:
+                    self.__journal.vm_launched(vm_run_id, region, vm_info)
+            if on_vm_ready:
+                await on_vm_ready(region, vm_info)
+
+        try:
+            await create_vms(
+                region_pairs,
+                self.__run_id,
+                self.__machine_types,
+                vm_run_id,
+                on_vm_ready=on_vm_ready_in_pool,
+                vms_already_up=reused,
+            )
+        finally:
+            for r in to_launch:
+                self.__launching.discard(self.__key(r))
+
+    async def release(self, claimant: Hashable):
+        """Deletes VMs in regions that no batch claims any more,
+        and any left over from failed launches."""
+        self.__claims.pop(claimant, None)
+        claimed = set().union(*self.__claims.values())
+
+        to_delete: dict[str, list[Region]] = collections.defaultdict(list)
+        for key, vm_run_ids in self.__launched.items():
+            region = key[0]
+            if key in self.__launching:
+                continue  # Will be released by its own claimant
+            keep = (
+                self.__live[key][0]
+                if region in claimed and key in self.__live
+                else None
+            )
+            for vm_run_id in vm_run_ids - {keep}:
+                to_delete[vm_run_id].append(region)
+
+        kept = [key[0] for key in self.__live if key[0] in claimed]
+        if kept:
+            logging.info("Keeping VMs in %s for later batches", kept)
+        if not to_delete:
+            return
+        for vm_run_id, regions in to_delete.items():
+            for region in regions:
+                key = self.__key(region)
+                self.__launched[key].discard(vm_run_id)
+                if self.__live.get(key, (None,))[0] == vm_run_id:
+                    del self.__live[key]
+        try:
+            await asyncio.gather(
+                *(
+                    delete_vms(vm_run_id, regions)
+                    for vm_run_id, regions in to_delete.items()
+                )
+            )
+            if self.__journal:
+                for vm_run_id, regions in to_delete.items():
+                    self.__journal.vms_deleted(vm_run_id, regions)
+        finally:
+            await self.__budget.release(sum(len(r) for r in to_delete.values()))
+
+    async def release_all(self):
+        self.__claims.clear()
+        await self.release(None)
+
+    def live_regions(self) -> list[Region]:
+        return [key[0] for key in self.__live]
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+import json
+import sys
+import threading
+import time
+
+import pytest
+
+from cloud import aws_regions_enabled
+from cloud.aws_regions_enabled import (
+    discover_aws_regions,
+    is_nonenabled_auth_aws_region,
+)
+from cloud.clouds import get_region, Cloud
+from util.utils import set_cwd, init_logger
+
+init_logger()
+
+# Answers for each region as configured, after its delay, and records that it was probed
+fake_probe = """
+import json, os, sys, time
+region = os.environ["REGION"]
+with open("probed.txt", "a") as f:
+    f.write(region + "\\n")
+delay_s, enabled = json.load(open("config.json"))[region]
+time.sleep(delay_s)
+sys.exit(0 if enabled else 1)
+"""
+
+old_check = "2000-01-01T00:00:00+00:00"
+
+
+@pytest.fixture
+def aws(tmp_path, monkeypatch):
+    """:return a function that configures the fake probe, with the delay and whether
+    enabled by region, and the regions file; and gives what is written to the file each time
+    """
+    set_cwd()
+    # Regions are loaded before leaving the source dir
+    get_region(Cloud.AWS, "us-east-1")
+    (tmp_path / "scripts").mkdir()
+    (tmp_path / "region_data").mkdir()
+    script = tmp_path / "scripts" / "aws-test-auth.sh"
+    script.write_text(f"#!{sys.executable}\n{fake_probe}")
+    script.chmod(0o755)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(aws_regions_enabled, "__enabled_regions", {})
+    monkeypatch.setattr(aws_regions_enabled, "__timed_out", set())
+    monkeypatch.setattr(aws_regions_enabled, "probe_timeout_s", 2)
+
+    saves = []
+    save = getattr(aws_regions_enabled, "__save")
+
+    def counted_save():
+        save()
+        with open("region_data/enabled_aws_regions.json") as f:
+            saves.append(json.load(f))
+
+    monkeypatch.setattr(aws_regions_enabled, "__save", counted_save)
+
+    def configure(probes: dict[str, tuple[float, bool]], saved: dict):
+        (tmp_path / "config.json").write_text(json.dumps(probes))
+        (tmp_path / "region_data" / "enabled_aws_regions.json").write_text(
+            json.dumps(saved)
+        )
+        return saves
+
+    return configure
+
+
+def __regions(*region_ids: str):
+    return [get_region(Cloud.AWS, r) for r in region_ids]
+
+
+def __probed() -> list[str]:
+    with open("probed.txt") as f:
+        return f.read().split()
+
+
+def test_probed_concurrently(aws):
+    regions = __regions("us-east-1", "us-west-2", "eu-west-1", "ap-south-1")
+    saves = aws({r.region_id: (1, r.region_id != "ap-south-1") for r in regions}, {})
+    start = time.time()
+    discover_aws_regions(regions)
+    assert time.time() - start < 3
+    # Written once
+    assert len(saves) == 1
+    assert {k: v["enabled"] for k, v in saves[0].items()} == {
+        r.region_id: r.region_id != "ap-south-1" for r in regions
+    }
+    assert [is_nonenabled_auth_aws_region(r) for r in regions] == [
+        False,
+        False,
+        False,
+        True,
+    ]
+
+
+def test_timed_out(aws, monkeypatch):
+    monkeypatch.setattr(aws_regions_enabled, "probe_timeout_s", 0.5)
+    known, unknown = __regions("us-east-1", "us-west-2")
+    saved = {"us-east-1": {"enabled": True, "checked": old_check}}
+    saves = aws({"us-east-1": (10, False), "us-west-2": (10, True)}, saved)
+    discover_aws_regions([unknown])
+    # Known, but stale, so checked again in the background
+    discover_aws_regions([known])
+    __join_rechecks()
+
+    assert not saves
+    assert not is_nonenabled_auth_aws_region(known)
+    # Not known, and not probed again in this process
+    assert is_nonenabled_auth_aws_region(unknown)
+    assert sorted(__probed()) == ["us-east-1", "us-west-2"]
+
+
+def test_stale_rechecked_in_background(aws):
+    stale, fresh = __regions("us-east-1", "us-west-2")
+    checked = "2100-01-01T00:00:00+00:00"
+    saved = {
+        "us-east-1": {"enabled": False, "checked": old_check},
+        "us-west-2": {"enabled": True, "checked": checked},
+    }
+    saves = aws({"us-east-1": (1, True)}, saved)
+    start = time.time()
+    discover_aws_regions([stale, fresh])
+    assert time.time() - start < 0.5
+    # The old value, meanwhile
+    assert is_nonenabled_auth_aws_region(stale)
+
+    __join_rechecks()
+    assert not is_nonenabled_auth_aws_region(stale)
+    assert __probed() == ["us-east-1"]
+    assert len(saves) == 1
+    assert saves[0]["us-east-1"]["checked"] > old_check
+    assert saves[0]["us-west-2"] == saved["us-west-2"]
+
+
+def __join_rechecks():
+    for t in threading.enumerate():
+        if t.name == "aws-regions-recheck":
+            t.join()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+import geopy.distance
+import numpy as np
+import pytest
+
+from cloud import clouds
+from cloud.clouds import (
+    get_region,
+    Cloud,
+    interregion_distance,
+    interregion_distances,
+)
+from util.utils import set_cwd, init_logger
+
+init_logger()
+
+
+@pytest.fixture
+def distances_file(tmp_path, monkeypatch):
+    """Distances loaded anew, and saved in a temporary file rather than in region_data"""
+    set_cwd()
+    monkeypatch.setattr(clouds, "__distances_file", str(tmp_path / "distances.npz"))
+    monkeypatch.setattr(clouds, "__distances", None)
+    return tmp_path / "distances.npz"
+
+
+def test_distances(distances_file):
+    pairs = [
+        (get_region(Cloud.GCP, "us-east1"), get_region(Cloud.AWS, "us-east-1")),
+        (get_region(Cloud.AWS, "eu-west-1"), get_region(Cloud.GCP, "asia-east2")),
+        (get_region(Cloud.GCP, "us-west1"), get_region(Cloud.GCP, "europe-west3")),
+    ]
+    expected = [
+        geopy.distance.distance((r1.lat, r1.long), (r2.lat, r2.long)).km
+        for r1, r2 in pairs
+    ]
+    assert [interregion_distance(r1, r2) for r1, r2 in pairs] == expected
+    assert [interregion_distance(r2, r1) for r1, r2 in pairs] == expected
+    assert (
+        list(
+            interregion_distances(
+                np.array([r1.idx for r1, _ in pairs]),
+                np.array([r2.idx for _, r2 in pairs]),
+            )
+        )
+        == expected
+    )
+    assert distances_file.exists()
+
+    r = pairs[0][0]
+    assert interregion_distance(r, r) == 0
+    frankfurt = [
+        get_region(Cloud.GCP, "europe-west3"),
+        get_region(Cloud.AWS, "eu-central-1"),
+    ]
+    # Known to be in the same city
+    assert interregion_distance(*frankfurt) == 10
+
+
+def test_rebuilt_when_locations_change(distances_file, monkeypatch):
+    builds = []
+    build = getattr(clouds, "__build_distances")
+    monkeypatch.setattr(
+        clouds, "__build_distances", lambda: builds.append(1) or build()
+    )
+    r1, r2 = get_region(Cloud.GCP, "us-east1"), get_region(Cloud.AWS, "eu-west-1")
+
+    def distance_in_new_process(locations_hash: str) -> float:
+        monkeypatch.setattr(clouds, "locations_hash", lambda: locations_hash)
+        monkeypatch.setattr(clouds, "__distances", None)
+        return interregion_distance(r1, r2)
+
+    d = distance_in_new_process("a")
+    assert len(builds) == 1
+    # Loaded from the file
+    assert distance_in_new_process("a") == d
+    assert len(builds) == 1
+    assert distance_in_new_process("b") == d
+    assert len(builds) == 2
+
+
+def test_unknown_zero_distance(distances_file, monkeypatch):
+    # Not known to be in the same city, though with identical coordinates
+    monkeypatch.setattr(clouds, "__samecity_crosscloud_datacenters", lambda: [])
+    r1 = get_region(Cloud.GCP, "europe-west3")
+    r2 = get_region(Cloud.AWS, "eu-central-1")
+    with pytest.raises(AssertionError):
+        interregion_distance(r1, r2)
+    with pytest.raises(AssertionError):
+        interregion_distances(np.array([r1.idx]), np.array([r2.idx]))
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import numpy as np
+
+from cloud.clouds import Cloud
+from history.columnar import HistoryColumns, cloud_codes
+from util.utils import init_logger
+
+init_logger()
+
+
+def test_select_by_masks():
+    gcp, aws = cloud_codes[Cloud.GCP], cloud_codes[Cloud.AWS]
+    columns = HistoryColumns(
+        {
+            "bitrate_Bps": np.array([1e6, 2e6, 3e6, 4e6]),
+            "avgrtt": np.array([10.0, 0.5, 30.0, 40.0]),
+            "distance": np.array([900.0, 0.0, 300.0, 600.0]),
+            "from_cloud": np.array([gcp, gcp, gcp, aws]),
+            "to_cloud": np.array([aws, gcp, aws, aws]),
+            "from_region": np.array([0, 0, 0, 1]),
+            "to_region": np.array([1, 0, 2, 2]),
+            "run_id": np.array([0, 0, 1, 1]),
+            "regions": np.array(["GCP.us-east1", "AWS.us-east-1", "AWS.eu-west-1"]),
+            "run_ids": np.array(["r1", "r2"]),
+        }
+    )
+    inter = columns.select(~columns.intra_region())
+    assert len(inter) == 3
+    by_distance = inter.select(np.argsort(inter.distance))
+    gcp_to_aws = by_distance.select(by_distance.cloud_pair(Cloud.GCP, Cloud.AWS))
+    assert list(gcp_to_aws.bitrate_Bps) == [3e6, 1e6]
+    assert list(gcp_to_aws.run_ids[gcp_to_aws.run_id]) == ["r2", "r1"]
+    assert list(gcp_to_aws.regions[gcp_to_aws.to_region]) == [
+        "AWS.eu-west-1",
+        "AWS.us-east-1",
+    ]
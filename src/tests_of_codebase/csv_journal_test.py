@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import tempfile
+
+from history import csv_journal
+from util.utils import init_logger
+
+init_logger()
+
+
+def test_append_read_compact():
+    path = tempfile.mkdtemp(prefix="csv_journal_test") + "/journal.csv"
+    csv_journal.append_rows(path, [{"a": "1", "b": "2"}], header=["a", "b"])
+    columns, rows, offset = csv_journal.read_rows(path)
+    assert columns == ["a", "b"] and rows == [{"a": "1", "b": "2"}]
+
+    # New column, and a partly written row from a crash before it
+    with open(path, "a") as f:
+        f.write("3")
+    csv_journal.append_rows(path, [{"a": "4", "b": "5", "c": "6"}])
+    columns, rows, _ = csv_journal.read_rows(path)
+    assert columns == ["a", "b", "c"]
+    assert rows == [
+        {"a": "1", "b": "2", "c": ""},
+        {"a": "4", "b": "5", "c": "6"},
+    ]
+    assert list(csv_journal.iter_rows(path)) == [
+        {"a": "1", "b": "2"},
+        {"a": "4", "b": "5", "c": "6"},
+    ]
+
+    # Only what was appended since, under the header in effect there
+    csv_journal.append_rows(path, [{"a": "7", "c": "8"}])
+    _, rows_since, _ = csv_journal.read_rows(path, offset)
+    assert rows_since == rows[1:] + [{"a": "7", "b": "", "c": "8"}]
+
+    assert csv_journal.compact(path) == 3
+    with open(path) as f:
+        assert sum(line.startswith("a,") for line in f) == 1
+    assert csv_journal.read_rows(path)[1] == rows + [{"a": "7", "b": "", "c": "8"}]
+
+
+def test_torn_row():
+    path = tempfile.mkdtemp(prefix="csv_journal_test") + "/journal.csv"
+    row = {"a": "1", "b": "2", "c": "t3.nano"}
+    csv_journal.append_rows(path, [row])
+    # Cut inside its last field by a crash, so with as many fields as the header
+    with open(path, "a") as f:
+        f.write("5,6,t3.na")
+    assert csv_journal.read_rows(path)[1] == [row]
+    assert list(csv_journal.iter_rows(path)) == [row]
+
+    csv_journal.append_rows(path, [row | {"a": "7"}])
+    assert csv_journal.read_rows(path)[1] == [row, row | {"a": "7"}]
+    with open(path) as f:
+        assert "t3.na\n" not in f.read()
+
+
+def test_count_rows():
+    d = tempfile.mkdtemp(prefix="csv_journal_test")
+    path, index_path = d + "/journal.csv", d + "/index.json"
+    key = lambda r: (r["a"],) if r["a"] != "skip" else None
+    assert not csv_journal.count_rows(path, index_path, key)
+
+    csv_journal.append_rows(path, [{"a": "x"}, {"a": "y"}, {"a": "skip"}])
+    assert csv_journal.count_rows(path, index_path, key) == {("x",): 1, ("y",): 1}
+    # Only the rows since are counted, added to the counts in the index
+    csv_journal.append_rows(path, [{"a": "x", "b": "1"}])
+    assert csv_journal.count_rows(path, index_path, key) == {("x",): 2, ("y",): 1}
+
+    # Counted anew when the file is replaced
+    csv_journal.compact(path)
+    csv_journal.append_rows(path, [{"a": "y"}])
+    assert csv_journal.count_rows(path, index_path, key) == {("x",): 2, ("y",): 2}
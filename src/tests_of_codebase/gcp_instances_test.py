@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+from cloud import gcp_instances
+from cloud.clouds import get_region, Cloud
+from util.utils import set_cwd, init_logger
+
+init_logger()
+
+# Keeps instances as files in the state directory, and fails as configured there
+fake_gcloud = """
+import glob, json, os, sys, time
+args = sys.argv[1:]
+if args[:2] == ["config", "get-value"]:
+    print("project")  # Run without the environment below
+    sys.exit()
+state = os.environ["FAKE_GCLOUD_STATE"]
+config = json.load(open(f"{state}/config.json"))
+opt = lambda k: next((a.split("=", 1)[1] for a in args if a.startswith(f"--{k}=")), None)
+if args[:3] == ["compute", "instances", "create"]:
+    name = args[3]
+    if name in config["fail_create"]:
+        sys.exit(1)
+    instance = {"name": name, "zone": "zones/" + opt("zone"), "created": time.time()}
+    json.dump(instance, open(f"{state}/{name}.json", "w"))
+elif args[:3] == ["compute", "instances", "delete"]:
+    for name in [a for a in args[4:] if not a.startswith("-")]:
+        if name in config["fail_delete_once"] and not os.path.exists(f"{state}/{name}.failed"):
+            open(f"{state}/{name}.failed", "w").close()
+            sys.exit(1)
+        instance = json.load(open(f"{state}/{name}.json"))
+        json.dump(instance | {"deleted": time.time()}, open(f"{state}/{name}.json", "w"))
+    if config["fail_list_after_delete"]:
+        open(f"{state}/list.fails", "w").close()
+elif args[2] == "list":
+    if os.path.exists(f"{state}/list.fails"):
+        sys.exit(1)
+    out = []
+    for path in glob.glob(f"{state}/*.json"):
+        i = json.load(open(path))
+        if "name" not in i:
+            continue
+        if args[1] == "operations":
+            if i["name"] in config["op_error"] and "insert" in opt("filter"):
+                out.append({"targetLink": "instances/" + i["name"], "status": "DONE",
+                            "error": {"errors": [{"message": "exhausted"}]}})
+            continue
+        if i["name"] in config["op_error"] or time.time() - i.get("deleted", 1e12) > 0.2:
+            continue
+        up = time.time() - i["created"] > 0.2 and i["name"] not in config["never_up"]
+        out.append({"name": i["name"], "zone": i["zone"], "status": "RUNNING" if up else "STAGING",
+                    "networkInterfaces": [{"accessConfigs": [{"natIP": "10.0.0.1"}] if up else []}]})
+    print(json.dumps(out))
+else:
+    sys.exit(2)
+"""
+
+
+@pytest.fixture
+def gcloud(tmp_path, monkeypatch):
+    """:return a function that configures the fake gcloud, which is on PATH"""
+    set_cwd()
+    (tmp_path / "bin").mkdir()
+    script = tmp_path / "bin" / "gcloud"
+    script.write_text(f"#!{sys.executable}\n{fake_gcloud}")
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_GCLOUD_STATE", str(tmp_path))
+    monkeypatch.setattr(gcp_instances, "poll_interval_s", 0.05)
+
+    def configure(**config):
+        defaults = dict.fromkeys(
+            ["fail_create", "op_error", "never_up", "fail_delete_once"], []
+        )
+        defaults["fail_list_after_delete"] = False
+        (tmp_path / "config.json").write_text(json.dumps(defaults | config))
+        return tmp_path
+
+    return configure
+
+
+def __regions(*region_ids: str):
+    return [get_region(Cloud.GCP, r) for r in region_ids]
+
+
+def test_create_failures(gcloud):
+    ok, fails, op_error, never_up = __regions(
+        "us-east1", "asia-east2", "europe-west1", "us-west1"
+    )
+    gcloud(
+        fail_create=[gcp_instances.instance_name("r1", fails)],
+        op_error=[gcp_instances.instance_name("r1", op_error)],
+        never_up=[gcp_instances.instance_name("r1", never_up)],
+    )
+    outputs = {}
+
+    async def on_created(region, output):
+        outputs[region] = output
+
+    asyncio.run(
+        gcp_instances.create_instances(
+            "r1", [ok, fails, op_error, never_up], "e2-small", on_created, timeout=1
+        )
+    )
+    assert outputs[ok] == f"10.0.0.1,intercloud-us-east1-r1,us-east1-b"
+    assert isinstance(outputs[fails], ChildProcessError)
+    assert str(outputs[op_error]) == "exhausted"
+    assert "Not up" in str(outputs[never_up])
+
+
+def test_delete_with_sweep(gcloud):
+    regions = __regions("us-east1", "us-west1", "europe-west3")
+    # The request for this one fails, and it is deleted in the sweep
+    state = gcloud(fail_delete_once=[gcp_instances.instance_name("r2", regions[1])])
+    __create("r2", regions)
+
+    deletions = asyncio.run(gcp_instances.delete_instances("r2", regions, timeout=5))
+    assert sorted(deletions) == sorted(
+        gcp_instances.instance_name("r2", r) for r in regions
+    )
+    assert all(d.error is None and d.latency_s > 0 for d in deletions.values())
+    assert not asyncio.run(gcp_instances.list_instances("project", "r2"))
+    assert os.path.exists(
+        state / f"{gcp_instances.instance_name('r2', regions[1])}.failed"
+    )
+
+
+def test_delete_when_polling_fails(gcloud):
+    regions = __regions("us-east1", "us-west1")
+    gcloud(fail_list_after_delete=True)
+    __create("r3", regions)
+
+    # Gives up at the deadline, rather than polling for ever
+    deletions = asyncio.run(
+        asyncio.wait_for(gcp_instances.delete_instances("r3", regions, timeout=0.5), 10)
+    )
+    assert len(deletions) == 2
+    assert all("Not deleted" in d.error for d in deletions.values())
+
+
+def __create(run_id: str, regions):
+    async def on_created(_, output):
+        assert isinstance(output, str), output
+
+    asyncio.run(gcp_instances.create_instances(run_id, regions, "e2-small", on_created))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import asyncio
+
+import pytest
+
+from test_steps.measurement import (
+    Transport,
+    MeasurementError,
+    measure,
+    parse_iperf_csv,
+    parse_ping_summary,
+)
+from util.utils import init_logger
+
+init_logger()
+
+iperf_output = (
+    "20220301120000,10.0.0.2,54321,34.1.2.3,5001,3,0.0-10.0,123456789,98765431\n"
+)
+ping_output = (
+    "5 packets transmitted, 5 received, 0% packet loss, time 4005ms\n"
+    "rtt min/avg/max/mdev = 70.120/70.345/70.901/0.280 ms\n"
+)
+
+
+class __FakeTransport(Transport):
+    """Fails the first attempts at each command, then gives the output"""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.commands = []
+
+    async def run(self, command: str) -> str:
+        self.commands.append(command)
+        if len([c for c in self.commands if c == command]) <= self.failures:
+            raise ChildProcessError("Error 255")
+        return iperf_output if command.startswith("iperf") else ping_output
+
+
+def test_parse():
+    assert parse_iperf_csv(iperf_output) == 123456789
+    assert parse_ping_summary(ping_output) == 70.345
+
+
+def test_measure_with_retries():
+    transport = __FakeTransport(failures=2)
+    m = asyncio.run(measure(transport, "34.1.2.3", attempts=3, retry_delay_s=0))
+    assert (m.bitrate_Bps, m.avgrtt_ms) == (123456789, 70.345)
+    assert set(m.timings) == {"iperf", "ping"}
+    assert len(transport.commands) == 6
+
+
+def test_measure_fails_with_step():
+    with pytest.raises(MeasurementError) as e:
+        asyncio.run(
+            measure(__FakeTransport(failures=3), "34.1.2.3", 3, retry_delay_s=0)
+        )
+    assert e.value.step == "iperf"
+    assert e.value.attempts == 3
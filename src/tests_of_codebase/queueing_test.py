@@ -1,19 +1,49 @@
 #!/usr/bin/env python
+import asyncio
 import itertools
+import os
+import tempfile
 
+import pytest
+
+from cloud import providers
 from cloud.clouds import get_region, Cloud, get_regions
-from test_steps.do_test import do_batch
+from cloud.simulated import simulate_clouds
+from history import result_writer, results
+from history.attempted import failures_per_region_pair
+from history.results import perftest_resultsdir_envvar, results_dir
+from test_steps.do_test import do_batch, plan_batch, RetryPolicy
 from util.utils import set_cwd, random_id, Timer, init_logger
 
 init_logger()
 
 
+@pytest.fixture(autouse=True)
+def simulated_clouds(tmp_path, monkeypatch):
+    """Simulated clouds for each test, with the real providers restored after it"""
+    # Results from simulated tests must not go into the real results
+    monkeypatch.setenv(perftest_resultsdir_envvar, str(tmp_path))
+    results_dir.cache_clear()
+    monkeypatch.setattr(providers, "__providers", {})
+    simulate_clouds(list(Cloud), time_scale=0.001, seed=1)
+    yield
+    results_dir.cache_clear()
+
+
+def __with_vm_info(region):
+    vm_info = {"address": f"{region}-address", "machine_type": "simulated"}
+    if region.cloud == Cloud.GCP:
+        vm_info |= {"name": f"{region}-name", "zone": f"{region.region_id}-b"}
+    return region, vm_info
+
+
 def test1():
+    set_cwd()
     run_id = random_id()
-    t1 = (get_region(Cloud.GCP, "us-east1"), {})
-    t2 = (get_region(Cloud.GCP, "us-central1"), {})
-    t3 = (get_region(Cloud.AWS, "us-east-1"), {})
-    t4 = (get_region(Cloud.AWS, "us-east-2"), {})
+    t1 = __with_vm_info(get_region(Cloud.GCP, "us-east1"))
+    t2 = __with_vm_info(get_region(Cloud.GCP, "us-central1"))
+    t3 = __with_vm_info(get_region(Cloud.AWS, "us-east-1"))
+    t4 = __with_vm_info(get_region(Cloud.AWS, "us-east-2"))
 
     test_input = [
         (t1, t2),
@@ -21,18 +51,64 @@ def test1():
         (t3, t4),
         (t4, t3),
     ]
-    do_batch(run_id, test_input)
+    asyncio.run(do_batch(run_id, test_input))
 
 
 def test2():
+    set_cwd()
     run_id = random_id()
     regions = get_regions()[:40]
     region_pairs = itertools.product(regions, regions)
-    test_input = [((r[0], {}), (r[1], {})) for r in region_pairs]
-    do_batch(run_id, test_input)
+    test_input = [(__with_vm_info(r[0]), __with_vm_info(r[1])) for r in region_pairs]
+    asyncio.run(do_batch(run_id, test_input))
+
+
+def test_unwritten_results_fail_tests(monkeypatch):
+    set_cwd()
+    t1 = __with_vm_info(get_region(Cloud.GCP, "us-east1"))
+    t2 = __with_vm_info(get_region(Cloud.AWS, "us-east-1"))
+
+    def append_results(_):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(result_writer, "append_results", append_results)
+    asyncio.run(do_batch(random_id(), [(t1, t2), (t2, t1)]))
+    assert not results.tests_per_region_pair()
+    assert set(failures_per_region_pair()) == {
+        ("GCP", "us-east1", "AWS", "us-east-1"),
+        ("AWS", "us-east-1", "GCP", "us-east1"),
+    }
+
+
+def test_retry_after_other_tests():
+    set_cwd()
+    r1, r2, r3 = [
+        __with_vm_info(get_region(Cloud.GCP, r))
+        for r in ["us-east1", "us-central1", "us-west1"]
+    ]
+
+    async def run():
+        q = plan_batch(
+            [(r1[0], r2[0]), (r1[0], r3[0])],
+            retry_policy=RetryPolicy(attempts=2, backoff_s=0.01),
+        )
+        for region, vm_info in [r1, r2, r3]:
+            await q.vm_ready(region, vm_info)
+        taken = []
+        while (pair := await q.blocking_dequeue_one()) is not None:
+            taken.append((pair[0][0], pair[1][0]))
+            # Every test fails
+            if not await q.retry_later(*pair):
+                await q.one_test_done(*pair)
+        return taken
+
+    assert asyncio.run(run()) == [(r1[0], r2[0]), (r1[0], r3[0])] * 2
 
 
 if __name__ == "__main__":
+    # As in the fixture: results from simulated tests must not go into the real results
+    os.environ[perftest_resultsdir_envvar] = tempfile.mkdtemp(prefix="queueing_test")
+    simulate_clouds(list(Cloud), time_scale=0.001, seed=1)
     with Timer("Full run"):
         set_cwd()
         test2()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import time
+
+from cloud.clouds import get_region, Cloud
+from history import result_writer
+from history.result_writer import ResultWriter
+from util.utils import init_logger
+
+init_logger()
+
+
+def __fake_append_results(monkeypatch, failures: int):
+    """:return the results written, by a replacement for append_results
+    that fails the first calls"""
+    written = []
+    calls = []
+
+    def append_results(results_j: list[dict]):
+        calls.append(results_j)
+        if len(calls) <= failures:
+            raise OSError("No space left on device")
+        written.extend(results_j)
+
+    monkeypatch.setattr(result_writer, "append_results", append_results)
+    return written, calls
+
+
+def __test(src_id: str, dst_id: str):
+    src, dst = get_region(Cloud.GCP, src_id), get_region(Cloud.GCP, dst_id)
+    return src, dst, {"from": src_id, "to": dst_id}
+
+
+def test_retried_writes(monkeypatch):
+    written, calls = __fake_append_results(monkeypatch, failures=2)
+    writer = ResultWriter(group_interval_s=0.1, write_attempts=3, retry_delay_s=0.01)
+    tests = [__test("us-east1", "us-west1"), __test("us-west1", "us-east1")]
+    for t in tests:
+        writer.write(*t)
+    assert writer.close() == []
+    # Written together, once, after failing twice
+    assert len(calls) == 3
+    assert written == [result_j for _, _, result_j in tests]
+
+
+def test_unwritten_tests(monkeypatch):
+    written, calls = __fake_append_results(monkeypatch, failures=3)
+    writer = ResultWriter(group_interval_s=0.1, write_attempts=3, retry_delay_s=0.01)
+    given_up = [__test("us-east1", "us-west1"), __test("us-west1", "us-east1")]
+    for t in given_up:
+        writer.write(*t)
+    while len(calls) < 3:
+        time.sleep(0.01)
+    # In a later group, which is written
+    later = __test("us-east1", "europe-west1")
+    writer.write(*later)
+
+    assert writer.close() == [(src, dst) for src, dst, _ in given_up]
+    assert written == [later[2]]
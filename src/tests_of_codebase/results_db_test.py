@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import csv
+import os
+import tempfile
+from contextlib import closing
+
+from history import results_db
+from util.utils import init_logger
+
+init_logger()
+
+header = ["timestamp", "run_id", "from_cloud", "from_region", "to_cloud", "to_region"]
+header += ["bitrate_Bps", "avgrtt", "gcp_vm", "aws_vm"]
+
+
+def __row(run_id, from_region, to_region, bitrate):
+    return dict(
+        zip(
+            header,
+            ["2022-02-14T08:59:09Z", run_id, "GCP", from_region, "AWS", to_region]
+            + [bitrate, 191.6, "e2-small", "t3.nano"],
+        )
+    )
+
+
+def test_index_follows_csv():
+    d = tempfile.mkdtemp(prefix="results_db_test")
+    csv_path, db_path = f"{d}/results.csv", f"{d}/results.db"
+    rows = [__row("r1", "us-east1", "eu-west-2", 1e6)]
+
+    def load_csv():
+        with open(csv_path) as f:
+            return header, [
+                r
+                | {"bitrate_Bps": float(r["bitrate_Bps"]), "avgrtt": float(r["avgrtt"])}
+                for r in csv.DictReader(f)
+            ]
+
+    def write_csv():
+        with open(csv_path, "w") as f:
+            writer = csv.DictWriter(f, header)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    write_csv()
+    with closing(results_db.connect(db_path, csv_path, load_csv)) as conn:
+        assert results_db.load_all(conn) == rows
+        assert results_db.has_succeeded(conn, "GCP", "us-east1", "AWS", "eu-west-2")
+        assert not results_db.has_succeeded(conn, "GCP", "us-east1", "AWS", "eu-west-1")
+
+    # Changed outside the database, so it is rebuilt
+    rows += [__row("r2", "us-east1", "eu-west-2", 2e6)]
+    write_csv()
+    os.utime(csv_path, ns=(0, 0))
+    with closing(results_db.connect(db_path, csv_path, load_csv)) as conn:
+        assert results_db.load_all(conn) == rows
+
+        # Added in step with the CSV
+        rows += [__row("r3", "us-west1", "eu-west-2", 3e6)]
+        write_csv()
+        results_db.add_results(conn, csv_path, rows[-1:])
+    with closing(results_db.connect(db_path, csv_path, lambda: 1 / 0)) as conn:
+        # Not rebuilt, since it is in step with the CSV
+        assert results_db.load_all(conn) == rows
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import pytest
+
+from cloud.clouds import get_region, Cloud
+from history.results import perftest_resultsdir_envvar, results_dir
+from history.run_journal import RunJournal, load_run
+from util.utils import set_cwd, random_id, init_logger
+
+init_logger()
+
+
+@pytest.fixture(autouse=True)
+def temporary_results_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(perftest_resultsdir_envvar, str(tmp_path))
+    results_dir.cache_clear()
+    yield
+    results_dir.cache_clear()
+
+
+def test_resume_from_journal():
+    set_cwd()
+    run_id = random_id()
+    r1 = get_region(Cloud.AWS, "af-south-1")
+    r2 = get_region(Cloud.GCP, "asia-east2")
+    r3 = get_region(Cloud.GCP, "asia-south1")
+    machine_types = {Cloud.AWS: "t3.nano", Cloud.GCP: "e2-small"}
+    vm_info = {"machine_type": "t3.nano", "address": "10.0.0.1"}
+
+    journal = RunJournal(run_id)
+    run_options = {"schedule": "greedy", "max_live_vms": float("inf")}
+    journal.batches_planned(
+        0, [[(r1, r2), (r2, r1)], [(r2, r3)]], machine_types, run_options
+    )
+    journal.vm_launching(f"{run_id}-0", r1)
+    journal.vm_launching(f"{run_id}-0", r2)
+    journal.vm_launched(f"{run_id}-0", r1, vm_info)
+    journal.test_done(r2, r1, succeeded=False)
+    journal.vm_launching(f"{run_id}-1", r3)
+    journal.vms_deleted(f"{run_id}-1", [r3])
+    journal.test_done(r1, r2, succeeded=False)
+    # A crash while writing
+    with open(f"{results_dir()}/run-journals/{run_id}.jsonl", "a") as f:
+        f.write('{"event": "test_do')
+
+    run = load_run(run_id)
+    assert not run.finished
+    assert run.machine_types == machine_types
+    assert run.run_options == run_options
+    # The launch in r2 did not finish, so the VM may exist, but cannot be reused
+    assert run.vms == {(r1, f"{run_id}-0"): vm_info, (r2, f"{run_id}-0"): None}
+    assert run.pending_batches() == [[(r2, r3)]]
+    assert run.next_batch_idx() == 2
+
+    # Resumed, with the batches left planned again after those before
+    journal = RunJournal(run_id)
+    journal.batches_planned(2, run.pending_batches(), machine_types, run_options)
+    journal.run_finished()
+    run = load_run(run_id)
+    assert run.finished
+    assert run.pending_batches() == [[(r2, r3)]]
+    assert run.next_batch_idx() == 3
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import itertools
+
+from cloud.clouds import get_regions
+from test_steps.scheduling import (
+    tournament_rounds,
+    simulated_makespan,
+    max_parallel_tests,
+)
+from util.utils import set_cwd, init_logger
+
+init_logger()
+
+
+def __all_directed_pairs(n):
+    regions = get_regions()[:n]
+    return [(r1, r2) for r1, r2 in itertools.product(regions, regions) if r1 != r2]
+
+
+def test_rounds_are_region_disjoint():
+    set_cwd()
+    for n in [2, 3, 7, 10]:
+        pairs = __all_directed_pairs(n)
+        rounds = tournament_rounds(pairs)
+        assert sorted(itertools.chain.from_iterable(rounds)) == sorted(pairs)
+        for rnd in rounds:
+            regions_in_round = list(itertools.chain.from_iterable(rnd))
+            assert len(regions_in_round) == len(set(regions_in_round)), rnd
+        # Circle method: Each region meets each other in both directions, n-1 rounds each way
+        assert len(rounds) == 2 * (n - 1 if n % 2 == 0 else n), (n, len(rounds))
+
+
+def test_rounds_makespan_not_worse_than_greedy():
+    set_cwd()
+    pairs = __all_directed_pairs(20)
+    ordered = list(itertools.chain.from_iterable(tournament_rounds(pairs)))
+    for worker_count in [1, 4, 10]:
+        assert simulated_makespan(ordered, worker_count) <= simulated_makespan(
+            pairs, worker_count
+        )
+
+
+def test_max_parallel_tests():
+    set_cwd()
+    for n in [2, 3, 7, 10]:
+        assert max_parallel_tests(__all_directed_pairs(n)) == n // 2
+
+    r = get_regions()[:6]
+    # A path r0-r1-r2 and a triangle r3-r4-r5, with an intra-region test in r2
+    pairs = [(r[0], r[1]), (r[2], r[1]), (r[3], r[4]), (r[4], r[5]), (r[5], r[3])]
+    assert max_parallel_tests(pairs) == 2
+    assert max_parallel_tests(pairs + [(r[2], r[2])]) == 3
+
+
+if __name__ == "__main__":
+    set_cwd()
+    test_rounds_are_region_disjoint()
+    test_rounds_makespan_not_worse_than_greedy()
+    test_max_parallel_tests()
@@ -1,4 +1,14 @@
+import asyncio
+import os
+import signal
 import subprocess
+import weakref
+from typing import Optional
+
+# Bounds the subprocesses running at once in one event loop
+max_concurrent_subprocesses = 100
+
+__limits: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
 
 
 def run_subprocess(script: str, env: dict) -> str:
@@ -7,3 +17,53 @@ def run_subprocess(script: str, env: dict) -> str:
         raise ChildProcessError(f"Error {process.returncode}")
     else:
         return process.stdout
+
+
+def __concurrency_limit() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in __limits:
+        __limits[loop] = asyncio.Semaphore(max_concurrent_subprocesses)
+    return __limits[loop]
+
+
+async def run_subprocess_async(
+    script: str, env: dict, timeout: Optional[float] = None
+) -> str:
+    """As run_subprocess, but in the event loop.
+    On timeout or cancellation, the script and any processes it started are killed.
+    """
+    return await run_command_async([script], env, timeout)
+
+
+async def run_command_async(
+    args: list[str], env: Optional[dict] = None, timeout: Optional[float] = None
+) -> str:
+    """Runs a command directly, without a shell, as for run_subprocess_async.
+    :param env: by default, this process's environment
+    """
+    async with __concurrency_limit():
+        # A new session, so that the command's children can be killed with it
+        process = await asyncio.create_subprocess_exec(
+            *args, env=env, stdout=subprocess.PIPE, start_new_session=True
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            await __kill(process)
+            raise ChildProcessError(f"Timed out after {timeout} s: {args[0]}")
+        except asyncio.CancelledError:
+            await __kill(process)
+            raise
+
+    if process.returncode:
+        raise ChildProcessError(f"Error {process.returncode}")
+    else:
+        return stdout.decode()
+
+
+async def __kill(process: asyncio.subprocess.Process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # Already exited
+    await process.wait()
@@ -15,7 +15,8 @@ from util import subprocesses
 
 __gcp_default = None
 
-thread_timeout = 5 * 60
+# For each run of a launch, test, or deletion script
+subprocess_timeout = 5 * 60
 
 
 def init_logger():